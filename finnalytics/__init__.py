@@ -19,14 +19,46 @@
 
 '''
 
-# submodules
-from . import config
-from . import base
-from . import logic
-from . import pages
-from . import models
-from . import services
-from . import dispatch
+
+# stdlib
+import sys
+import types
+import importlib
+
+
+##### !!! Lazy Package !!! #####
+class Package(types.ModuleType):
+
+  ''' stands in for a package in ``sys.modules``, so importing it
+      costs nothing up front: each submodule listed in its ``__all__``
+      is imported the first time it is accessed as an attribute. used
+      by this package, :py:mod:`finnalytics.logic` and
+      :py:mod:`finnalytics.storage`. to build the app (importing
+      everything it serves), see :py:func:`finnalytics.dispatch.create`. '''
+
+  def __getattr__(self, name):
+
+    ''' import the submodule ``name`` on first access '''
+
+    if name not in self.__dict__.get('__all__', ()): raise AttributeError(name)
+    return importlib.import_module('%s.%s' % (self.__name__, name))
+
+  def __dir__(self):
+
+    ''' list loaded attributes and lazy submodules '''
+
+    return sorted(set(self.__dict__) | set(self.__all__))
+
+
+def lazy(name):
+
+  ''' swap the package module ``name`` for a lazy :py:class:`Package`,
+      which holds a reference to the original (so its globals survive) '''
+
+  module = sys.modules[name]
+  package = sys.modules[name] = Package(name, module.__doc__)
+  package.__dict__.update(module.__dict__, _module=module)
+  return package
 
 
 __all__ = (
@@ -36,5 +68,11 @@ __all__ = (
   'pages',
   'models',
   'services',
-  'dispatch'
+  'dispatch',
+  'storage',
+  'templates'
 )
+
+
+# swap in the lazy package
+lazy(__name__)
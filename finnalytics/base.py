@@ -19,9 +19,105 @@
 
 '''
 
+# stdlib
+import time
+import functools
+import itertools
+
 # canteen
-from canteen import rpc, model
+from canteen import rpc, model, Page
 from canteen.rpc import premote as proto
+from canteen.model.adapter import RedisAdapter
+
+# finnalytics
+from .storage.pool import pools
+from .logic.assets import assets
+from .logic.cache import renders
+from .logic.metrics import metrics
+from .logic.manifest import manifest
+from .templates.extensions import flushed
+
+
+##### !!! Record Batches !!! #####
+class RecordBatch(object):
+
+  ''' columnar batch of would-be entities of one model. columns are
+      held as given (lists, tuples or arrays), so building a batch
+      allocates no per-row objects at all. keys are built on demand,
+      and a full model instance only when a row is indexed. '''
+
+  __slots__ = ('kind', 'ids', 'parents', 'columns', 'keys', 'resolved')
+
+  def __init__(self, kind, ids, parents, columns):
+
+    ''' initialize a batch of ``kind`` entities from a sequence of
+        ``ids``, a sequence of ``parents`` (or ``None``), and a mapping
+        of property name to a sequence of values for each row. '''
+
+    for name, column in columns.iteritems():
+      if len(column) != len(ids):
+        raise ValueError('Expected %s values for "%s", got %s.' % (len(ids), name, len(column)))
+    if parents is not None and len(parents) != len(ids):
+      raise ValueError('Expected %s parents, got %s.' % (len(ids), len(parents)))
+
+    self.kind, self.ids, self.parents, self.columns = kind, ids, parents, columns
+    self.keys, self.resolved = {}, {}
+
+  def __len__(self):
+
+    ''' number of rows in this batch '''
+
+    return len(self.ids)
+
+  def __getitem__(self, index):
+
+    ''' materialize the model instance for row ``index`` '''
+
+    values = dict((name, column[index]) for name, column in self.columns.iteritems())
+    if hasattr(self.kind, 'id'): values['id'] = self.ids[index]
+    return self.kind(key=self.key(index), **values)
+
+  def __iter__(self):
+
+    ''' materialize each row's model instance in turn '''
+
+    for index in xrange(len(self.ids)):
+      yield self[index]
+
+  def column(self, name):
+
+    ''' the raw value sequence for property ``name`` '''
+
+    return self.columns[name]
+
+  def parent(self, index):
+
+    ''' resolve the parent key for row ``index``. parents may be given
+        as keys, or as ``(kind, id)`` pairs, which are turned into keys
+        once each no matter how many rows share them. '''
+
+    parent = self.parents[index] if self.parents is not None else None
+    if parent is None or isinstance(parent, model.Key): return parent
+
+    resolved = self.resolved.get(parent)
+    if resolved is None:
+      resolved = self.resolved[parent] = model.Key(*parent)
+    return resolved
+
+  def key(self, index):
+
+    ''' build (once) the key for row ``index`` '''
+
+    key = self.keys.get(index)
+    if key is None:
+      key = self.keys[index] = model.Key(self.kind, self.ids[index], parent=self.parent(index))
+    return key
+
+  def put(self):
+
+    ''' persist every row, via :py:meth:`BaseModel.put_multi` '''
+
+    return self.kind.put_multi(self)
 
 
 ##### !!! Base Model !!! #####
@@ -38,7 +134,7 @@ class BaseModel(model.Model):
 
     # figure out key ID and parent
     id, parent = (
-      parent if (not id or (isinstance(basestring, parent) and not parent)) else id,
+      parent if (not id or (isinstance(parent, basestring) and not parent)) else id,
       parent if not isinstance(parent, basestring) else None
     )
 
@@ -48,8 +144,336 @@ class BaseModel(model.Model):
     # factory object
     return cls(key=model.Key(cls, id, parent=parent), **kwargs)
 
+  @classmethod
+  def bulk(cls, ids, parent=None, parents=None, rows=None, fields=None, **columns):
+
+    ''' build many entities at once, as a lazy :py:class:`RecordBatch`.
+
+        :param ids: sequence of key IDs, one per row.
+        :param parent: optional parent key (or ``(kind, id)`` pair)
+          shared by every row.
+        :param parents: optional sequence of parent keys (or ``(kind,
+          id)`` pairs), one per row.
+        :param rows: optional sequence of value tuples, ordered as
+          ``fields``, as an alternative to passing ``columns``.
+        :param columns: property values, as one sequence per property.
+        :returns: :py:class:`RecordBatch` of ``len(ids)`` rows. '''
+
+    if rows is not None:
+      columns.update(zip(fields, zip(*rows) if rows else [()] * len(fields)))
+    if parent is not None:
+      parents = [parent] * len(ids)
+    return RecordBatch(cls, ids, parents, columns)
+
+  ## == Sharding == ##
+  @staticmethod
+  def _shard(key):
+
+    ''' resolve the ring key that decides which server stores ``key``:
+        its root ancestor, as a ``{hashtag}``, so that a whole entity
+        group (like everything built by :py:meth:`factory` under one
+        parent) is owned by a single server. '''
+
+    return '{%s}' % next(iter(key.ancestry)).urlsafe()
+
+  @staticmethod
+  def _route(stored):
+
+    ''' map a stored Redis key back to its ring key, for
+        :py:meth:`finnalytics.storage.pool.Pools.rebalance`. returns
+        ``None`` for anything that isn't the key of a sharded entity. '''
+
+    try:
+      key = model.Key.from_urlsafe(stored)
+    except Exception:
+      return None
+
+    kind = RedisAdapter.registry.get(key.kind)
+    if not (isinstance(kind, type) and issubclass(kind, BaseModel)): return None
+    return BaseModel._shard(key)
+
+  ## == Single Operations == ##
+  def put(self, adapter=None, **kwargs):
+
+    ''' persist this entity. on Redis, it's written (via
+        :py:meth:`put_multi`) to the server that owns its entity group. '''
+
+    if adapter is None and not kwargs and type(self)._pipelined() is not None:
+      return type(self).put_multi([self])[0]
+    return super(BaseModel, self).put(adapter=adapter, **kwargs)
+
+  @classmethod
+  def get(cls, key=None, name=None, adapter=None, **kwargs):
+
+    ''' retrieve the entity at ``key`` (or with ID ``name``). on Redis,
+        it's read (via :py:meth:`get_multi`) from the server that owns
+        its entity group. '''
+
+    if adapter is None and not kwargs and cls._pipelined() is not None:
+      if name: key = model.Key(cls, name)
+      elif isinstance(key, basestring): key = cls.__keyclass__.from_urlsafe(key)
+      if isinstance(key, model.Key): return cls.get_multi([key])[0]
+    return super(BaseModel, cls).get(key=key, name=name, adapter=adapter, **kwargs)
+
+  def delete(self, adapter=None, **kwargs):
+
+    ''' delete this entity. on Redis, it's deleted (via
+        :py:meth:`delete_multi`) from the server that owns its entity group. '''
+
+    if adapter is None and not kwargs and type(self)._pipelined() is not None:
+      return type(self).delete_multi([self.key])[0]
+    return super(BaseModel, self).delete(adapter=adapter, **kwargs)
+
+  ## == Bulk Operations == ##
+  @classmethod
+  def _pipelined(cls):
+
+    ''' resolve the ``RedisAdapter`` backing this model, if any, so that
+        bulk operations can be pipelined rather than looped over the
+        adapter. returns ``None`` for any other adapter. '''
+
+    adapter = cls.__adapter__  # resolved to an adapter instance at class construction
+    return adapter if isinstance(adapter, RedisAdapter) else None
+
+  @classmethod
+  def _resolve(cls, keys):
+
+    ''' normalize ``keys`` (``model.Key`` instances or plain IDs) into
+        a list of ``model.Key`` instances for this model. '''
+
+    return [key if isinstance(key, model.Key) else model.Key(cls, key) for key in keys]
+
+  @staticmethod
+  def _encode(adapter, key):
+
+    ''' encode ``key`` into the ``(encoded, flattened)`` pair the
+        adapter's own ``get``, ``put`` and ``delete`` expect '''
+
+    joined, flattened = key.flatten(True)
+    return adapter.encode_key(joined, flattened) or key.urlsafe(joined), flattened
+
+  @classmethod
+  def _allocate(cls, adapter, entities):
+
+    ''' allocate IDs for any of ``entities`` that don't have one yet,
+        from the adapter's own per-kind counters, with one increment
+        per kind in a single round trip to the default server. '''
+
+    pending = [entity for entity in entities if not entity.key or not entity.key.id]
+    if not pending: return
+
+    by_kind = {}
+    for entity in pending:
+      by_kind.setdefault(type(entity), []).append(entity)
+
+    with pools.pipeline() as pipe:
+      for kind, group in by_kind.iteritems():
+        adapter.allocate_ids(kind.__keyclass__, kind.kind(), count=len(group), pipeline=pipe)
+      counters = pipe.execute()
+
+    for (kind, group), last in zip(by_kind.iteritems(), counters):
+      for offset, entity in enumerate(group):
+        entity._set_key(kind.__keyclass__(kind.kind(), int(last) - len(group) + offset + 1,
+                                          parent=entity.key.parent if entity.key else None))
+
+  @classmethod
+  def put_multi(cls, entities):
+
+    ''' persist ``entities`` through the adapter's own serialization and
+        key layout, so that they read back just as if saved with
+        ``put``. entities are written with one pipelined round trip per
+        server owning any of them (see :py:meth:`_shard`), and their
+        indexes (which queries read) with one to the default server.
+        connections come from :py:data:`pools`, bounded by the
+        ``RedisAdapter.pool`` config.
+
+        :param entities: iterable of model instances to save.
+        :returns: list of the saved entities' keys, in order. '''
+
+    entities, adapter = list(entities), cls._pipelined()
+    if adapter is None:
+      return [entity.put() for entity in entities]
+
+    cls._allocate(adapter, entities)
+    for entity in entities:
+      kind = adapter.registry[entity.kind()]
+      with entity:  # validate, as ``put`` would
+        for name in entity.to_dict(_all=True):
+          kind[name].valid(entity)
+
+    def write(pipe, position, shard):
+
+      ''' queue the write of ``entities[position]`` '''
+
+      entity = entities[position]
+      adapter.put(cls._encode(adapter, entity.key), entity._set_persisted(True),
+                  adapter.registry[entity.kind()], pipeline=pipe)
+
+    pools.execute([cls._shard(entity.key) for entity in entities], write)
+    with pools.pipeline(transaction=True) as pipe:
+      for entity in entities:
+        origin, meta, properties, graph = adapter.generate_indexes(entity.key, entity, adapter._pluck_indexed(entity))
+        # the adapter treats an empty (and so falsy) pipeline as none at all, so queue its calls here
+        for handler, args, kwargs in adapter.write_indexes((origin, meta, properties), graph, execute=False):
+          adapter.execute(handler, *args, target=pipe)
+      pipe.execute()
+    return [entity.key for entity in entities]
+
+  @classmethod
+  def get_multi(cls, keys):
+
+    ''' fetch the entities at ``keys`` with one pipelined round trip
+        per server owning any of them.
+
+        :param keys: iterable of ``model.Key`` instances or plain IDs.
+        :returns: list of entities (or ``None`` for misses), in order. '''
+
+    keys, adapter = cls._resolve(keys), cls._pipelined()
+    if adapter is None:
+      return [cls.get(key) for key in keys]
+
+    # not via the adapter's ``get_multi``, which swaps an empty (falsy) pipeline for the default server
+    blobs = pools.execute(map(cls._shard, keys), lambda pipe, position, shard: (
+      adapter.get(cls._encode(adapter, keys[position]), pipeline=pipe)))
+
+    found = []
+    for key, blob in zip(keys, blobs):
+      entity = adapter.get(cls._encode(adapter, key), _entity=blob) if blob else None
+      if entity is not None:
+        entity['key'], key.__persisted__ = key, True
+        entity = adapter.registry[key.kind](_persisted=True, **entity)
+      found.append(entity)
+    return found
+
+  @classmethod
+  def delete_multi(cls, keys):
+
+    ''' delete the entities at ``keys`` with one pipelined round trip
+        per server owning any of them, and clean their indexes on the
+        default server.
+
+        :param keys: iterable of ``model.Key`` instances or plain IDs.
+        :returns: list of booleans indicating whether each key existed. '''
+
+    keys, adapter = cls._resolve(keys), cls._pipelined()
+    if adapter is None:
+      return [bool(key.delete()) for key in keys]
+
+    with pools.pipeline(transaction=True) as pipe:
+      for key in keys:
+        adapter.clean_indexes(adapter.generate_indexes(key), pipeline=pipe)
+      pipe.execute()
+
+    return map(bool, pools.execute(map(cls._shard, keys), lambda pipe, position, shard: (
+      adapter.delete(cls._encode(adapter, keys[position]), pipeline=pipe))))
+
 Model = BaseModel
 
+# entity keys (base64 of ``:<kind>:<id>...``) are sharded, so rebalancing moves them
+pools.own('O*', BaseModel._route)
+
+
+##### !!! Base Page !!! #####
+class BasePage(Page):
+
+  ''' base page class '''
+
+  @property
+  def template_context(self):
+
+    ''' canteen's template context, plus the URL of the precomputed
+        services manifest at ``services.manifest``. asset URL helpers
+        link fingerprinted files when an asset manifest was built. '''
+
+    context = super(BasePage, self).template_context
+    context['services']['manifest'] = manifest.url
+    for kind, url in context['asset'].items():
+      context['asset'][kind] = assets.helper(kind, url)
+    return context
+
+  def _prepare(self, headers=None, content_type='text/html; charset=utf-8'):
+
+    ''' apply the mimetype and headers canteen's render would '''
+
+    if content_type: self.response.mimetype = content_type
+    self.response.headers.extend(itertools.chain(
+      iter(self.http.base_headers),
+      self.config.get('http', {}).get('headers', {}).iteritems(),
+      self.headers.iteritems(),
+      (headers or {}).iteritems()))
+
+  def stream(self, template, headers=None, content_type='text/html; charset=utf-8',
+                   context=None, _direct=False, threshold=None, **kwargs):
+
+    ''' render ``template`` as a stream of chunks, each ending at a
+        ``{% flush %}`` tag, so that content above a flush point (say,
+        ``<head>`` and its stylesheets) reaches the browser while the
+        rest of the page is still rendering. the response carries no
+        ``Content-Length``, so the server sends it chunked.
+
+        :param threshold: minimum characters rendered before a flush
+          point is honored, overriding the ``streaming`` config.
+
+        all other arguments are as in canteen's ``Handler.render``. '''
+
+    from canteen.util import config
+
+    self._prepare(headers, content_type)
+    self.response.headers['X-Accel-Buffering'] = 'no'  # ask proxies not to buffer
+
+    merged = dict(itertools.chain(*(i.iteritems() for i in (
+      self.template.base_context,
+      self.template_context,
+      context or {},
+      kwargs))), streaming=True)
+
+    events = self.template.environment(self, getattr(self.runtime, 'config', None) or config.Config()).get_template(
+      template).generate(**merged)
+
+    if threshold is None: threshold = self.config.get('streaming', {}).get('threshold', 0)
+    self.response.response, self.response.direct_passthrough = flushed(events, threshold), True
+    return self.respond(direct=_direct)
+
+  def render(self, template, headers=None, content_type='text/html; charset=utf-8',
+                   context=None, _direct=False, cache=None, ttl=None, tags=(), stream=None, **kwargs):
+
+    ''' render ``template``, optionally through the render cache or as
+        a stream (see :py:meth:`stream`).
+
+        :param cache: names of the context values (from ``context`` or
+          ``kwargs``) that the rendered output depends on. the template
+          name and those values (which must be JSON-serializable) make
+          up the cache key. if ``None``, the render is never cached.
+        :param ttl: seconds the cached render stays fresh, overriding the
+          cache's default.
+        :param tags: tags to attach to the cached render, for use with
+          :py:meth:`finnalytics.logic.cache.RenderCache.invalidate`.
+        :param stream: whether to stream the render. defaults to the
+          ``streaming`` config. cached renders are never streamed, unless
+          the render cache is disabled.
+
+        all other arguments are as in canteen's ``Handler.render``. '''
+
+    if cache is None or not renders.enable:
+      if stream if stream is not None else self.config.get('streaming', {}).get('enable', False):
+        return self.stream(template, headers, content_type, context, _direct, **kwargs)
+      return super(BasePage, self).render(template, headers, content_type, context, _direct, **kwargs)
+
+    merged = dict(context or {}, **kwargs)
+    key = renders.key('page:%s' % template, [(name, merged.get(name)) for name in cache])
+    chunks = renders.get(key)
+
+    if chunks is None:
+      super(BasePage, self).render(template, headers, content_type, context, True, **kwargs)
+      return self.respond(renders.set(key, tuple(self.response.response), ttl=ttl, tags=tags), direct=_direct)
+
+    # cache hit: apply the same mimetype and headers a full render would
+    self._prepare(headers, content_type)
+    self.response.direct_passthrough = True
+    return self.respond(chunks, direct=_direct)
+
+Page = BasePage
+
 
 ##### !!! Base Service !!! #####
 
@@ -74,6 +498,62 @@ class Service(rpc.Service):
 
   __credentials__ = None  # credentials pulled via `initialize`
 
+  class __metaclass__(type(rpc.Service)):
+
+    ''' instruments every remote method defined on a service '''
+
+    def __new__(mcs, name, bases, members):
+
+      ''' wrap each remote method in ``members`` with metrics '''
+
+      if metrics.enable and proto.StubBase not in bases:
+        for attr, value in members.items():
+          if callable(value) and getattr(value, 'remote', None) is not None:
+            members[attr] = mcs.instrument('%s.%s' % (name, attr), value)
+      return type(rpc.Service).__new__(mcs, name, bases, members)
+
+    @staticmethod
+    def instrument(name, method):
+
+      ''' wrap the remote ``method`` to record its calls, errors, latency
+          and payload sizes under ``name`` in :py:data:`metrics` '''
+
+      stats = metrics.method(name)
+
+      @functools.wraps(method)
+      def instrumented(self, request):
+
+        ''' dispatch the wrapped remote method, measuring it '''
+
+        shard, start = stats.shard(), time.time()
+        shard.calls += 1
+
+        try:
+          response = method(self, request)
+        except Exception as exc:
+          kind = self.error(exc)
+          shard.errors[kind] = shard.errors.get(kind, 0) + 1
+          raise
+        finally:
+          shard.latency.record((time.time() - start) * 1e6)
+
+        headers = getattr(self.state, 'headers', None)
+        if headers and headers.get('content-length'): shard.requests.record(int(headers['content-length']))
+        if response is not None and metrics.sizes and not (shard.calls - 1) % metrics.sizes:
+          shard.responses.record(metrics.size(response))
+        return response
+
+      return instrumented
+
+  def error(self, exc):
+
+    ''' name the kind of error ``exc`` is, for metrics: its key in
+        ``exceptions`` (i.e. ``unauthorized``), or its class name '''
+
+    for name, kind in self.exceptions.items():
+      if type(exc) is kind: return name
+    return type(exc).__name__
+
   exceptions = rpc.Exceptions({
     # Base Exceptions
     'unauthorized': Unauthorized,
@@ -28,6 +28,8 @@ app, root = (
   os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
 )
 
+data = os.environ.get('FINNA_DATA', os.path.join(root, 'data'))  # on-disk event state (WAL, segments)
+
 config = cfg.Config(app={
 
   'name': 'finnalytics',
@@ -39,7 +41,17 @@ config = cfg.Config(app={
   'dev': {
 
     'profiler': {
-      'enable': False
+      'enable': False,
+      'rate': 0.01,  # fraction of requests to profile
+      'header': 'X-Finna-Profile',  # ...plus any request carrying this header
+      'token': None,  # if set, the value the header must carry
+      'interval': 0.005,  # seconds between stack samples
+      'flush': 30,  # seconds between collapsed-stack dumps
+      'path': '.develop/profiles'  # where `<route>.folded` files are written
+    },
+
+    'startup': {
+      'budget': 2.0  # seconds allowed to import the package and spawn the app (see `finna startup`)
     }
 
   },
@@ -52,6 +64,8 @@ config = cfg.Config(app={
 
     'assets': os.path.join(app, 'assets'),
     'favicon': os.path.join(app, 'assets', 'img', 'favicon.ico'),
+    'segments': os.path.join(data, 'segments'),
+    'wal': os.path.join(data, 'wal'),
 
     'templates': {
       'source': os.path.join(app, 'templates', 'source'),
@@ -67,7 +81,83 @@ config = cfg.Config(app={
   # Gevent Config
   'gevent': {
 
-    'engine': 'wsgi'  # `pywsgi`, `wsgi`, or `stream`
+    'engine': 'wsgi',  # `pywsgi`, `wsgi`, or `stream`
+
+    # prefork mode (`finna run --workers N`)
+    'workers': {
+      'reuseport': False,  # give each worker its own `SO_REUSEPORT` socket, rather than sharing one
+      'max_requests': 10000,  # recycle a worker after serving this many requests (`None` never does)
+      'jitter': 0.1,  # ...plus up to this fraction more, so workers don't all recycle at once
+      'max_memory': 512 << 20,  # recycle a worker once its resident memory passes this many bytes
+      'check': 5,  # seconds between memory checks
+      'grace': 30  # seconds a retiring worker may spend finishing in-flight requests
+    }
+
+  },
+
+  # Event ingestion
+  'ingest': {
+
+    'flush_size': 10000,  # rows buffered per event type before flushing
+    'flush_interval': 1.0  # max seconds a buffer may age before flushing
+
+  },
+
+  # Write-ahead log for buffered events
+  'wal': {
+
+    'enable': True,
+    'window': 0.001,  # seconds a commit waits for more writers to join it (one sync per batch)
+    'segment_size': 32 << 20  # bytes per log file
+
+  },
+
+  # Moving persisted batches into on-disk segments (`finna archive`)
+  'archive': {
+
+    'age': 7 * 86400  # seconds a batch stays in the datastore after its last event
+
+  },
+
+  # Time-bucketed rollups
+  'rollups': {
+
+    'enable': not __debug__,  # counters live in Redis, which development doesn't run
+    'dimensions': 2,  # max dimensions combined into one counter
+
+    'retention': {  # seconds to keep each period's buckets (`None` is forever)
+      'minute': 2 * 86400,
+      'hour': 90 * 86400,
+      'day': None
+    }
+
+  },
+
+  # Rendered page/fragment cache
+  'renders': {
+
+    'enable': not __debug__,  # templates change under us in development
+    'budget': 16 << 20,  # max bytes of cached renders per process
+    'ttl': 300  # default seconds a cached render stays fresh
+
+  },
+
+  # Per-RPC-method metrics
+  'metrics': {
+
+    'enable': True,  # instrument remote methods on `finnalytics.base.Service`
+    'sizes': 8,  # measure the encoded size of one in every N responses
+    'token': None,  # if set, allows `/_internal/metrics` and `/export` with `X-Finna-Metrics: <token>`
+    'trust_local': False  # let requests from localhost skip the token (unsafe behind a local proxy)
+
+  },
+
+  # Streamed page renders
+  'streaming': {
+
+    # stream `Page.render` output, flushing at `{% flush %}` tags (needs a chunking server, i.e. `pywsgi`)
+    'enable': False,
+    'threshold': 0  # min characters rendered before a flush point is honored
 
   },
 
@@ -77,7 +167,7 @@ config = cfg.Config(app={
     # HTTP session settings
     'sessions': {
 
-      'engine': 'cookies',
+      'engine': 'cookies',  # `cookies`, or `redis` for server-side sessions
 
       'cookies': {
         'key': 'finnalytics',
@@ -86,7 +176,18 @@ config = cfg.Config(app={
         'secure': False,  # only secure in production
         'http_only': True,
         'max_age': 3600,
-        'mode': 'json'
+        'mode': 'json',  # `json`, or `binary` for smaller cookies (see `finnalytics.logic.sessions`)
+        'cache': 4096  # max verified cookies to remember per process
+      },
+
+      'redis': {
+        'key': 'finnalytics',
+        'prefix': 'session',  # Redis key prefix for session bodies
+        'domain': None,
+        'path': '/',
+        'secure': False,  # only secure in production
+        'http_only': True,
+        'max_age': 3600  # also the TTL of session bodies in Redis
       }
 
     },
@@ -147,6 +248,8 @@ config = cfg.Config(app={
       'extensions': [
         'jinja2.ext.autoescape',
         'jinja2.ext.with_',
+        'finnalytics.templates.extensions.FragmentCache',
+        'finnalytics.templates.extensions.FlushPoints'
       ],
 
     }
@@ -156,9 +259,18 @@ config = cfg.Config(app={
   'RedisAdapter': {
     'debug': True,
 
+    # Connection pool bounds (per server, overridable via a server's `pool` key)
+    'pool': {
+      'max_connections': 32,
+      'timeout': 5  # seconds to wait for a free connection
+    },
+
+    # Consistent-hash ring points per server (scaled by a server's `weight` key)
+    'replicas': 160,
+
     'servers': {
 
-      'default': 'local',
+      'default': 'local',  # also holds unsharded keys, like ID counters
 
       # Redis Instances
       'local': {'host': '127.0.0.1', 'port': 6379}
@@ -177,6 +289,14 @@ config = cfg.Config(app={
     'cdn_prefix': ['//'],
     'serving_mode': 'cdn' if not __debug__ else 'local',
 
+    # in-process asset server (used when `serving_mode` is `local`)
+    'server': {
+      'budget': 8 << 20,  # bytes of small, hot files kept in memory
+      'cacheable': 256 << 10,  # larger files are sent from disk (via `wsgi.file_wrapper`, if present)
+      'chunk': 64 << 10,  # block size when streaming files from disk
+      'max_age': 31536000  # cache lifetime (seconds) for fingerprinted files
+    }
+
   },
 
   # Asset registry
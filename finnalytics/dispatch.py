@@ -19,5 +19,99 @@
 
 '''
 
-# WSGI spawn
-import canteen, finnalytics; application = canteen.spawn(finnalytics, dev=__debug__, config=finnalytics.config.config)
+# stdlib
+import importlib
+import threading
+
+
+## Globals
+_application, _lock = None, threading.Lock()
+
+# gevent server for each `gevent.engine` option, as `(module, class)`. `stream` is pywsgi with
+# streamed page renders left on, the others render pages fully buffered.
+ENGINES = {
+  'pywsgi': ('gevent.pywsgi', 'WSGIServer'),
+  'wsgi': ('gevent.wsgi', 'WSGIServer'),
+  'stream': ('gevent.pywsgi', 'WSGIServer')
+}
+
+# modules to use in place of ones newer gevents dropped (`gevent.wsgi`, an alias of pywsgi, is gone as of 1.3)
+FALLBACKS = {
+  'gevent.wsgi': 'gevent.pywsgi'
+}
+
+
+def create(config=None):
+
+  ''' spawn a new WSGI application: import everything it serves (so
+      pages and services register their routes), preload templates,
+      and mount the profiler and asset server around it.
+
+      :param config: app config to spawn with (defaults to
+        ``finnalytics.config.config``).
+
+      :returns: the WSGI application. '''
+
+  import canteen, finnalytics
+  config = config or finnalytics.config.config
+
+  # register pages, services and models
+  for name in ('models', 'pages', 'services'): importlib.import_module('finnalytics.%s' % name)
+
+  # replay events logged, but never flushed, by processes that have since exited
+  from finnalytics.services.write import ingestor; ingestor.recover()
+
+  # preload compiled templates (a single bundle read, if built with `--bundle`)
+  if config.config.get('TemplateAPI', {}).get('force_compiled'):
+    importlib.import_module(config.app['paths']['templates']['compiled'])
+
+  # WSGI spawn
+  application = canteen.spawn(finnalytics, dev=__debug__, config=config)
+
+  # sampling profiler (returns `application` as-is unless `dev.profiler.enable` is set)
+  from finnalytics.logic.profiler import profiler; application = profiler.wrap(application)
+
+  # in-process static assets (returns `application` as-is unless assets' `serving_mode` is `local`)
+  from finnalytics.logic.assets import server; application = server.wrap(application)
+
+  return application
+
+
+def load():
+
+  ''' the application for this process, spawned on first call. WSGI
+      servers that fork should call this before forking. '''
+
+  global _application
+  with _lock:
+    if _application is None: _application = create()
+  return _application
+
+
+def application(environ, start_response):
+
+  ''' WSGI entrypoint, dispatching to :py:func:`load`'s application '''
+
+  return (_application or load())(environ, start_response)
+
+
+def server(engine):
+
+  ''' resolve the gevent server class for ``engine`` (see
+      :py:data:`ENGINES`), falling back per :py:data:`FALLBACKS` if its
+      module is missing '''
+
+  module, name = ENGINES[engine]
+  try:
+    return getattr(importlib.import_module(module), name)
+  except ImportError:
+    if module not in FALLBACKS: raise
+    return getattr(importlib.import_module(FALLBACKS[module]), name)
+
+
+__all__ = (
+  'create',
+  'load',
+  'application',
+  'server'
+)
@@ -20,8 +20,23 @@
 '''
 
 
-# submodules
+# finnalytics
+from .. import lazy
 
 
 __all__ = (
+  'assets',
+  'cache',
+  'query',
+  'ingest',
+  'manifest',
+  'metrics',
+  'profiler',
+  'rollups',
+  'sessions',
+  'sketches'
 )
+
+
+# submodules are imported on first access
+lazy(__name__)
@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+
+'''
+
+  logic: assets
+  ~~~~~~~~~~~~~
+
+  :author: Sam Gammon <sam@momentum.io>
+  :author: Ian Weisberger <ian@momentum.io>
+  :author: David Rekow <david@momentum.io>
+  :copyright: (c) momentum labs, 2014
+  :license: The inspection, use, distribution, modification or implementation
+            of this source code is governed by a private license - all rights
+            are reserved by the Authors (collectively, "momentum labs") and held
+            under relevant California and US Federal Copyright laws. For full
+            details, see ``LICENSE.md`` at the root of this project. Continued
+            inspection of this source code demands agreement with the included
+            license and explicitly means acceptance to these terms.
+
+'''
+
+# stdlib
+import os
+import json
+import mimetypes
+import threading
+
+# finnalytics
+from ..config import config
+from .cache import RenderCache
+
+
+## Globals
+MANIFEST = 'manifest.json'  # written to the root of the asset path by `finna build --gzip`
+DIRECTORIES = {'style': 'style', 'script': 'js', 'image': 'img', 'font': 'font'}  # asset type => directory
+PREFIXES = {  # asset type => URL prefix (canteen's defaults)
+  'style': 'assets/style',
+  'script': 'assets/script',
+  'image': 'assets/img',
+  'font': 'assets/font',
+  'video': 'assets/video'
+}
+
+
+def fingerprinted(name, digest):
+
+  ''' the fingerprinted form of the asset path ``name``, for content
+      hash ``digest``: ``js/app.js`` becomes ``js/app.<digest>.js`` '''
+
+  base, extension = os.path.splitext(name)
+  return '%s.%s%s' % (base, digest, extension)
+
+
+##### !!! Asset Manifest !!! #####
+class AssetManifest(object):
+
+  ''' the asset manifest written by ``finna build --gzip``, mapping
+      each asset (by path relative to the asset root) to its content
+      hash, its fingerprinted copy and the size of its ``.gz`` variant,
+      if it has one. without a manifest (i.e. in development), assets
+      resolve to themselves. '''
+
+  def __init__(self, root):
+
+    ''' initialize a manifest for the assets under ``root``. it is
+        read on first use. '''
+
+    self.root, self.lock, self.__entries = root, threading.Lock(), None
+
+  @classmethod
+  def from_config(cls, config):
+
+    ''' build a manifest from the app's ``paths.assets`` config '''
+
+    return cls(config.app.get('paths', {}).get('assets', 'assets'))
+
+  @property
+  def entries(self):
+
+    ''' manifest entries by asset path, loaded on first access '''
+
+    if self.__entries is None: self.load()
+    return self.__entries
+
+  def load(self):
+
+    ''' (re)read the manifest from disk '''
+
+    target = os.path.join(self.root, MANIFEST)
+    entries = {}
+    if os.path.exists(target):
+      with open(target) as handle: entries = json.load(handle).get('assets', {})
+
+    with self.lock:
+      self.__entries = entries
+    return entries
+
+  def entry(self, kind, name):
+
+    ''' the manifest entry for ``name``, an asset of type ``kind``
+        (``style``, ``script``...), or ``None`` '''
+
+    return self.entries.get('%s/%s' % (DIRECTORIES.get(kind, kind), name))
+
+  def resolve(self, kind, name):
+
+    ''' the fingerprinted name of ``name``, an asset of type ``kind``,
+        or ``name`` itself if it isn't in the manifest '''
+
+    entry = self.entry(kind, name)
+    return os.path.basename(entry['path']) if entry else name
+
+  def helper(self, kind, url):
+
+    ''' wrap canteen's URL builder ``url`` for assets of type ``kind``
+        (i.e. ``asset.script`` in templates) to link fingerprinted
+        names. packaged (multi-fragment) assets pass through as-is. '''
+
+    def resolved(*fragments, **arguments):
+
+      ''' build a URL for the fingerprinted asset '''
+
+      if len(fragments) == 1:
+        path, query = (fragments[0].split('?', 1) + [None])[:2]
+        fragments = (self.resolve(kind, path) + ('?' + query if query else ''),)
+      return url(*fragments, **arguments)
+
+    return resolved
+
+
+##### !!! Asset Server !!! #####
+class Asset(object):
+
+  ''' a servable file, as stat'ed when the asset table was built '''
+
+  __slots__ = ('name', 'path', 'type', 'size', 'mtime', 'etag', 'encoded', 'immutable')
+
+  def __init__(self, name, path, etag=None, encoded=None, immutable=False):
+
+    ''' stat the asset at ``path`` (``name``, relative to the asset
+        root). ``etag`` defaults to one derived from its size and
+        modification time; ``encoded`` is the size of its ``.gz``
+        variant, if it has one. '''
+
+    stat = os.stat(path)
+    self.name, self.path, self.size, self.mtime = name, path, stat.st_size, stat.st_mtime
+    self.type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    self.etag = etag or '"%x-%x"' % (stat.st_size, int(stat.st_mtime * 1000))
+    self.encoded, self.immutable = encoded, immutable
+
+  def tag(self, encoded=False):
+
+    ''' the ETag of this asset, or of its ``.gz`` variant '''
+
+    return self.etag[:-1] + '-gzip"' if encoded else self.etag
+
+
+class AssetServer(object):
+
+  ''' serves static assets in-process when ``serving_mode`` is
+      ``local``, in front of the app. files are looked up in a table
+      (with ETags) built once from the asset tree and manifest, so a
+      revalidation costs no I/O at all, the ``.gz`` variant written by
+      ``finna build --gzip`` is sent to clients that accept it, small
+      files are answered from memory and large ones are handed to the
+      server's ``wsgi.file_wrapper`` (i.e. ``sendfile``) if it has one. '''
+
+  def __init__(self, manifest, enable=True, prefixes=None, budget=8 << 20, cacheable=256 << 10,
+               chunk=64 << 10, max_age=31536000, watch=False):
+
+    ''' initialize an asset server.
+
+        :param manifest: :py:class:`AssetManifest` of the tree to serve.
+        :param enable: if falsy, :py:meth:`wrap` leaves the app as-is.
+        :param prefixes: URL prefix for each asset type.
+        :param budget: bytes of file content to hold in memory.
+        :param cacheable: largest file (in bytes) held in memory.
+        :param chunk: block size for files streamed from disk.
+        :param max_age: seconds fingerprinted files may be cached for.
+        :param watch: re-stat files on each request, to pick up edits
+          (for development). '''
+
+    self.manifest, self.enable, self.watch = manifest, enable, watch
+    self.cacheable, self.chunk, self.max_age = cacheable, chunk, max_age
+    self.prefixes = tuple(sorted((
+      ('/%s/' % prefix.strip('/'), DIRECTORIES.get(kind, kind)) for kind, prefix in (prefixes or PREFIXES).iteritems()),
+      key=lambda pair: -len(pair[0])))
+    self.files, self.lock, self.__table = RenderCache(budget=budget), threading.Lock(), None
+
+  @classmethod
+  def from_config(cls, config):
+
+    ''' build an asset server from the app's asset config '''
+
+    settings = config.assets.get('config', {})
+    return cls(assets, **dict(settings.get('server', {}), **{
+      'enable': settings.get('serving_mode') == 'local',
+      'prefixes': settings.get('asset_prefix'),
+      'watch': config.app.get('debug', False)}))
+
+  @property
+  def table(self):
+
+    ''' served assets by relative path, built on first access '''
+
+    return self.__table if self.__table is not None else self.index()
+
+  def index(self):
+
+    ''' (re)build the asset table from the asset tree and manifest '''
+
+    root, table = self.manifest.root, {}
+    self.manifest.load()
+    tags = {}
+    for name, entry in self.manifest.entries.iteritems():
+      etag = '"%s"' % str(entry['hash'])
+      tags[name], tags[entry['path']] = (etag, False), (etag, True)
+
+    for directory, directories, files in os.walk(root):
+      relative = os.path.relpath(directory, root)
+      present = frozenset(files)
+      for filename in files:
+        if filename.startswith('.') or filename.endswith(('.gz', '.tmp')): continue
+        name = os.path.normpath(os.path.join(relative, filename))
+        etag, immutable = tags.get(name, (None, False))
+        encoded = os.path.getsize(os.path.join(directory, filename + '.gz')) if filename + '.gz' in present else None
+        table[name] = Asset(name, os.path.join(directory, filename), etag, encoded, immutable)
+
+    with self.lock:
+      self.__table = table
+      self.files.clear()
+    return table
+
+  def wrap(self, app):
+
+    ''' mount this server in front of the WSGI callable ``app`` '''
+
+    if not self.enable: return app
+
+    def served(environ, start_response):
+
+      ''' serve ``environ`` if it is for an asset, else dispatch it '''
+
+      asset = self.match(environ)
+      if asset is None: return app(environ, start_response)
+      return self.serve(asset, environ, start_response)
+
+    return served
+
+  def match(self, environ):
+
+    ''' resolve the asset requested by ``environ``, if any '''
+
+    if environ.get('REQUEST_METHOD', 'GET') not in ('GET', 'HEAD'): return None
+    path = environ.get('PATH_INFO', '')
+    for prefix, directory in self.prefixes:
+      if path.startswith(prefix):
+        name = os.path.normpath(os.path.join(directory, path[len(prefix):]))
+        if name.startswith('..') or os.path.isabs(name): return None
+        return self.lookup(name)
+    return None
+
+  def lookup(self, name):
+
+    ''' find the asset at ``name`` in the table, re-stat'ing it first
+        when watching for edits '''
+
+    asset = self.table.get(name)
+    if not self.watch: return asset
+
+    path = os.path.join(self.manifest.root, name)
+    if not os.path.isfile(path):
+      self.table.pop(name, None)
+      return None
+
+    if asset is None or os.path.getmtime(path) != asset.mtime or (
+        asset.encoded is not None) != os.path.exists(path + '.gz'):
+      encoded = os.path.getsize(path + '.gz') if os.path.exists(path + '.gz') else None
+      asset = self.table[name] = Asset(name, path, None, encoded)
+      self.files.invalidate(name)
+    return asset
+
+  @staticmethod
+  def accepts(header, coding='gzip'):
+
+    ''' check whether an ``Accept-Encoding`` ``header`` allows ``coding`` '''
+
+    for part in header.split(','):
+      token, _, params = part.partition(';')
+      if token.strip().lower() in (coding, '*'):
+        quality = params.strip()
+        try:
+          return not quality.startswith('q=') or float(quality[2:]) > 0
+        except ValueError:
+          return True
+    return False
+
+  def serve(self, asset, environ, start_response):
+
+    ''' respond with ``asset`` (or a ``304``, if the client's copy is
+        current) '''
+
+    encoded = asset.encoded is not None and self.accepts(environ.get('HTTP_ACCEPT_ENCODING', ''))
+    etag = asset.tag(encoded)
+
+    headers = [
+      ('ETag', etag),
+      ('Cache-Control', ('public, max-age=%s, immutable' % self.max_age) if asset.immutable else 'public, no-cache')]
+    if asset.encoded is not None: headers.append(('Vary', 'Accept-Encoding'))
+
+    matches = environ.get('HTTP_IF_NONE_MATCH')
+    if matches and (matches.strip() == '*' or etag in (tag.strip().replace('W/', '', 1) for tag in matches.split(','))):
+      start_response('304 Not Modified', headers)
+      return []
+
+    path, size = (asset.path + '.gz', asset.encoded) if encoded else (asset.path, asset.size)
+    headers.append(('Content-Type', asset.type))
+    if encoded: headers.append(('Content-Encoding', 'gzip'))
+
+    if size > self.cacheable:
+      start_response('200 OK', headers + [('Content-Length', str(size))])
+      if environ.get('REQUEST_METHOD') == 'HEAD': return []
+      handle = open(path, 'rb')
+      wrapper = environ.get('wsgi.file_wrapper')
+      return wrapper(handle, self.chunk) if wrapper else self._stream(handle)
+
+    key = asset.name + ('.gz' if encoded else '')
+    body = self.files.get(key)
+    if body is None:
+      with open(path, 'rb') as handle: body = self.files.set(key, handle.read(), tags=(asset.name,))
+
+    start_response('200 OK', headers + [('Content-Length', str(len(body)))])
+    return [] if environ.get('REQUEST_METHOD') == 'HEAD' else [body]
+
+  def _stream(self, handle):
+
+    ''' read ``handle`` in chunks, closing it when done '''
+
+    try:
+      for block in iter(lambda: handle.read(self.chunk), ''):
+        yield block
+    finally:
+      handle.close()
+
+
+## Globals
+assets = AssetManifest.from_config(config)
+server = AssetServer.from_config(config)
+
+
+__all__ = (
+  'MANIFEST',
+  'DIRECTORIES',
+  'PREFIXES',
+  'fingerprinted',
+  'AssetManifest',
+  'Asset',
+  'AssetServer',
+  'assets',
+  'server'
+)
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+'''
+
+  logic: cache
+  ~~~~~~~~~~~~
+
+  :author: Sam Gammon <sam@momentum.io>
+  :author: Ian Weisberger <ian@momentum.io>
+  :author: David Rekow <david@momentum.io>
+  :copyright: (c) momentum labs, 2014
+  :license: The inspection, use, distribution, modification or implementation
+            of this source code is governed by a private license - all rights
+            are reserved by the Authors (collectively, "momentum labs") and held
+            under relevant California and US Federal Copyright laws. For full
+            details, see ``LICENSE.md`` at the root of this project. Continued
+            inspection of this source code demands agreement with the included
+            license and explicitly means acceptance to these terms.
+
+'''
+
+# stdlib
+import time
+import json
+import hashlib
+import threading
+import collections
+
+# finnalytics
+from ..config import config
+
+
+##### !!! Render Cache !!! #####
+class RenderCache(object):
+
+  ''' in-process LRU cache for rendered pages and template fragments,
+      bounded by a byte budget rather than an entry count. entries may
+      expire after a TTL and may carry tags, so that everything rendered
+      from some piece of data can be dropped at once when it changes. '''
+
+  def __init__(self, budget=16 << 20, ttl=None, enable=True):
+
+    ''' initialize a render cache.
+
+        :param budget: approximate maximum size of cached content, in
+          bytes (characters, for unicode content).
+        :param ttl: default seconds an entry stays fresh (``None`` keeps
+          entries until they are evicted or invalidated).
+        :param enable: if falsy, every lookup misses and nothing is
+          stored. '''
+
+    self.budget, self.ttl, self.enable = budget, ttl, enable
+    self.size, self.lock = 0, threading.Lock()
+    self.entries, self.tags = collections.OrderedDict(), {}
+
+  @classmethod
+  def from_config(cls, config):
+
+    ''' build a render cache from the app's ``renders`` config '''
+
+    return cls(**config.config.get('renders', {}))
+
+  def __len__(self):
+
+    ''' number of entries currently cached '''
+
+    return len(self.entries)
+
+  @staticmethod
+  def key(name, values=()):
+
+    ''' build a stable cache key for ``name`` (a template or fragment
+        name) and the context ``values`` that its output depends on.
+        values must be JSON-serializable, since anything else (like an
+        object whose ``repr`` holds its address) can't be keyed stably.
+
+        :raises TypeError: if any of ``values`` isn't JSON-serializable -
+          key on a stable value instead, such as an entity's ID. '''
+
+    try:
+      encoded = json.dumps(values, sort_keys=True)
+    except TypeError as exc:
+      raise TypeError('Cannot key cached "%s" on a value that is not JSON-serializable: %s' % (name, exc))
+    return '%s:%s' % (name, hashlib.sha1(encoded).hexdigest())
+
+  def get(self, key):
+
+    ''' fetch the content cached at ``key``, or ``None`` on a miss
+        (including when the entry has expired). '''
+
+    if not self.enable: return None
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is None: return None
+
+      value, size, expires, tags = entry
+      if expires is not None and expires <= time.time():
+        self._drop(key)
+        return None
+
+      del self.entries[key]  # re-insert, marking it most recently used
+      self.entries[key] = entry
+      return value
+
+  def set(self, key, value, ttl=None, tags=()):
+
+    ''' cache ``value`` (a string, or a sequence of string chunks) at
+        ``key``, evicting least-recently-used entries to fit the byte
+        budget. values larger than the whole budget are not cached. '''
+
+    size = len(value) if isinstance(value, basestring) else sum(map(len, value))
+    if not self.enable or size > self.budget: return value
+
+    ttl = self.ttl if ttl is None else ttl
+    with self.lock:
+      if key in self.entries: self._drop(key)
+      while self.entries and self.size + size > self.budget:
+        self._drop(next(iter(self.entries)))
+
+      self.entries[key] = (value, size, (time.time() + ttl) if ttl else None, tuple(tags))
+      self.size += size
+      for tag in tags:
+        self.tags.setdefault(tag, set()).add(key)
+    return value
+
+  def invalidate(self, *tags):
+
+    ''' drop every entry carrying any of ``tags``. returns the number
+        of entries dropped. '''
+
+    with self.lock:
+      keys = set()
+      for tag in tags:
+        keys |= self.tags.pop(tag, set())
+      for key in keys:
+        self._drop(key)
+    return len(keys)
+
+  def clear(self):
+
+    ''' drop every cached entry '''
+
+    with self.lock:
+      self.entries.clear()
+      self.tags.clear()
+      self.size = 0
+
+  def _drop(self, key):
+
+    ''' remove the entry at ``key`` (lock must be held) '''
+
+    entry = self.entries.pop(key, None)
+    if entry is None: return
+    self.size -= entry[1]
+    for tag in entry[3]:
+      if tag in self.tags:
+        self.tags[tag].discard(key)
+        if not self.tags[tag]: del self.tags[tag]
+
+
+## Globals
+renders = RenderCache.from_config(config)
+
+
+__all__ = (
+  'RenderCache',
+  'renders'
+)
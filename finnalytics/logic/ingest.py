@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+
+'''
+
+  logic: ingest
+  ~~~~~~~~~~~~~
+
+  :author: Sam Gammon <sam@momentum.io>
+  :author: Ian Weisberger <ian@momentum.io>
+  :author: David Rekow <david@momentum.io>
+  :copyright: (c) momentum labs, 2014
+  :license: The inspection, use, distribution, modification or implementation
+            of this source code is governed by a private license - all rights
+            are reserved by the Authors (collectively, "momentum labs") and held
+            under relevant California and US Federal Copyright laws. For full
+            details, see ``LICENSE.md`` at the root of this project. Continued
+            inspection of this source code demands agreement with the included
+            license and explicitly means acceptance to these terms.
+
+'''
+
+# stdlib
+import time
+import array
+import itertools
+import threading
+
+# canteen util
+from canteen.util import debug
+
+
+## Globals
+_NULL = 0  # dictionary code reserved for "no value"
+_RESERVED = ('timestamp', 'value')  # built-in column names, which dimensions can't shadow
+logging = debug.Logger(name='ingest')
+
+
+##### !!! Columns !!! #####
+class Column(object):
+
+  ''' dictionary-encoded string column. each distinct value is
+      stored once in ``symbols`` and rows hold a compact integer
+      code pointing into it, with ``0`` reserved for "missing". '''
+
+  __slots__ = ('name', 'codes', 'symbols', 'index')
+
+  def __init__(self, name, rows=0):
+
+    ''' initialize an empty column, backfilled with ``rows``
+        missing values so it lines up with its siblings. '''
+
+    self.name, self.symbols, self.index = name, [None], {None: _NULL}
+    self.codes = array.array('I', [_NULL]) * rows
+
+  def encode(self, value):
+
+    ''' resolve (or allocate) the dictionary code for ``value`` '''
+
+    code = self.index.get(value)
+    if code is None:
+      code = self.index[value] = len(self.symbols)
+      self.symbols.append(value)
+    return code
+
+  def append(self, value):
+
+    ''' append a single value to this column '''
+
+    self.codes.append(self.encode(value))
+
+  def extend(self, values):
+
+    ''' append a run of values to this column '''
+
+    encode = self.encode
+    self.codes.extend(array.array('I', [encode(value) for value in values]))
+
+  def pad(self, rows):
+
+    ''' pad this column with missing values up to ``rows`` '''
+
+    if len(self.codes) < rows:
+      self.codes.extend(array.array('I', [_NULL]) * (rows - len(self.codes)))
+
+
+##### !!! Event Buffer !!! #####
+class EventBuffer(object):
+
+  ''' array-backed, columnar buffer of events for a single
+      event type. appending an event costs a few array appends,
+      rather than a model instantiation and a datastore write. '''
+
+  __slots__ = ('type', 'timestamps', 'values', 'columns', 'created', 'sequence', 'pending')
+
+  def __init__(self, type):
+
+    ''' initialize an empty buffer for events of ``type``. ``sequence``
+        is the earliest write-ahead log sequence it holds, if any, and
+        ``pending`` the sinks it has yet to reach once sealed. '''
+
+    self.type, self.created, self.columns, self.sequence, self.pending = type, time.time(), {}, None, None
+    self.timestamps, self.values = array.array('d'), array.array('d')
+
+  def __len__(self):
+
+    ''' number of rows currently buffered '''
+
+    return len(self.timestamps)
+
+  def column(self, name):
+
+    ''' retrieve (or create) the dimension column ``name`` '''
+
+    column = self.columns.get(name)
+    if column is None:
+      column = self.columns[name] = Column(name, rows=len(self.timestamps))
+    return column
+
+  def append(self, timestamp, value=1.0, dimensions=None):
+
+    ''' append a single event to the buffer '''
+
+    for name, dimension in (dimensions or {}).iteritems():
+      self.column(name).append(dimension)
+
+    self.timestamps.append(timestamp)
+    self.values.append(value)
+
+    rows = len(self.timestamps)
+    for column in self.columns.itervalues():
+      column.pad(rows)
+
+  @staticmethod
+  def validate(timestamps, values=None, dimensions=None):
+
+    ''' check that ``values`` and each of ``dimensions`` line up with
+        ``timestamps``, that no timestamp is negative and that no
+        dimension is named for a built-in column, raising
+        ``ValueError`` if not. such events could never be archived
+        into a segment. '''
+
+    count = len(timestamps)
+    if values is not None and len(values) != count:
+      raise ValueError('Expected %s values, got %s.' % (count, len(values)))
+    if count and min(timestamps) < 0:
+      raise ValueError('Timestamps cannot be negative.')
+
+    for name, run in (dimensions or {}).iteritems():
+      if name in _RESERVED:
+        raise ValueError('Dimension "%s" collides with a built-in column.' % name)
+      if len(run) != count:
+        raise ValueError('Expected %s values for dimension "%s", got %s.' % (count, name, len(run)))
+
+  def extend(self, timestamps, values=None, dimensions=None):
+
+    ''' append a columnar run of events to the buffer. ``values``
+        defaults to ``1.0`` per event, and ``dimensions`` maps each
+        dimension name to a sequence aligned with ``timestamps``. '''
+
+    self.validate(timestamps, values, dimensions)
+    count, offset = len(timestamps), len(self.timestamps)
+
+    for name, run in (dimensions or {}).iteritems():
+      column = self.column(name)
+      column.pad(offset)
+      column.extend(run)
+
+    self.timestamps.extend(array.array('d', timestamps))
+    self.values.extend(array.array('d', values) if values is not None else array.array('d', [1.0]) * count)
+
+    rows = len(self.timestamps)
+    for column in self.columns.itervalues():
+      column.pad(rows)
+    return count
+
+  def rows(self):
+
+    ''' generate ``(timestamp, value, dimensions)`` tuples for each
+        buffered event. meant for debugging and sinks that can't
+        consume columns directly - hot paths should use the arrays. '''
+
+    columns = self.columns.values()
+    for i, (timestamp, value) in enumerate(zip(self.timestamps, self.values)):
+      yield timestamp, value, dict((
+        (column.name, column.symbols[column.codes[i]]) for column in columns if column.codes[i] != _NULL))
+
+
+##### !!! Ingestor !!! #####
+class Ingestor(object):
+
+  ''' holds one :py:class:`EventBuffer` per event type and hands
+      sealed buffers to each registered sink once a buffer grows past
+      ``flush_size`` rows or ages past ``flush_interval`` seconds.
+
+      given a write-ahead ``log``, events are committed to it before
+      they are buffered (and before :py:meth:`write` returns), and the
+      log is checkpointed as buffers are flushed. a buffer a sink fails
+      on is logged and retried on the next flush. '''
+
+  def __init__(self, flush_size=10000, flush_interval=1.0, sinks=None, log=None):
+
+    ''' initialize this ingestor with its flush thresholds, an
+        optional initial sequence of sinks and an optional
+        :py:class:`finnalytics.storage.wal.WriteAheadLog`. '''
+
+    self.flush_size, self.flush_interval, self.log = flush_size, flush_interval, log
+    self.sinks, self.buffers, self.lock = list(sinks or []), {}, threading.Lock()
+    self.flushing, self.failed, self.floors, self.__reaper = [], [], [], None
+
+  def sink(self, target):
+
+    ''' register ``target`` as a sink. sinks are called with each
+        sealed :py:class:`EventBuffer` after it is swapped out. usable
+        as a decorator. '''
+
+    self.sinks.append(target)
+    return target
+
+  def ingest(self, type, timestamps, values=None, dimensions=None):
+
+    ''' buffer a columnar run of events of ``type``, flushing it if
+        it has crossed a threshold. returns the count accepted. '''
+
+    return self.write([(type, timestamps, values, dimensions)])
+
+  def write(self, runs):
+
+    ''' buffer each ``(type, timestamps, values, dimensions)`` run in
+        ``runs`` (committing them to the log together, first), flushing
+        any buffer that crosses a threshold. returns the count accepted. '''
+
+    for type, timestamps, values, dimensions in runs:
+      EventBuffer.validate(timestamps, values, dimensions)
+
+    sequence = None
+    if self.log is not None:
+      if not self.log.opened: self.recover()
+
+      # until these events are buffered, hold the checkpoint below any sequence they could get
+      with self.lock:
+        floor = self.log.sequence + 1
+        self.floors.append(floor)
+      try:
+        sequence = self.log.append([self._record(*run) for run in runs])
+      except:
+        with self.lock: self.floors.remove(floor)
+        raise
+
+    count, sealed = 0, []
+    with self.lock:
+      for type, timestamps, values, dimensions in runs:
+        buf = self.buffers.get(type)
+        if buf is None:
+          buf = self.buffers[type] = EventBuffer(type)
+        if sequence is not None: buf.sequence = min(buf.sequence or sequence, sequence)
+        count += buf.extend(timestamps, values, dimensions)
+        if self._due(buf): sealed.append(self._seal(type))
+      if sequence is not None: self.floors.remove(floor)
+
+    for buf in sealed: self._dispatch(buf)
+    if self.flush_interval and self.__reaper is None: self._start_reaper()
+    return count
+
+  def flush(self, type=None, force=True):
+
+    ''' flush buffered events for ``type`` (or every type if none
+        is given), first retrying any that a sink failed on. if
+        ``force`` is falsy, only buffers past a threshold are flushed.
+        returns the number of rows flushed. '''
+
+    with self.lock:
+      sealed = [buf for buf in self.failed if not type or buf.type == type]
+      self.failed = [buf for buf in self.failed if buf not in sealed]
+      sealed += [self._seal(name) for name in ([type] if type else self.buffers.keys())
+                 if name in self.buffers and (force or self._due(self.buffers[name]))]
+
+    for buf in sealed: self._dispatch(buf)
+    return sum(map(len, sealed))
+
+  @staticmethod
+  def _record(type, timestamps, values, dimensions):
+
+    ''' encode a run as a write-ahead log record, which :py:meth:`recover`
+        replays as ``(type, timestamps, values, dimensions)`` '''
+
+    values = list(values) if values is not None else None
+    return type, list(timestamps), values, dict((name, list(run)) for name, run in (dimensions or {}).iteritems())
+
+  def _due(self, buf):
+
+    ''' check whether ``buf`` has crossed a flush threshold '''
+
+    return len(buf) >= self.flush_size or (
+      self.flush_interval and (time.time() - buf.created) >= self.flush_interval)
+
+  def _seal(self, type):
+
+    ''' swap out the buffer for ``type`` (lock must be held) '''
+
+    buf = self.buffers.pop(type)
+    if buf.sequence is not None: self.flushing.append(buf)
+    return buf
+
+  def _deliver(self, buf):
+
+    ''' hand ``buf`` to each sink it has yet to reach, logging any
+        that fail. returns whether every sink has taken it. '''
+
+    failed = []
+    for target in (self.sinks if buf.pending is None else buf.pending) if len(buf) else ():
+      try:
+        target(buf)
+      except Exception:
+        logging.exception('Failed to flush %s "%s" events to a sink.' % (len(buf), buf.type))
+        failed.append(target)
+
+    buf.pending = failed
+    return not failed
+
+  def _dispatch(self, buf):
+
+    ''' hand a sealed buffer to every registered sink, then advance
+        the log's checkpoint past it. if a sink fails, the buffer stays
+        pinned in the log (holding back the checkpoint) and is retried,
+        for the sinks that failed, on the next flush. '''
+
+    if not self._deliver(buf):
+      with self.lock: self.failed.append(buf)
+      return
+
+    if buf.sequence is not None:
+      with self.lock:
+        self.flushing.remove(buf)
+        horizon = min([self.log.sequence + 1] + self.floors + [
+          pending.sequence for pending in itertools.chain(self.buffers.itervalues(), self.flushing)
+          if pending.sequence is not None])
+      self.log.checkpoint(horizon)
+
+  def recover(self):
+
+    ''' replay events from write-ahead logs left by exited processes
+        straight to the sinks, then open this process's log. returns
+        the number of log records replayed. '''
+
+    if self.log is None: return 0
+
+    def replay(records):
+
+      ''' rebuffer a dead process's records and flush them '''
+
+      buffers = {}
+      for record in records:
+        for type, timestamps, values, dimensions in record:
+          buffers.setdefault(type, EventBuffer(type)).extend(timestamps, values, dimensions)
+      for buf in buffers.itervalues():
+        if not self._deliver(buf): raise IOError('Failed to replay "%s" events - keeping the log.' % buf.type)
+
+    recovered = self.log.recover(replay)
+    self.log.open()
+    return recovered
+
+  def _start_reaper(self):
+
+    ''' spin up a daemon that flushes buffers which have aged past
+        ``flush_interval`` but never hit ``flush_size``. '''
+
+    def reap():
+
+      ''' periodically flush stale buffers '''
+
+      while True:
+        time.sleep(self.flush_interval)
+        try:
+          self.flush(force=False)
+        except Exception:
+          logging.exception('Failed to flush stale ingest buffers.')
+
+    with self.lock:
+      if self.__reaper is not None: return
+      self.__reaper = threading.Thread(target=reap, name='finnalytics-ingest-reaper')
+      self.__reaper.daemon = True
+      self.__reaper.start()
+
+
+__all__ = (
+  'Column',
+  'EventBuffer',
+  'Ingestor'
+)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+'''
+
+  logic: manifest
+  ~~~~~~~~~~~~~~~
+
+  :author: Sam Gammon <sam@momentum.io>
+  :author: Ian Weisberger <ian@momentum.io>
+  :author: David Rekow <david@momentum.io>
+  :copyright: (c) momentum labs, 2014
+  :license: The inspection, use, distribution, modification or implementation
+            of this source code is governed by a private license - all rights
+            are reserved by the Authors (collectively, "momentum labs") and held
+            under relevant California and US Federal Copyright laws. For full
+            details, see ``LICENSE.md`` at the root of this project. Continued
+            inspection of this source code demands agreement with the included
+            license and explicitly means acceptance to these terms.
+
+'''
+
+# stdlib
+import hashlib
+import threading
+
+
+##### !!! Services Manifest !!! #####
+class ServicesManifest(object):
+
+  ''' the RPC services manifest that ``apptools`` bootstraps from,
+      built from canteen's ``ServiceHandler.describe`` the first time
+      it is needed rather than on every page render. the set of
+      services only changes on deploy, so the script is served from a
+      content-fingerprinted URL that can be cached forever. '''
+
+  def __init__(self, prefix='/_rpc/manifest', callable='apptools.rpc.service.factory'):
+
+    ''' initialize an (as yet unbuilt) services manifest.
+
+        :param prefix: URL prefix the fingerprinted script is served at.
+        :param callable: frontend function to pass the manifest to. '''
+
+    self.prefix, self.callable, self.lock = prefix, callable, threading.Lock()
+    self.__script = self.__fingerprint = None
+
+  def build(self):
+
+    ''' (re)build the manifest script from the registered services '''
+
+    from canteen.rpc import ServiceHandler
+
+    script = ServiceHandler.describe(javascript=True, callable=self.callable)
+    with self.lock:
+      self.__script, self.__fingerprint = script, hashlib.sha1(script).hexdigest()[:16]
+    return script
+
+  @property
+  def script(self):
+
+    ''' the manifest script, built on first access '''
+
+    return self.__script if self.__script is not None else self.build()
+
+  @property
+  def fingerprint(self):
+
+    ''' content hash of the manifest script '''
+
+    if self.__fingerprint is None: self.build()
+    return self.__fingerprint
+
+  @property
+  def url(self):
+
+    ''' fingerprinted URL the manifest script is served at '''
+
+    return '%s.%s.js' % (self.prefix, self.fingerprint)
+
+
+## Globals
+manifest = ServicesManifest()
+
+
+__all__ = (
+  'ServicesManifest',
+  'manifest'
+)
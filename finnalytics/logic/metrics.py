@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+
+'''
+
+  logic: metrics
+  ~~~~~~~~~~~~~~
+
+  :author: Sam Gammon <sam@momentum.io>
+  :author: Ian Weisberger <ian@momentum.io>
+  :author: David Rekow <david@momentum.io>
+  :copyright: (c) momentum labs, 2014
+  :license: The inspection, use, distribution, modification or implementation
+            of this source code is governed by a private license - all rights
+            are reserved by the Authors (collectively, "momentum labs") and held
+            under relevant California and US Federal Copyright laws. For full
+            details, see ``LICENSE.md`` at the root of this project. Continued
+            inspection of this source code demands agreement with the included
+            license and explicitly means acceptance to these terms.
+
+'''
+
+# stdlib
+import array
+
+# finnalytics
+from ..config import config
+from .profiler import _original
+
+
+## Globals
+_ident = _original('thread', 'get_ident')  # shards are per OS thread, even under gevent
+
+
+##### !!! Histograms !!! #####
+class Histogram(object):
+
+  ''' HDR-style histogram of non-negative integers. values below
+      ``2 ** (bits + 1)`` get a bucket each, and every power of two
+      above that is split into ``2 ** bits`` buckets, so any recorded
+      value is known to within ``2 ** -bits`` of itself (about 3% at
+      the default) in a few KB of counts. values past ``ceiling`` are
+      clamped to it. '''
+
+  __slots__ = ('bits', 'ceiling', 'counts', 'total', 'sum', 'max')
+
+  def __init__(self, bits=5, ceiling=1 << 36):
+
+    ''' initialize an empty histogram '''
+
+    self.bits, self.total, self.sum, self.max = bits, 0, 0, 0
+    self.counts = array.array('L', [0]) * (self.index(ceiling) + 1)
+    self.ceiling = self.bound(len(self.counts) - 1)
+
+  def index(self, value):
+
+    ''' bucket index for ``value`` '''
+
+    shift = value.bit_length() - self.bits - 1
+    if shift <= 0: return value
+    return (shift << self.bits) + (value >> shift)
+
+  def bound(self, index):
+
+    ''' highest value that lands in bucket ``index`` '''
+
+    shift = (index >> self.bits) - 1
+    if shift <= 0: return index
+    return ((index - (shift << self.bits) + 1) << shift) - 1
+
+  def record(self, value):
+
+    ''' count one occurrence of ``value`` '''
+
+    value = min(int(value), self.ceiling)
+    self.counts[self.index(value)] += 1
+    self.total += 1
+    self.sum += value
+    if value > self.max: self.max = value
+
+  def merge(self, other):
+
+    ''' add the counts of ``other`` (of the same shape) to this one '''
+
+    for i, count in enumerate(other.counts):
+      if count: self.counts[i] += count
+    self.total, self.sum, self.max = self.total + other.total, self.sum + other.sum, max(self.max, other.max)
+    return self
+
+  def percentile(self, q):
+
+    ''' value at or below which ``q`` percent of recorded values fall '''
+
+    if not self.total: return 0
+    rank, seen = max(1, int(round(self.total * q / 100.0))), 0
+    for i, count in enumerate(self.counts):
+      seen += count
+      if seen >= rank: return min(self.bound(i), self.max)
+    return self.max
+
+  def summary(self, scale=1):
+
+    ''' p50, p99 and p999 (plus max and mean), divided by ``scale`` '''
+
+    return {
+      'count': self.total,
+      'p50': self.percentile(50) / float(scale),
+      'p99': self.percentile(99) / float(scale),
+      'p999': self.percentile(99.9) / float(scale),
+      'max': self.max / float(scale),
+      'mean': (self.sum / float(self.total or 1)) / scale}
+
+
+##### !!! Method Metrics !!! #####
+class Shard(object):
+
+  ''' one thread's share of a method's metrics. only ever written by
+      its own thread, so recording a call takes no lock. '''
+
+  __slots__ = ('calls', 'errors', 'latency', 'requests', 'responses')
+
+  def __init__(self):
+
+    ''' initialize an empty shard '''
+
+    self.calls, self.errors = 0, {}
+    self.latency, self.requests, self.responses = Histogram(), Histogram(), Histogram()
+
+
+class MethodMetrics(object):
+
+  ''' call counts, errors by type, latency (in microseconds) and
+      request/response payload sizes (in bytes) for one remote method,
+      sharded per thread and merged on read. '''
+
+  __slots__ = ('name', 'shards')
+
+  def __init__(self, name):
+
+    ''' initialize empty metrics for the method ``name`` '''
+
+    self.name, self.shards = name, {}
+
+  def shard(self):
+
+    ''' the calling thread's shard '''
+
+    ident = _ident()
+    shard = self.shards.get(ident)
+    if shard is None: shard = self.shards.setdefault(ident, Shard())
+    return shard
+
+  def merged(self):
+
+    ''' merge every thread's shard into one '''
+
+    merged = Shard()
+    for shard in self.shards.values():
+      merged.calls += shard.calls
+      for kind, count in shard.errors.items():
+        merged.errors[kind] = merged.errors.get(kind, 0) + count
+      for name in ('latency', 'requests', 'responses'):
+        getattr(merged, name).merge(getattr(shard, name))
+    return merged
+
+  def snapshot(self):
+
+    ''' summarize this method's metrics (latencies in milliseconds) '''
+
+    merged = self.merged()
+    return {
+      'calls': merged.calls,
+      'errors': merged.errors,
+      'latency': merged.latency.summary(scale=1000),
+      'request_bytes': merged.requests.summary(),
+      'response_bytes': merged.responses.summary()}
+
+
+##### !!! Registry !!! #####
+class Registry(object):
+
+  ''' per-process registry of :py:class:`MethodMetrics` by name '''
+
+  def __init__(self, enable=True, sizes=8, token=None, trust_local=False):
+
+    ''' initialize an empty registry.
+
+        :param enable: if falsy, services are not instrumented.
+        :param sizes: measure the encoded size of one in every ``sizes``
+          responses per thread (requests are measured from their
+          ``Content-Length`` and are always recorded).
+        :param token: if set, lets the metrics endpoint be fetched with
+          this value in ``X-Finna-Metrics``.
+        :param trust_local: if truthy, requests from this host may fetch the
+          metrics endpoint without the token. Leave it off behind a local
+          reverse proxy, which makes every request look local. '''
+
+    self.enable, self.sizes, self.token, self.trust_local, self.methods = (
+      enable, sizes, token, trust_local, {})
+
+  @classmethod
+  def from_config(cls, config):
+
+    ''' build a registry from the app's ``metrics`` config '''
+
+    return cls(**config.config.get('metrics', {}))
+
+  def method(self, name):
+
+    ''' retrieve (or create) the metrics for the method ``name`` '''
+
+    found = self.methods.get(name)
+    if found is None: found = self.methods.setdefault(name, MethodMetrics(name))
+    return found
+
+  def snapshot(self):
+
+    ''' summarize every method that has been called '''
+
+    return dict((name, found.snapshot()) for name, found in self.methods.items())
+
+  def reset(self):
+
+    ''' drop everything recorded so far '''
+
+    for found in self.methods.values(): found.shards.clear()
+
+  @staticmethod
+  def size(message):
+
+    ''' encoded (JSON) size of the RPC message ``message``, in bytes '''
+
+    from protorpc import protojson
+    return len(protojson.encode_message(message))
+
+
+## Globals
+metrics = Registry.from_config(config)
+
+
+__all__ = (
+  'Histogram',
+  'Shard',
+  'MethodMetrics',
+  'Registry',
+  'metrics'
+)
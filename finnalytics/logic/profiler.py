@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+
+'''
+
+  logic: profiler
+  ~~~~~~~~~~~~~~~
+
+  :author: Sam Gammon <sam@momentum.io>
+  :author: Ian Weisberger <ian@momentum.io>
+  :author: David Rekow <david@momentum.io>
+  :copyright: (c) momentum labs, 2014
+  :license: The inspection, use, distribution, modification or implementation
+            of this source code is governed by a private license - all rights
+            are reserved by the Authors (collectively, "momentum labs") and held
+            under relevant California and US Federal Copyright laws. For full
+            details, see ``LICENSE.md`` at the root of this project. Continued
+            inspection of this source code demands agreement with the included
+            license and explicitly means acceptance to these terms.
+
+'''
+
+# stdlib
+import os
+import re
+import sys
+import time
+import atexit
+import random
+import threading
+import collections
+
+# canteen util
+from canteen.util import debug
+
+# finnalytics
+from ..config import config
+
+
+## Globals
+_LABEL = re.compile(r'[^\w.-]+')  # characters not allowed in dump filenames
+logging = debug.Logger(name='profiler')
+
+
+def _original(module, name):
+
+  ''' resolve ``module.name`` as it was before any gevent patching, so
+      the sampler runs on (and sleeps in) a real OS thread '''
+
+  try:
+    from gevent import monkey
+  except ImportError:
+    return getattr(__import__(module), name)
+  return monkey.get_original(module, name)
+
+
+##### !!! Sampling Profiler !!! #####
+class Profiler(object):
+
+  ''' statistical profiler, mounted as WSGI middleware. a fraction of
+      requests (plus any flagged by header) are marked while they run,
+      and a background thread samples the stack of each marked thread
+      every ``interval`` seconds, counting collapsed stacks per route
+      (``rpc.<service>.<method>`` for RPC calls). counts are dumped
+      periodically as ``<label>.folded`` files, ready for
+      ``flamegraph.pl``. unsampled requests pay for one random draw and
+      a header lookup; with the profiler disabled, nothing is mounted.
+
+      samples are attributed by OS thread, so under gevent they go to
+      whichever marked request last ran on the hub's thread. '''
+
+  def __init__(self, enable=False, rate=0.01, header='X-Finna-Profile', token=None,
+                     interval=0.005, flush=30, path='.develop/profiles'):
+
+    ''' initialize this profiler.
+
+        :param enable: if falsy, :py:meth:`wrap` returns apps untouched.
+        :param rate: fraction of requests to profile, between 0 and 1.
+        :param header: request header that flags a request for profiling.
+        :param token: if set, the value ``header`` must carry.
+        :param interval: seconds between stack samples.
+        :param flush: seconds between dumps of collapsed stacks.
+        :param path: directory collapsed-stack files are written to. '''
+
+    self.enable, self.rate, self.token, self.interval, self.flush, self.path = (
+      enable, rate, token, interval, flush, path)
+    self.header = 'HTTP_' + header.upper().replace('-', '_') if header else None
+    self.active, self.stacks, self.names = {}, collections.defaultdict(collections.Counter), {}
+    self.lock, self.stopped, self.__sampler = threading.Lock(), False, None
+
+  @classmethod
+  def from_config(cls, config):
+
+    ''' build a profiler from the app's ``dev.profiler`` config '''
+
+    return cls(**config.app.get('dev', {}).get('profiler', {}))
+
+  def wrap(self, app):
+
+    ''' mount this profiler around the WSGI callable ``app`` '''
+
+    if not self.enable: return app
+
+    # canteen wraps every dispatch in cProfile when this flag is set - sample instead
+    if getattr(app, '__wrapped__', True) is None: app.__wrapped__ = app.dispatch
+
+    def profiled(environ, start_response):
+
+      ''' dispatch ``environ``, profiling it if sampled '''
+
+      if not self.sampled(environ): return app(environ, start_response)
+      return self.profile(app, environ, start_response)
+
+    return profiled
+
+  def sampled(self, environ):
+
+    ''' decide whether to profile the request at ``environ`` '''
+
+    flag = environ.get(self.header) if self.header else None
+    if flag is not None and (self.token is None or flag == self.token): return True
+    return self.rate > 0 and random.random() < self.rate
+
+  def label(self, environ):
+
+    ''' name the route (or RPC method) ``environ`` dispatches to '''
+
+    from werkzeug import exceptions
+    from canteen.logic.http import HTTPSemantics
+
+    try:
+      endpoint, arguments = HTTPSemantics.route_map.bind_to_environ(environ).match()
+    except exceptions.HTTPException:
+      return 'unmatched'
+
+    if endpoint == 'rpc': return 'rpc.%(service)s.%(method)s' % arguments
+    return endpoint
+
+  def profile(self, app, environ, start_response):
+
+    ''' dispatch ``environ`` with the current thread marked for
+        sampling, until its response has been fully iterated '''
+
+    if self.__sampler is None: self.start()
+    ident = _original('thread', 'get_ident')()
+    self.active[ident] = self.label(environ)
+
+    try:
+      result = app(environ, start_response)
+      try:
+        for chunk in result: yield chunk
+      finally:
+        if hasattr(result, 'close'): result.close()
+    finally:
+      self.active.pop(ident, None)
+
+  def collapse(self, frame):
+
+    ''' collapse ``frame`` and its callers into a ``;``-separated
+        stack, outermost first '''
+
+    stack, names = [], self.names
+    while frame is not None:
+      code = frame.f_code
+      name = names.get(code)
+      if name is None: name = names[code] = '%s:%s' % (code.co_filename, code.co_name)
+      stack.append(name)
+      frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+  def sample(self):
+
+    ''' record the current stack of each marked thread '''
+
+    if not self.active: return
+    frames = sys._current_frames()
+    with self.lock:
+      for ident, label in self.active.items():
+        frame = frames.get(ident)
+        if frame is not None: self.stacks[label][self.collapse(frame)] += 1
+
+  def dump(self):
+
+    ''' write accumulated counts to ``<path>/<label>.folded``, one
+        ``stack count`` line per distinct stack '''
+
+    with self.lock:
+      snapshot = dict((label, dict(counts)) for label, counts in self.stacks.iteritems())
+
+    if not snapshot: return 0
+    if not os.path.isdir(self.path): os.makedirs(self.path)
+
+    for label, counts in snapshot.iteritems():
+      target = os.path.join(self.path, _LABEL.sub('_', label) + '.folded')
+      with open(target + '.tmp', 'w') as handle:
+        handle.writelines('%s %d\n' % item for item in sorted(counts.iteritems()))
+      os.rename(target + '.tmp', target)
+    return len(snapshot)
+
+  def start(self):
+
+    ''' spin up the sampler thread, once '''
+
+    def run():
+
+      ''' sample marked threads, dumping every ``flush`` seconds '''
+
+      sleep, deadline = _original('time', 'sleep'), time.time() + self.flush
+      while not self.stopped:
+        sleep(self.interval)
+        self.sample()
+        if time.time() >= deadline:
+          deadline = time.time() + self.flush
+          try:
+            self.dump()
+          except (IOError, OSError):
+            logging.exception('Failed to dump profiles to "%s".' % self.path)
+
+    with self.lock:
+      if self.__sampler is not None: return
+      self.__sampler = _original('thread', 'start_new_thread')(run, ())
+    atexit.register(self.stop)
+
+  def stop(self):
+
+    ''' stop sampling and write out whatever has been collected '''
+
+    self.stopped = True
+    return self.dump()
+
+
+## Globals
+profiler = Profiler.from_config(config)
+
+
+__all__ = (
+  'Profiler',
+  'profiler'
+)
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+
+'''
+
+  logic: query
+  ~~~~~~~~~~~~
+
+  :author: Sam Gammon <sam@momentum.io>
+  :author: Ian Weisberger <ian@momentum.io>
+  :author: David Rekow <david@momentum.io>
+  :copyright: (c) momentum labs, 2014
+  :license: The inspection, use, distribution, modification or implementation
+            of this source code is governed by a private license - all rights
+            are reserved by the Authors (collectively, "momentum labs") and held
+            under relevant California and US Federal Copyright laws. For full
+            details, see ``LICENSE.md`` at the root of this project. Continued
+            inspection of this source code demands agreement with the included
+            license and explicitly means acceptance to these terms.
+
+'''
+
+# stdlib
+import operator
+
+# numpy
+import numpy
+
+
+## Globals
+_comparisons = {
+  '==': operator.eq,
+  '!=': operator.ne,
+  '<': operator.lt,
+  '<=': operator.le,
+  '>': operator.gt,
+  '>=': operator.ge
+}
+
+_aggregates = ('count', 'sum', 'avg', 'min', 'max')
+_metrics = ('timestamp', 'value')  # numeric columns every table carries
+_DENSE_LIMIT = 1 << 20  # max key space aggregated densely, regardless of row count
+
+
+##### !!! Tables !!! #####
+class Table(object):
+
+  ''' a set of equal-length column arrays. ``metrics`` maps numeric
+      column names (``timestamp``, ``value``) to arrays, and
+      ``dimensions`` maps string column names to ``(symbols, codes)``
+      pairs, where ``codes`` index into ``symbols`` and ``0`` means the
+      row has no value for that dimension. '''
+
+  __slots__ = ('metrics', 'dimensions')
+
+  def __init__(self, metrics=None, dimensions=None):
+
+    ''' initialize a table from its column arrays '''
+
+    self.metrics, self.dimensions = metrics or {
+      'timestamp': numpy.empty(0, numpy.float64), 'value': numpy.empty(0, numpy.float64)}, dimensions or {}
+
+  def __len__(self):
+
+    ''' number of rows in this table '''
+
+    return len(self.metrics['timestamp']) if 'timestamp' in self.metrics else 0
+
+  @classmethod
+  def from_columns(cls, timestamps, values, dimensions, copy=False):
+
+    ''' build a table over array-like ``timestamps`` and ``values`` and
+        a mapping of ``name => (symbols, codes)``. columns are viewed
+        in place unless ``copy`` is set, i.e. for buffers still being
+        appended to. '''
+
+    view = (lambda column, dtype: numpy.array(column, dtype=dtype)) if copy else (
+            lambda column, dtype: numpy.frombuffer(column, dtype=dtype) if len(column) else numpy.empty(0, dtype))
+
+    return cls({'timestamp': view(timestamps, numpy.float64), 'value': view(values, numpy.float64)}, dict((
+      (name, (list(symbols), view(codes, numpy.uint32))) for name, (symbols, codes) in dimensions.iteritems())))
+
+  @classmethod
+  def from_buffer(cls, buf, copy=True):
+
+    ''' build a table from a :py:class:`finnalytics.logic.ingest.EventBuffer` '''
+
+    return cls.from_columns(buf.timestamps, buf.values, dict((
+      (name, (column.symbols, column.codes)) for name, column in buf.columns.iteritems())), copy=copy)
+
+  @classmethod
+  def concat(cls, tables):
+
+    ''' stack ``tables`` into one, unifying each dimension's symbol
+        table and remapping codes with a single vectorized lookup. '''
+
+    tables = [table for table in tables if len(table)]
+    if not tables: return cls()
+    if len(tables) == 1: return tables[0]
+
+    metrics = dict(((name, numpy.concatenate([table.metrics[name] for table in tables]))
+                    for name in ('timestamp', 'value')))
+
+    dimensions = {}
+    for name in set(name for table in tables for name in table.dimensions):
+      symbols, index, runs = [None], {None: 0}, []
+      for table in tables:
+        if name not in table.dimensions:
+          runs.append(numpy.zeros(len(table), numpy.uint32))
+          continue
+
+        local, codes = table.dimensions[name]
+        for symbol in local:
+          if symbol not in index:
+            index[symbol] = len(symbols)
+            symbols.append(symbol)
+        runs.append(numpy.array([index[symbol] for symbol in local], numpy.uint32)[codes])
+      dimensions[name] = (symbols, numpy.concatenate(runs))
+    return cls(metrics, dimensions)
+
+  def mask(self, column, op, value):
+
+    ''' build a boolean row mask for ``column <op> value``. dimension
+        columns support ``==``, ``!=`` and ``in``; metric columns
+        support every comparison. '''
+
+    if column in self.metrics:
+      data = self.metrics[column]
+      if op == 'in': return numpy.in1d(data, numpy.array(map(float, value)))
+      return _comparisons[op](data, float(value))
+
+    if column not in self.dimensions:
+      return numpy.zeros(len(self), numpy.bool_) if op != '!=' else numpy.ones(len(self), numpy.bool_)
+
+    symbols, codes = self.dimensions[column]
+    wanted = [symbols.index(item) for item in (value if op == 'in' else [value]) if item in symbols]
+    if op == 'in': return numpy.in1d(codes, numpy.array(wanted, numpy.uint32))
+    if op not in ('==', '!='): raise ValueError('Dimension "%s" only supports equality filters.' % column)
+    matched = codes == wanted[0] if wanted else numpy.zeros(len(self), numpy.bool_)
+    return matched if op == '==' else ~matched
+
+  def take(self, mask):
+
+    ''' select the rows where ``mask`` is set '''
+
+    return Table(dict(((name, data[mask]) for name, data in self.metrics.iteritems())), dict((
+      (name, (symbols, codes[mask])) for name, (symbols, codes) in self.dimensions.iteritems())))
+
+
+##### !!! Queries !!! #####
+class Query(object):
+
+  ''' a filter/group-by/aggregate query over a :py:class:`Table`,
+      executed entirely with vectorized array operations. '''
+
+  __slots__ = ('filters', 'group_by', 'interval', 'aggregates')
+
+  def __init__(self, filters=(), group_by=(), interval=None, aggregates=('count',)):
+
+    ''' initialize a query.
+
+        :param filters: sequence of ``(column, op, value)`` triples,
+          all of which must match.
+        :param group_by: sequence of dimension names to group by.
+        :param interval: if set, also group by ``timestamp`` floored to
+          buckets of this many seconds.
+        :param aggregates: sequence of ``count`` or ``<fn>:<column>``
+          specs, where ``fn`` is one of ``sum``, ``avg``, ``min`` or
+          ``max`` (the column defaults to ``value``). '''
+
+    for column, op, value in filters:
+      if op != 'in' and op not in _comparisons: raise ValueError('Unknown filter operator "%s".' % op)
+
+    self.filters, self.group_by, self.interval = tuple(filters), tuple(group_by), interval
+    self.aggregates = tuple(self.parse(spec) for spec in aggregates)
+
+  @staticmethod
+  def parse(spec):
+
+    ''' parse an aggregate spec into ``(fn, column)`` '''
+
+    fn, _, column = spec.partition(':')
+    if fn not in _aggregates: raise ValueError('Unknown aggregate "%s".' % fn)
+    if fn == 'count': return fn, None
+    if (column or 'value') not in _metrics: raise ValueError('Cannot aggregate unknown metric "%s".' % column)
+    return fn, column or 'value'
+
+  @property
+  def columns(self):
+
+    ''' names of the columns this query produces, in order '''
+
+    return list(self.group_by) + (['timestamp'] if self.interval else []) + [
+      fn if fn == 'count' else '%s:%s' % (fn, column) for fn, column in self.aggregates]
+
+  def execute(self, table):
+
+    ''' run this query against ``table``, returning a list of result
+        rows, each ordered like :py:attr:`columns`. '''
+
+    if self.filters:
+      mask = numpy.ones(len(table), numpy.bool_)
+      for column, op, value in self.filters:
+        mask &= table.mask(column, op, value)
+      table = table.take(mask)
+
+    # build one integer key per row across every grouping column
+    keys, labels = [], []
+    for name in self.group_by:
+      symbols, codes = table.dimensions.get(name, ([None], numpy.zeros(len(table), numpy.uint32)))
+      keys.append(codes.astype(numpy.int64))
+      labels.append(lambda code, symbols=symbols: symbols[code])
+
+    if self.interval:
+      floors = numpy.floor(table.metrics['timestamp'] / self.interval).astype(numpy.int64)
+      base = floors.min() if len(floors) else 0
+      keys.append(floors - base)
+      labels.append(lambda code, base=base: float((code + base) * self.interval))
+
+    if keys and not len(table): return []
+    shape = [int(key.max()) + 1 for key in keys]
+    composite = (numpy.ravel_multi_index(keys, shape) if len(keys) > 1 else keys[0]) if keys else (
+      numpy.zeros(len(table), numpy.int64))
+
+    # small key spaces are aggregated densely, indexed directly by key -
+    # sparse ones are compacted first, which costs a sort
+    space = int(numpy.prod(shape)) if keys else 1
+    if space > max(len(table), _DENSE_LIMIT):
+      groups, composite = numpy.unique(composite, return_inverse=True)
+      space = len(groups)
+    else:
+      groups = None
+
+    counts = numpy.bincount(composite, minlength=space)
+    if groups is None:
+      groups = numpy.flatnonzero(counts) if keys else numpy.zeros(1, numpy.int64)
+      select = groups
+    else:
+      select = numpy.arange(space)
+
+    results, empty = [], counts[select] == 0
+    for fn, column in self.aggregates:
+      if fn == 'count':
+        results.append(counts[select])
+        continue
+
+      data = table.metrics[column]
+      if fn in ('sum', 'avg'):
+        sums = numpy.bincount(composite, weights=data, minlength=space)
+        results.append((sums if fn == 'sum' else sums / numpy.maximum(counts, 1))[select])
+        continue
+
+      extremes = numpy.full(space, numpy.inf if fn == 'min' else -numpy.inf)
+      (numpy.minimum if fn == 'min' else numpy.maximum).at(extremes, composite, data)
+      results.append(extremes[select])
+
+    # groups without rows (only possible when nothing is grouped) have no avg, min or max
+    nullable = [fn in ('avg', 'min', 'max') for fn, column in self.aggregates]
+    decoded = numpy.unravel_index(groups, shape) if len(keys) > 1 else (groups,) if keys else ()
+    return [
+      [label(int(code)) for label, code in zip(labels, codes)] + [
+        None if null and empty[i] else result[i].item() for null, result in zip(nullable, results)]
+      for i, codes in enumerate(zip(*decoded) if decoded else [()])]
+
+
+__all__ = (
+  'Table',
+  'Query'
+)
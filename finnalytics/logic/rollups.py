@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+'''
+
+  logic: rollups
+  ~~~~~~~~~~~~~~
+
+  :author: Sam Gammon <sam@momentum.io>
+  :author: Ian Weisberger <ian@momentum.io>
+  :author: David Rekow <david@momentum.io>
+  :copyright: (c) momentum labs, 2014
+  :license: The inspection, use, distribution, modification or implementation
+            of this source code is governed by a private license - all rights
+            are reserved by the Authors (collectively, "momentum labs") and held
+            under relevant California and US Federal Copyright laws. For full
+            details, see ``LICENSE.md`` at the root of this project. Continued
+            inspection of this source code demands agreement with the included
+            license and explicitly means acceptance to these terms.
+
+'''
+
+# stdlib
+import urllib
+import itertools
+import collections
+
+# numpy
+import numpy
+
+# finnalytics
+from .query import Table
+from ..config import config
+from ..storage.pool import pools
+
+
+## Globals
+_PERIODS = (
+  ('minute', 60),
+  ('hour', 3600),
+  ('day', 86400)
+)
+
+
+##### !!! Rollups !!! #####
+class Rollups(object):
+
+  ''' pre-aggregates events into minute, hour and day counters per
+      metric and per combination of dimensions. each period bucket is
+      one Redis hash (``<prefix>:<metric>:<period>:<bucket>``) whose
+      fields are encoded dimension combinations, with ``''`` holding
+      the bucket's total, so a query over a month of days reads about
+      thirty small hashes instead of every raw event. '''
+
+  def __init__(self, pools, retention=None, dimensions=2, prefix='rollup', enable=True):
+
+    ''' initialize a rollup engine.
+
+        :param pools: :py:class:`finnalytics.storage.pool.Pools` to write to.
+        :param retention: mapping of period name to bucket TTL in seconds
+          (``None`` to keep buckets forever).
+        :param dimensions: maximum number of dimensions combined into
+          a single counter, to bound per-event fan-out.
+        :param prefix: prefix for rollup hash keys.
+        :param enable: if falsy, ingest doesn't record rollups. '''
+
+    self.pools, self.dimensions, self.prefix, self.enable = pools, dimensions, prefix, enable
+    if pools is not None: pools.own('%s:*' % prefix)
+    self.retention = dict(retention or {})
+    self.periods = collections.OrderedDict(_PERIODS)
+
+  @classmethod
+  def from_config(cls, config):
+
+    ''' build a rollup engine from the app's ``rollups`` config '''
+
+    return cls(pools, **config.config.get('rollups', {}))
+
+  ## == Encoding == ##
+  def key(self, metric, period, bucket):
+
+    ''' build the hash key for ``metric``'s ``period`` ``bucket`` '''
+
+    return '%s:%s:%s:%d' % (self.prefix, metric, period, bucket)
+
+  def bucket(self, period, timestamp):
+
+    ''' floor ``timestamp`` to the start of its ``period`` bucket '''
+
+    width = self.periods[period]
+    return int(timestamp // width) * width
+
+  @staticmethod
+  def field(dimensions):
+
+    ''' encode a mapping (or pairs) of dimensions into a hash field.
+        pairs are sorted by name so the encoding is canonical. '''
+
+    pairs = sorted(dimensions.iteritems() if isinstance(dimensions, dict) else dimensions)
+    return '|'.join('%s=%s' % (urllib.quote(unicode(name).encode('utf-8'), ''),
+                               urllib.quote(unicode(value).encode('utf-8'), '')) for name, value in pairs)
+
+  ## == Writes == ##
+  def aggregate(self, buf):
+
+    ''' fold a sealed :py:class:`finnalytics.logic.ingest.EventBuffer`
+        into ``{hash key: {field: total}}`` without touching Redis, so
+        each counter is incremented once per flush, not once per event.
+        rows are grouped with array operations, as in
+        :py:meth:`finnalytics.logic.query.Query.execute`, so only the
+        distinct ``(bucket, codes)`` groups are visited in Python. '''
+
+    totals = collections.defaultdict(collections.Counter)
+    if not len(buf): return totals
+
+    table = Table.from_buffer(buf, copy=False)
+    names = sorted(table.dimensions)
+    combos = [()] + [combo for size in xrange(1, self.dimensions + 1)
+                     for combo in itertools.combinations(names, size)]
+
+    for period, width in self.periods.iteritems():
+      floors = numpy.floor(table.metrics['timestamp'] / width).astype(numpy.int64)
+      base = floors.min()
+      for combo in combos:
+        columns = [table.dimensions[name] for name in combo]
+        keys = [floors - base] + [codes.astype(numpy.int64) for symbols, codes in columns]
+        values = table.metrics['value']
+
+        if combo:  # skip rows that don't carry every dimension in this combo
+          mask = numpy.logical_and.reduce([key != 0 for key in keys[1:]])
+          keys, values = [key[mask] for key in keys], values[mask]
+          if not len(values): continue
+
+        shape = [int(key.max()) + 1 for key in keys]
+        groups, inverse = numpy.unique(numpy.ravel_multi_index(keys, shape), return_inverse=True)
+        sums = numpy.bincount(inverse, weights=values)
+
+        for group, total in zip(zip(*numpy.unravel_index(groups, shape)), sums):
+          field = self.field(zip(combo, (symbols[code] for (symbols, codes), code in zip(columns, group[1:]))))
+          totals[self.key(buf.type, period, int(group[0] + base) * width)][field] += total.item()
+    return totals
+
+  def record(self, buf):
+
+    ''' increment counters for every event in ``buf``, using one
+        pipelined round trip per Redis server. usable as an ingest sink. '''
+
+    totals = self.aggregate(buf)
+    keys = totals.keys()
+
+    def increment(pipe, position, key):
+
+      ''' queue increments (and expiry) for one bucket hash '''
+
+      for field, total in totals[key].iteritems():
+        if float(total).is_integer():
+          pipe.hincrby(key, field, int(total))
+        else:
+          pipe.hincrbyfloat(key, field, total)
+
+      ttl = self.retention.get(key.split(':')[-2])
+      if ttl: pipe.expire(key, ttl)
+
+    self.pools.execute(keys, increment)
+    return len(keys)
+
+  ## == Reads == ##
+  def buckets(self, period, start, end):
+
+    ''' list the ``period`` buckets covering ``[start, end)`` '''
+
+    return range(self.bucket(period, start), int(end), self.periods[period])
+
+  def series(self, metric, start, end, period='day', **dimensions):
+
+    ''' read a time series of ``metric`` between ``start`` and ``end``
+        at ``period`` resolution, optionally narrowed to an exact set
+        of ``dimensions``. returns a list of ``(bucket, total)`` pairs. '''
+
+    buckets, field = self.buckets(period, start, end), self.field(dimensions)
+    values = self.pools.execute([self.key(metric, period, bucket) for bucket in buckets],
+                                lambda pipe, position, key: pipe.hget(key, field))
+    return [(bucket, float(value or 0)) for bucket, value in zip(buckets, values)]
+
+  def total(self, metric, start, end, period='day', **dimensions):
+
+    ''' sum ``metric`` between ``start`` and ``end`` '''
+
+    return sum(value for bucket, value in self.series(metric, start, end, period, **dimensions))
+
+  def breakdown(self, metric, dimension, start, end, period='day'):
+
+    ''' total ``metric`` between ``start`` and ``end`` by each value
+        of a single ``dimension``. returns a ``collections.Counter``. '''
+
+    prefix, totals = '%s=' % urllib.quote(unicode(dimension).encode('utf-8'), ''), collections.Counter()
+    hashes = self.pools.execute([self.key(metric, period, bucket) for bucket in self.buckets(period, start, end)],
+                                lambda pipe, position, key: pipe.hgetall(key))
+
+    for fields in hashes:
+      for field, value in (fields or {}).iteritems():
+        if field.startswith(prefix) and '|' not in field:
+          totals[urllib.unquote(field[len(prefix):]).decode('utf-8')] += float(value)
+    return totals
+
+
+## Globals
+rollups = Rollups.from_config(config)
+
+
+__all__ = (
+  'Rollups',
+  'rollups'
+)
@@ -0,0 +1,436 @@
+# -*- coding: utf-8 -*-
+
+'''
+
+  logic: sessions
+  ~~~~~~~~~~~~~~~
+
+  :author: Sam Gammon <sam@momentum.io>
+  :author: Ian Weisberger <ian@momentum.io>
+  :author: David Rekow <david@momentum.io>
+  :copyright: (c) momentum labs, 2014
+  :license: The inspection, use, distribution, modification or implementation
+            of this source code is governed by a private license - all rights
+            are reserved by the Authors (collectively, "momentum labs") and held
+            under relevant California and US Federal Copyright laws. For full
+            details, see ``LICENSE.md`` at the root of this project. Continued
+            inspection of this source code demands agreement with the included
+            license and explicitly means acceptance to these terms.
+
+'''
+
+# stdlib
+import re
+import time
+import hmac
+import base64
+import struct
+import hashlib
+import threading
+import collections
+
+# werkzeug
+from werkzeug.security import safe_str_cmp
+from werkzeug.contrib import securecookie
+
+# canteen
+from canteen.logic.http.cookies import Cookies
+from canteen.logic.session import Session, SessionEngine
+
+# finnalytics
+from ..config import config
+from ..storage.pool import pools
+
+
+## Globals
+_FLOAT = struct.Struct('<d')
+_HEX = re.compile(r'^(?:[0-9a-f]{2})+$')
+
+
+##### !!! Binary Codec !!! #####
+def _varint(value, out):
+
+  ''' append unsigned ``value`` to ``out`` as a base-128 varint '''
+
+  while value > 0x7f:
+    out.append(chr(0x80 | (value & 0x7f)))
+    value >>= 7
+  out.append(chr(value))
+
+
+def _pack(value, out):
+
+  ''' append the tagged encoding of ``value`` to ``out`` '''
+
+  if value is None or value is True or value is False:
+    out.append({None: 'N', True: 'T', False: 'F'}[value])
+  elif isinstance(value, (int, long)):
+    out.append('i')
+    _varint((value << 1) if value >= 0 else ((-value << 1) - 1), out)  # zigzag
+  elif isinstance(value, float):
+    out.append('d' + _FLOAT.pack(value))
+  elif isinstance(value, str) and len(value) >= 16 and _HEX.match(value):
+    out.append('x')  # hex digests (like session IDs) travel as raw bytes
+    _varint(len(value) // 2, out)
+    out.append(value.decode('hex'))
+  elif isinstance(value, basestring):
+    out.append('u' if isinstance(value, unicode) else 's')
+    if isinstance(value, unicode): value = value.encode('utf-8')
+    _varint(len(value), out)
+    out.append(value)
+  elif isinstance(value, dict):
+    out.append('m')
+    _varint(len(value), out)
+    for key, item in sorted(value.iteritems()):
+      _pack(key, out)
+      _pack(item, out)
+  elif isinstance(value, (list, tuple)):
+    out.append('l')
+    _varint(len(value), out)
+    for item in value:
+      _pack(item, out)
+  else:
+    raise TypeError('Cannot encode %r in a binary session.' % type(value))
+
+
+def dumps(value):
+
+  ''' encode a session value (``None``, ``bool``, numbers, strings,
+      lists and dicts of the same) into a compact tagged binary form,
+      with varint lengths. lowercase hex strings, like session IDs, are
+      packed as raw bytes at half their length. '''
+
+  out = []
+  _pack(value, out)
+  return ''.join(out)
+
+
+def loads(data):
+
+  ''' decode a value encoded by :py:func:`dumps`. raises ``ValueError``
+      if ``data`` is malformed. '''
+
+  def varint(position):
+
+    ''' read a varint at ``position``, returning it and the next position '''
+
+    value = shift = 0
+    while True:
+      byte = ord(data[position])
+      value, shift, position = value | ((byte & 0x7f) << shift), shift + 7, position + 1
+      if not byte & 0x80: return value, position
+
+  def unpack(position):
+
+    ''' decode the value at ``position``, returning it and the next position '''
+
+    tag, position = data[position], position + 1
+    if tag in 'NTF':
+      return {'N': None, 'T': True, 'F': False}[tag], position
+    if tag == 'i':
+      value, position = varint(position)
+      return (value >> 1) ^ -(value & 1), position
+    if tag == 'd':
+      return _FLOAT.unpack_from(data, position)[0], position + _FLOAT.size
+    if tag in 'sux':
+      length, position = varint(position)
+      if position + length > len(data): raise ValueError('Truncated binary session.')
+      value = data[position:position + length]
+      if tag == 'u': value = value.decode('utf-8')
+      elif tag == 'x': value = value.encode('hex')
+      return value, position + length
+    if tag in 'ml':
+      length, position = varint(position)
+      items = []
+      for _ in xrange(length * (2 if tag == 'm' else 1)):
+        item, position = unpack(position)
+        items.append(item)
+      return (dict(zip(items[::2], items[1::2])) if tag == 'm' else items), position
+    raise ValueError('Unknown binary session tag %r.' % tag)
+
+  try:
+    value, position = unpack(0)
+  except (IndexError, struct.error, UnicodeDecodeError):
+    raise ValueError('Truncated or malformed binary session.')
+  if position != len(data): raise ValueError('Trailing data in binary session.')
+  return value
+
+
+##### !!! Verified Sessions !!! #####
+class VerifiedCache(object):
+
+  ''' bounded LRU mapping of raw cookie values that have already
+      passed HMAC verification to their decoded contents. only values
+      that verify are ever stored, and lookups match the full signed
+      value, so a hit is exactly as trustworthy as a fresh check. '''
+
+  def __init__(self, capacity=4096):
+
+    ''' initialize a cache holding up to ``capacity`` cookies '''
+
+    self.capacity, self.lock, self.entries = capacity, threading.Lock(), collections.OrderedDict()
+
+  def get(self, key):
+
+    ''' fetch the decoded contents verified for ``key``, or ``None`` '''
+
+    with self.lock:
+      data = self.entries.pop(key, None)
+      if data is not None: self.entries[key] = data  # most recently used
+      return data
+
+  def set(self, key, data):
+
+    ''' remember ``data`` as the verified contents of ``key`` '''
+
+    if not self.capacity: return data
+    with self.lock:
+      self.entries.pop(key, None)
+      while len(self.entries) >= self.capacity:
+        self.entries.popitem(last=False)
+      self.entries[key] = data
+    return data
+
+
+##### !!! Binary Cookies !!! #####
+@Cookies.add_mode('binary')
+class BinaryCookie(securecookie.SecureCookie):
+
+  ''' compact signed session cookie. where the ``json`` mode signs and
+      base64-encodes every item separately, this packs the whole
+      session once with :py:func:`dumps` and signs the single blob, so
+      the cookie is smaller and cheaper to check. the blob is only
+      decoded after its HMAC verifies. repeat requests carrying a
+      cookie that has already verified skip both the HMAC and the
+      decode.
+
+      this mode is opt-in (``mode: 'binary'``). cookies still in the
+      ``json`` format are read through that mode, so switching over
+      doesn't end live sessions - they're rewritten as binary cookies
+      on their next commit. '''
+
+  hash_method = staticmethod(config.config.get('SessionAPI', {}).get('algorithm', hashlib.sha1))
+  verified = VerifiedCache(config.config.get('http', {}).get('sessions', {}).get('cookies', {}).get('cache', 4096))
+
+  def serialize(self, expires=None):
+
+    ''' sign and encode this session as ``<mac>?<blob>`` '''
+
+    if self.secret_key is None:
+      raise RuntimeError('no secret key defined')
+    if expires:
+      self['_expires'] = securecookie._date_to_unix(expires)
+
+    blob = dumps(dict(self))
+    return '?'.join(base64.urlsafe_b64encode(segment).rstrip('=') for segment in (
+      hmac.new(self.secret_key, blob, self.hash_method).digest(), blob))
+
+  @classmethod
+  def verify(cls, string, secret_key):
+
+    ''' check the signature on a serialized cookie, returning its
+        decoded contents or ``None`` if it fails to verify. '''
+
+    try:
+      mac, blob = [base64.urlsafe_b64decode(segment + '=' * (-len(segment) % 4)) for segment in string.split('?', 1)]
+    except (ValueError, TypeError):
+      return None
+
+    if not safe_str_cmp(mac, hmac.new(secret_key, blob, cls.hash_method).digest()):
+      return None
+
+    try:
+      data = loads(blob)
+    except ValueError:
+      return None
+    return data if isinstance(data, dict) else None
+
+  @classmethod
+  def unserialize(cls, string, secret_key):
+
+    ''' load a session from a serialized cookie, consulting the cache
+        of previously-verified cookies first. '''
+
+    if isinstance(string, unicode): string = string.encode('utf-8', 'replace')
+    if isinstance(secret_key, unicode): secret_key = secret_key.encode('utf-8', 'replace')
+
+    data = cls.verified.get((string, secret_key))
+    if data is None:
+      data = cls.verify(string, secret_key)
+      if data is None:  # perhaps a cookie from before the switch to binary mode
+        return cls(Cookies.get_mode('json').unserialize(string, secret_key), secret_key, False)
+      cls.verified.set((string, secret_key), data)
+
+    data = dict(data)  # sessions are mutable, so never hand out the cached copy
+    if '_expires' in data:
+      if time.time() > data.pop('_expires'): data = ()
+    return cls(data, secret_key, False)
+
+
+# registering a mode makes it the fallback for unknown mode names, which should stay `json`
+Cookies.__default__ = Cookies.get_mode('json')
+
+
+##### !!! Redis Sessions !!! #####
+class RedisSession(Session):
+
+  ''' session whose body lives in Redis under an opaque ID, and is
+      only fetched the first time its data is touched. the encoded body
+      is kept as loaded, so on commit an unchanged session (including
+      one that was read but never written) costs nothing. '''
+
+  __slots__ = ('__engine__', '__blob__', '__data__')
+
+  def __init__(self, id, engine, data=None):
+
+    ''' initialize a session for ``id`` (``None`` to allocate one on
+        first use), backed by a :py:class:`RedisSessions` ``engine``.
+        passing ``data`` marks it as new and unsaved. '''
+
+    self.__id__, self.__session__, self.__engine__ = id, None, engine
+    self.__data__, self.__blob__ = (None, None) if data is None else (data, '')
+
+  ## == Accessors == ##
+  loaded = property(lambda self: self.__data__ is not None)
+  csrf = property(lambda self: self.data.get('csrf') or self.data.setdefault('csrf', Session.generate_token()))
+
+  @property
+  def id(self):
+
+    ''' session ID, allocated on first use if there wasn't one '''
+
+    if self.__id__ is None: self._load()
+    return self.__id__
+
+  data = property(lambda self: self.__data__ if self.__data__ is not None else self._load())
+
+  @property
+  def dirty(self):
+
+    ''' whether this session differs from what is stored for it '''
+
+    if self.__data__ is None: return False  # never touched
+    if not self.__data__: return bool(self.__blob__)  # emptied
+    return dumps(self.__data__) != self.__blob__
+
+  ## == Get/Set == ##
+  def set(self, key, value, exception=Exception):
+
+    ''' set session item ``key`` to ``value`` '''
+
+    self.data[key] = value
+    return self
+
+  def __contains__(self, key):
+
+    ''' check whether session item ``key`` is set '''
+
+    return key in self.data
+
+  ## == Reset == ##
+  def reset(self, save=False, adapter=None):
+
+    ''' clear this session's data '''
+
+    self.data.clear()
+
+  def reset_csrf(self, save=False, adapter=None):
+
+    ''' replace this session's CSRF token, returning the new one '''
+
+    self.data.pop('csrf', None)
+    return self.csrf
+
+  ## == Save/Load == ##
+  def _load(self):
+
+    ''' fetch this session's data from Redis, returning it '''
+
+    blob = self.__engine__.fetch(self.__id__) if self.__id__ else None
+    try:
+      self.__data__, self.__blob__ = (loads(blob), blob) if blob else ({}, '')
+    except ValueError:
+      self.__data__, self.__blob__ = {}, ''
+
+    if not self.__blob__:
+      # absent, expired or unknown (possibly client-chosen) ID: never adopt it
+      self.__id__ = Session.generate_token(Session.config.get('salt', ''))
+    return self.__data__
+
+  def save(self, environ, adapter=None):
+
+    ''' no-op: :py:meth:`RedisSessions.commit` already wrote any
+        changes before the response went out. '''
+
+  def commit(self):
+
+    ''' mark the current data as stored, returning its encoding '''
+
+    self.__blob__ = dumps(self.__data__) if self.__data__ else ''
+    return self.__blob__
+
+
+# session bodies are sharded across every Redis server
+pools.own('%s:*' % config.config.get('http', {}).get('sessions', {}).get('redis', {}).get('prefix', 'session'))
+
+
+@SessionEngine.configure('redis')
+class RedisSessions(SessionEngine):
+
+  ''' server-side session engine. the cookie carries only an opaque
+      session ID, and the session body is stored in Redis. loading a
+      session costs nothing until its data is used, and only sessions
+      whose data changed are written back. '''
+
+  def key(self, id):
+
+    ''' build the Redis key holding session ``id`` '''
+
+    return '%s:%s' % (self.config.get('prefix', 'session'), id)
+
+  def fetch(self, id):
+
+    ''' fetch the encoded body of session ``id`` from its server '''
+
+    key = self.key(id)
+    return pools.client(pools.server_for(key)).get(key)
+
+  def load(self, request, http):
+
+    ''' attach a lazy session for the ID in the request's cookie (or
+        an unallocated one), without touching Redis. '''
+
+    return request.set_session(RedisSession(request.cookies.get(self.config.get('key', 'canteen')), self), self)
+
+  def commit(self, request, response, session):
+
+    ''' write ``session`` back to Redis if it changed, and point the
+        session cookie at it if it doesn't already. '''
+
+    if not isinstance(session, RedisSession):  # established eagerly by canteen
+      session = RedisSession(None, self, data=dict(session.data or {}))
+    if not session.dirty: return
+
+    cookie, key = self.config.get('key', 'canteen'), self.key(session.id)
+    client, blob = pools.client(pools.server_for(key)), session.commit()
+    if not blob:
+      client.delete(key)
+    else:
+      client.set(key, blob, ex=self.config.get('max_age'))
+
+    if request.cookies.get(cookie) != session.id:
+      response.set_cookie(cookie, session.id, max_age=self.config.get('max_age'),
+                          path=self.config.get('path', '/'),
+                          secure=self.config.get('secure', False),
+                          domain=self.config.get('domain', request.host.split(':')[0]),
+                          httponly=self.config.get('http_only', True))
+
+
+__all__ = (
+  'dumps',
+  'loads',
+  'VerifiedCache',
+  'BinaryCookie',
+  'RedisSession',
+  'RedisSessions'
+)
@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+
+'''
+
+  logic: sketches
+  ~~~~~~~~~~~~~~~
+
+  :author: Sam Gammon <sam@momentum.io>
+  :author: Ian Weisberger <ian@momentum.io>
+  :author: David Rekow <david@momentum.io>
+  :copyright: (c) momentum labs, 2014
+  :license: The inspection, use, distribution, modification or implementation
+            of this source code is governed by a private license - all rights
+            are reserved by the Authors (collectively, "momentum labs") and held
+            under relevant California and US Federal Copyright laws. For full
+            details, see ``LICENSE.md`` at the root of this project. Continued
+            inspection of this source code demands agreement with the included
+            license and explicitly means acceptance to these terms.
+
+'''
+
+# stdlib
+import sys
+import math
+import array
+import struct
+import hashlib
+
+
+## Globals
+_HEADER = struct.Struct('<BB')  # (kind, version)
+_VERSION = 1
+_kinds = {}
+
+
+def _hash(item):
+
+  ''' hash ``item`` to a pair of independent 64-bit integers '''
+
+  if isinstance(item, unicode): item = item.encode('utf-8')
+  return struct.unpack('<QQ', hashlib.md5(item if isinstance(item, str) else str(item)).digest())
+
+
+def _pack(values):
+
+  ''' dump an array as little-endian bytes '''
+
+  if sys.byteorder != 'little':
+    values = array.array(values.typecode, values)
+    values.byteswap()
+  return values.tostring()
+
+
+def _unpack(typecode, blob):
+
+  ''' load an array from little-endian bytes '''
+
+  values = array.array(typecode)
+  values.fromstring(blob)
+  if sys.byteorder != 'little': values.byteswap()
+  return values
+
+
+def sketch(kind):
+
+  ''' register a :py:class:`Sketch` subclass under a one-byte ``kind``
+      tag, so :py:func:`loads` can revive it from bytes. '''
+
+  def _register(klass):
+
+    ''' register ``klass`` '''
+
+    klass.kind, _kinds[kind] = kind, klass
+    return klass
+  return _register
+
+
+def loads(blob):
+
+  ''' revive any registered sketch from bytes made by ``dumps``. '''
+
+  kind, version = _HEADER.unpack_from(blob)
+  if kind not in _kinds or version != _VERSION:
+    raise ValueError('Unrecognized sketch (kind %s, version %s).' % (kind, version))
+  return _kinds[kind].decode(blob[_HEADER.size:])
+
+
+def merge(sketches):
+
+  ''' merge an iterable of compatible sketches into a new one, i.e.
+      to roll seven day sketches up into a week. '''
+
+  merged = None
+  for item in sketches:
+    if item is None: continue
+    merged = item.copy() if merged is None else merged.merge(item)
+  return merged
+
+
+##### !!! Sketch Base !!! #####
+class Sketch(object):
+
+  ''' base class for fixed-size, mergeable, serializable sketches '''
+
+  __slots__ = ()
+
+  kind = None
+
+  def add(self, item, count=1):
+
+    ''' account for ``count`` occurrences of ``item`` '''
+
+    raise NotImplementedError()
+
+  def update(self, items):
+
+    ''' account for one occurrence of each of ``items`` '''
+
+    for item in items:
+      self.add(item)
+    return self
+
+  def merge(self, other):
+
+    ''' fold ``other`` into this sketch, in place '''
+
+    raise NotImplementedError()
+
+  def encode(self):
+
+    ''' encode this sketch's state (sans header) as bytes '''
+
+    raise NotImplementedError()
+
+  @classmethod
+  def decode(cls, blob):
+
+    ''' revive a sketch from bytes made by ``encode`` '''
+
+    raise NotImplementedError()
+
+  def dumps(self):
+
+    ''' serialize this sketch to compact bytes '''
+
+    return _HEADER.pack(self.kind, _VERSION) + self.encode()
+
+  def copy(self):
+
+    ''' produce an independent copy of this sketch '''
+
+    return self.decode(self.encode())
+
+  def __ior__(self, other):
+
+    ''' syntactic sugar for ``merge`` '''
+
+    return self.merge(other)
+
+
+##### !!! HyperLogLog !!! #####
+@sketch(1)
+class HyperLogLog(Sketch):
+
+  ''' estimates distinct counts in ``2 ** precision`` bytes, with a
+      standard error of about ``1.04 / sqrt(2 ** precision)`` (~0.8%
+      at the default precision of 14). '''
+
+  __slots__ = ('precision', 'registers')
+
+  def __init__(self, precision=14, registers=None):
+
+    ''' initialize an empty (or pre-filled) HyperLogLog '''
+
+    if not 4 <= precision <= 18: raise ValueError('Precision must be between 4 and 18.')
+    self.precision = precision
+    self.registers = registers if registers is not None else bytearray(1 << precision)
+
+  def add(self, item, count=1):
+
+    ''' account for ``item`` (``count`` has no bearing on cardinality) '''
+
+    value, bits = _hash(item)[0], 64 - self.precision
+    index, rest = value >> bits, value & ((1 << bits) - 1)
+    rank = bits - rest.bit_length() + 1
+    if rank > self.registers[index]:
+      self.registers[index] = rank
+
+  def merge(self, other):
+
+    ''' fold ``other`` into this sketch by taking register maxima '''
+
+    if other.precision != self.precision: raise ValueError('Cannot merge sketches of differing precision.')
+    self.registers = bytearray(map(max, self.registers, other.registers))
+    return self
+
+  def cardinality(self):
+
+    ''' estimate the number of distinct items added '''
+
+    m = len(self.registers)
+    alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(m, 0.7213 / (1 + 1.079 / m))
+    estimate = alpha * m * m / sum(2.0 ** -register for register in self.registers)
+
+    zeros = self.registers.count(b'\x00')
+    if estimate <= 2.5 * m and zeros:
+      return int(round(m * math.log(float(m) / zeros)))  # linear counting for small cardinalities
+    return int(round(estimate))
+
+  __len__ = cardinality
+
+  def encode(self):
+
+    ''' encode precision and registers '''
+
+    return chr(self.precision) + str(self.registers)
+
+  @classmethod
+  def decode(cls, blob):
+
+    ''' revive from ``encode`` output '''
+
+    return cls(ord(blob[0]), bytearray(blob[1:]))
+
+
+##### !!! Count-Min !!! #####
+@sketch(2)
+class CountMin(Sketch):
+
+  ''' estimates per-item frequencies in ``width * depth`` counters.
+      estimates never undercount, and overcount by at most
+      ``e / width`` of the total with probability ``1 - e ** -depth``. '''
+
+  __slots__ = ('width', 'depth', 'counters')
+
+  _dimensions = struct.Struct('<II')
+
+  def __init__(self, width=2048, depth=5, counters=None):
+
+    ''' initialize an empty (or pre-filled) Count-Min sketch '''
+
+    self.width, self.depth = width, depth
+    self.counters = counters if counters is not None else array.array('d', [0.0]) * (width * depth)
+
+  def _cells(self, item):
+
+    ''' yield the counter index for ``item`` in each row '''
+
+    first, second = _hash(item)
+    for row in xrange(self.depth):
+      yield row * self.width + (first + row * second) % self.width
+
+  def add(self, item, count=1):
+
+    ''' account for ``count`` occurrences of ``item`` '''
+
+    counters = self.counters
+    for cell in self._cells(item):
+      counters[cell] += count
+
+  def estimate(self, item):
+
+    ''' estimate how many times ``item`` was added '''
+
+    counters = self.counters
+    return min(counters[cell] for cell in self._cells(item))
+
+  __getitem__ = estimate
+
+  def merge(self, other):
+
+    ''' fold ``other`` into this sketch by summing counters '''
+
+    if (other.width, other.depth) != (self.width, self.depth):
+      raise ValueError('Cannot merge sketches of differing dimensions.')
+    self.counters = array.array('d', map(sum, zip(self.counters, other.counters)))
+    return self
+
+  def encode(self):
+
+    ''' encode dimensions and counters '''
+
+    return self._dimensions.pack(self.width, self.depth) + _pack(self.counters)
+
+  @classmethod
+  def decode(cls, blob):
+
+    ''' revive from ``encode`` output '''
+
+    width, depth = cls._dimensions.unpack_from(blob)
+    return cls(width, depth, _unpack('d', blob[cls._dimensions.size:]))
+
+
+##### !!! Space-Saving !!! #####
+@sketch(3)
+class SpaceSaving(Sketch):
+
+  ''' tracks the (approximate) top-``capacity`` heavy hitters in a
+      stream using ``capacity`` counters. each tracked item carries a
+      count and the maximum amount by which that count may overestimate. '''
+
+  __slots__ = ('capacity', 'counts', 'errors')
+
+  _capacity = struct.Struct('<I')
+  _entry = struct.Struct('<ddH')
+
+  def __init__(self, capacity=100, counts=None, errors=None):
+
+    ''' initialize an empty (or pre-filled) Space-Saving summary '''
+
+    self.capacity, self.counts, self.errors = capacity, counts or {}, errors or {}
+
+  def add(self, item, count=1):
+
+    ''' account for ``count`` occurrences of ``item``, evicting the
+        least-frequent tracked item if we're at capacity. '''
+
+    if isinstance(item, str): item = item.decode('utf-8')
+    if item in self.counts:
+      self.counts[item] += count
+    elif len(self.counts) < self.capacity:
+      self.counts[item], self.errors[item] = count, 0
+    else:
+      victim = min(self.counts, key=self.counts.__getitem__)
+      floor = self.counts.pop(victim)
+      self.errors.pop(victim)
+      self.counts[item], self.errors[item] = floor + count, floor
+
+  def top(self, n=None):
+
+    ''' list up to ``n`` ``(item, count, error)`` tuples, most frequent first '''
+
+    ranked = sorted(self.counts.iteritems(), key=lambda pair: pair[1], reverse=True)[:n or self.capacity]
+    return [(item, count, self.errors[item]) for item, count in ranked]
+
+  def merge(self, other):
+
+    ''' fold ``other`` into this summary. items tracked by only one
+        side are charged the other side's minimum count as error, then
+        the merged summary is trimmed back to ``capacity``. '''
+
+    floor = lambda summary: min(summary.counts.itervalues()) if len(summary.counts) >= summary.capacity else 0
+    ours, theirs = floor(self), floor(other)
+
+    counts, errors = {}, {}
+    for item in set(self.counts) | set(other.counts):
+      counts[item] = self.counts.get(item, ours) + other.counts.get(item, theirs)
+      errors[item] = self.errors.get(item, ours) + other.errors.get(item, theirs)
+
+    keep = sorted(counts, key=counts.__getitem__, reverse=True)[:self.capacity]
+    self.counts, self.errors = dict((item, counts[item]) for item in keep), dict((item, errors[item]) for item in keep)
+    return self
+
+  def encode(self):
+
+    ''' encode capacity and each tracked ``(count, error, item)`` '''
+
+    chunks = [self._capacity.pack(self.capacity)]
+    for item, count in self.counts.iteritems():
+      encoded = unicode(item).encode('utf-8')
+      chunks.append(self._entry.pack(count, self.errors[item], len(encoded)) + encoded)
+    return ''.join(chunks)
+
+  @classmethod
+  def decode(cls, blob):
+
+    ''' revive from ``encode`` output '''
+
+    capacity, offset, counts, errors = cls._capacity.unpack_from(blob)[0], cls._capacity.size, {}, {}
+    while offset < len(blob):
+      count, error, length = cls._entry.unpack_from(blob, offset)
+      offset += cls._entry.size
+      item = blob[offset:offset + length].decode('utf-8')
+      offset += length
+      counts[item], errors[item] = count, error
+    return cls(capacity, counts, errors)
+
+
+__all__ = (
+  'Sketch',
+  'HyperLogLog',
+  'CountMin',
+  'SpaceSaving',
+  'sketch',
+  'loads',
+  'merge'
+)
@@ -18,3 +18,113 @@
             license and explicitly means acceptance to these terms.
 
 '''
+
+# stdlib
+import json
+import array
+import base64
+
+# finnalytics
+from .base import BaseModel
+from .logic import sketches
+
+
+##### !!! Event Models !!! #####
+class EventBatch(BaseModel):
+
+  ''' a flushed, columnar batch of events of one type. columns are
+      stored as packed arrays so one batch costs one datastore write,
+      regardless of how many events it holds. '''
+
+  type = basestring, {'required': True, 'indexed': True}
+  count = int, {'default': 0}
+  start = float, {'indexed': True}
+  end = float, {'indexed': True}
+  timestamps = str  # packed `array('d')`, base64
+  values = str  # packed `array('d')`, base64
+  dimensions = str  # JSON map of name => [symbols, packed `array('I')` codes]
+
+  @classmethod
+  def from_buffer(cls, buf):
+
+    ''' build an (unsaved) batch from a sealed
+        :py:class:`finnalytics.logic.ingest.EventBuffer`. '''
+
+    return cls.factory(None, **{
+      'type': buf.type,
+      'count': len(buf),
+      'start': min(buf.timestamps) if len(buf) else None,
+      'end': max(buf.timestamps) if len(buf) else None,
+      'timestamps': base64.b64encode(buf.timestamps.tostring()),
+      'values': base64.b64encode(buf.values.tostring()),
+      'dimensions': json.dumps(dict((
+        (name, [column.symbols, base64.b64encode(column.codes.tostring())])
+        for name, column in buf.columns.iteritems())))})
+
+  def columns(self):
+
+    ''' decode this batch back into ``(timestamps, values, dimensions)``,
+        where ``dimensions`` maps names to ``(symbols, codes)``. '''
+
+    def unpack(typecode, blob):
+
+      ''' unpack a base64-encoded array '''
+
+      packed = array.array(typecode)
+      packed.fromstring(base64.b64decode(blob or ''))
+      return packed
+
+    return (
+      unpack('d', self.timestamps),
+      unpack('d', self.values),
+      dict(((name, (symbols, unpack('I', codes)))
+            for name, (symbols, codes) in json.loads(self.dimensions or '{}').iteritems())))
+
+
+##### !!! Sketch Models !!! #####
+class Sketch(BaseModel):
+
+  ''' a serialized probabilistic sketch (see
+      :py:mod:`finnalytics.logic.sketches`) for one name and period
+      bucket. stored size is bounded by the sketch's dimensions, not
+      by how many items it has seen. '''
+
+  name = basestring, {'required': True, 'indexed': True}
+  period = basestring, {'required': True, 'indexed': True}
+  bucket = int, {'required': True, 'indexed': True}
+  data = str  # `sketches.Sketch.dumps` output, base64
+
+  @staticmethod
+  def ident(name, period, bucket):
+
+    ''' build the deterministic ID for a sketch bucket '''
+
+    return '%s:%s:%d' % (name, period, bucket)
+
+  @classmethod
+  def store(cls, name, period, bucket, sketch):
+
+    ''' build an (unsaved) entity holding ``sketch`` '''
+
+    return cls.factory(cls.ident(name, period, bucket), **{
+      'name': name,
+      'period': period,
+      'bucket': bucket,
+      'data': base64.b64encode(sketch.dumps())})
+
+  @classmethod
+  def fetch(cls, name, period, buckets):
+
+    ''' load the sketches for ``buckets`` in one round trip and merge
+        them, i.e. seven day buckets into a week. returns ``None`` if
+        none of the buckets exist. '''
+
+    return sketches.merge(entity.sketch for entity in cls.get_multi([
+      cls.ident(name, period, bucket) for bucket in buckets]) if entity is not None)
+
+  @property
+  def sketch(self):
+
+    ''' revive the stored sketch '''
+
+    return sketches.loads(base64.b64decode(self.data))
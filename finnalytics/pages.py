@@ -20,11 +20,32 @@
 '''
 
 # stdlib
-import pdb
+import hmac
+import json
+import importlib
 
 # canteen
-from canteen import url, Page
-if __debug__: from canteen.model.adapter import inmemory
+from canteen import url
+
+# finnalytics
+from .base import Page
+from .logic.metrics import metrics
+from .logic.manifest import manifest
+from .services.read import export, formats
+
+
+def internal(request):
+
+  ''' check whether ``request`` may reach internal endpoints (metrics
+      and raw event exports): it must carry the metrics token in
+      ``X-Finna-Metrics``, or - only if ``metrics.trust_local`` is on, as
+      behind a proxy every request looks local - come from this host. '''
+
+  if metrics.trust_local and request.remote_addr in ('127.0.0.1', '::1'): return True
+  token, expected = request.headers.get('X-Finna-Metrics'), metrics.token
+  if not (token and expected): return False
+  encode = lambda value: value.encode('utf-8') if isinstance(value, unicode) else str(value)
+  return hmac.compare_digest(encode(token), encode(expected))
 
 
 # homepage!
@@ -35,12 +56,10 @@ class Homepage(Page):
 
   if __debug__:
 
-    # bind metadata/datastore for introspection
-    __metadata__, __datastore__, metadata, datastore = (
-      inmemory._metadata,
-      inmemory._datastore,
-      property(lambda self: self.__metadata__),
-      property(lambda self: self.__datastore__)
+    # bind metadata/datastore for introspection (the adapter is imported on first access)
+    metadata, datastore = (
+      property(lambda self: importlib.import_module('canteen.model.adapter.inmemory')._metadata),
+      property(lambda self: importlib.import_module('canteen.model.adapter.inmemory')._datastore)
     )
 
   def GET(self):
@@ -48,6 +67,70 @@ class Homepage(Page):
     ''' handles HTTP GET '''
 
     # allow interactive breakpoints for inspection
-    if __debug__ and self.request.args.get('debug'): pdb.set_trace()
+    if __debug__ and self.request.args.get('debug'): import pdb; pdb.set_trace()
+
+    return self.render('home.haml', message='hi', cache=('message',), tags=('home',))
+
+
+# precomputed RPC services manifest
+@url('services-manifest', u'/_rpc/manifest.<fingerprint>.js')
+class ServicesManifest(Page):
+
+  '''  '''
+
+  def GET(self, fingerprint):
+
+    ''' handles HTTP GET '''
+
+    if fingerprint != manifest.fingerprint:
+      return self.http.new_response(status='404 Not Found')
+
+    # content-addressed, so it can be cached for as long as browsers allow
+    headers = [('Cache-Control', 'public, max-age=31536000, immutable'), ('ETag', '"%s"' % fingerprint)]
+    if self.request.if_none_match.contains_weak(fingerprint):
+      return self.http.new_response(status='304 Not Modified', headers=headers)
+    return self.http.new_response(manifest.script, content_type='application/javascript', headers=headers)
+
+
+# streaming event export
+@url('export', u'/export/<type>.<format>')
+class Export(Page):
+
+  '''  '''
+
+  def GET(self, type, format):
+
+    ''' handles HTTP GET '''
+
+    if format not in formats:
+      return self.http.new_response(status='404 Not Found')
+    if not internal(self.request):
+      return self.http.new_response(status='403 Forbidden')
+
+    try:
+      start, end = (float(self.request.args[arg]) if arg in self.request.args else None for arg in ('start', 'end'))
+    except ValueError:
+      return self.http.new_response(status='400 Bad Request')
+
+    # no content-length, so the server streams each chunk as it's encoded
+    return self.http.new_response(export(type, start, end, format), content_type=formats[format][0],
+                                  direct_passthrough=True, headers=[
+      ('Content-Disposition', 'attachment; filename="%s.%s"' % (type, format)),
+      ('Cache-Control', 'no-cache')])
+
+
+# per-RPC-method metrics
+@url('metrics', u'/_internal/metrics')
+class Metrics(Page):
+
+  '''  '''
+
+  def GET(self):
+
+    ''' handles HTTP GET '''
+
+    if not internal(self.request):
+      return self.http.new_response(status='404 Not Found')
 
-    return self.render('home.haml', message='hi')
+    return self.http.new_response(json.dumps(metrics.snapshot(), sort_keys=True), content_type='application/json',
+                                  headers=[('Cache-Control', 'no-store')])
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+
+'''
+
+  services: read
+  ~~~~~~~~~~~~~~
+
+  :author: Sam Gammon <sam@momentum.io>
+  :author: Ian Weisberger <ian@momentum.io>
+  :author: David Rekow <david@momentum.io>
+  :copyright: (c) momentum labs, 2014
+  :license: The inspection, use, distribution, modification or implementation
+            of this source code is governed by a private license - all rights
+            are reserved by the Authors (collectively, "momentum labs") and held
+            under relevant California and US Federal Copyright laws. For full
+            details, see ``LICENSE.md`` at the root of this project. Continued
+            inspection of this source code demands agreement with the included
+            license and explicitly means acceptance to these terms.
+
+'''
+
+# stdlib
+import csv
+import json
+import cStringIO
+
+# numpy
+import numpy
+
+# canteen
+from canteen import rpc, model
+from canteen.rpc import premote as proto
+
+# finnalytics
+from ..write import ingestor
+from ...base import Service
+from ...models import EventBatch
+from ...logic.query import Table, Query
+from ...storage.segments import segments
+
+
+## Globals
+_EXPORT_CHUNK = 4096  # rows encoded per yielded chunk
+
+
+def tables(type, start=None, end=None):
+
+  ''' generate column tables for events of ``type`` overlapping
+      ``[start, end)``: memory-mapped views of sealed segments, one per
+      persisted :py:class:`EventBatch`, then a snapshot of the
+      in-process ingest buffer. only batch keys and the snapshot are
+      taken up front - each batch is fetched and decoded when the
+      generator reaches it, so at most one is held at a time. '''
+
+  # the Redis adapter takes one strict inequality per query, so ``start`` is checked per batch
+  query = EventBatch.query().filter(EventBatch.type == type)
+  if end is not None: query = query.filter(EventBatch.start < end)
+  keys = query.fetch(keys_only=True)
+
+  with ingestor.lock:
+    buf = ingestor.buffers.get(type)
+    snapshot = Table.from_buffer(buf, copy=True) if buf is not None else None
+
+  for segment in segments.segments(type, start, end):
+    yield segment.table()
+
+  for key in keys:
+    batch = EventBatch.get(key)
+    if batch is not None and (start is None or batch.end >= start): yield Table.from_columns(*batch.columns())
+
+  if snapshot is not None: yield snapshot
+
+
+def scan(type, start=None, end=None):
+
+  ''' collect every event of ``type`` overlapping ``[start, end)``
+      into a single table (see :py:func:`tables`) '''
+
+  return Table.concat(tables(type, start, end))
+
+
+##### !!! Export !!! #####
+def dimensions(type, start=None, end=None):
+
+  ''' list the names of every dimension on events of ``type`` in
+      ``[start, end)``, loading one table at a time '''
+
+  return sorted(set(name for table in tables(type, start, end) for name in table.dimensions))
+
+
+def rows(type, start=None, end=None, names=None, chunk=_EXPORT_CHUNK):
+
+  ''' generate ``(dimension names, chunk)`` pairs covering each event
+      of ``type`` in ``[start, end)``, where each chunk is a list of up
+      to ``chunk`` rows of ``[timestamp, value, dimensions...]``. the
+      dimensions are ``names`` if given, or else each table's own.
+      tables are loaded one at a time and walked in place, a slice at a
+      time, so nothing is ever concatenated or decoded beyond the
+      current table and chunk. '''
+
+  for table in tables(type, start, end):
+    fields = names if names is not None else sorted(table.dimensions)
+    timestamps, values = table.metrics['timestamp'], table.metrics['value']
+    columns = [(numpy.array(table.dimensions[name][0], dtype=object), table.dimensions[name][1])
+               if name in table.dimensions else None for name in fields]
+
+    for offset in xrange(0, len(table), chunk):
+      window = slice(offset, offset + chunk)
+      keep = numpy.ones(len(timestamps[window]), numpy.bool_)
+      if start is not None: keep &= timestamps[window] >= start
+      if end is not None: keep &= timestamps[window] < end
+      if not keep.any(): continue
+
+      decoded = [timestamps[window][keep].tolist(), values[window][keep].tolist()] + [
+        symbols[codes[window][keep]].tolist() if symbols is not None else [None] * int(keep.sum())
+        for symbols, codes in (column or (None, None) for column in columns)]
+      yield fields, zip(*decoded)
+
+
+def _ndjson(type, start, end):
+
+  ''' encode events as newline-delimited JSON objects '''
+
+  for names, chunk in rows(type, start, end):
+    fields = ('timestamp', 'value') + tuple(names)
+    yield ''.join(json.dumps(dict((field, item) for field, item in zip(fields, row) if item is not None)) + '\n'
+                  for row in chunk)
+
+
+def _csv(type, start, end):
+
+  ''' encode events as CSV, with a header row. the header needs every
+      dimension name up front, which costs a first pass over the
+      tables (still loading one at a time). '''
+
+  names, header = dimensions(type, start, end), None
+  for fields, chunk in rows(type, start, end, names):
+    out = cStringIO.StringIO()
+    writer = csv.writer(out)
+    if header is None:
+      header = ['timestamp', 'value'] + names
+      writer.writerow(header)
+    writer.writerows([[item.encode('utf-8') if isinstance(item, unicode) else ('' if item is None else item)
+                       for item in row] for row in chunk])
+    yield out.getvalue()
+
+
+# export formats, by name: (content type, encoder)
+formats = {
+  'ndjson': ('application/x-ndjson', _ndjson),
+  'csv': ('text/csv; charset=utf-8', _csv)
+}
+
+
+def export(type, start=None, end=None, format='ndjson'):
+
+  ''' stream every event of ``type`` in ``[start, end)``, encoded as
+      ``format`` (see :py:data:`formats`), as an iterator of strings. '''
+
+  return formats[format][1](type, start, end)
+
+
+##### !!! Messages !!! #####
+class Filter(model.Model):
+
+  ''' a single filter over an event column '''
+
+  column = basestring, {'required': True}
+  operator = basestring, {'default': '=='}  # `==`, `!=`, `<`, `<=`, `>`, `>=` or `in`
+  values = basestring, {'repeated': True}  # one value, or several for `in`
+
+
+class QueryRequest(model.Model):
+
+  ''' filter/group-by/aggregate query over one event type '''
+
+  type = basestring, {'required': True}
+  start = float
+  end = float
+  filters = Filter, {'repeated': True}
+  group_by = basestring, {'repeated': True}
+  interval = float  # also group by time buckets of this many seconds
+  aggregates = basestring, {'repeated': True}  # `count` or `<sum|avg|min|max>:<column>`
+
+
+class Row(model.Model):
+
+  ''' one result group '''
+
+  dimensions = basestring, {'repeated': True}  # group labels, in `group_by` order
+  timestamp = float  # bucket start, if grouped by `interval`
+  aggregates = float, {'repeated': True}  # aggregate values, in `aggregates` order
+  nulls = int, {'repeated': True}  # positions in `aggregates` with no value (sent as `0`)
+
+
+class QueryResponse(model.Model):
+
+  ''' results of a query '''
+
+  columns = basestring, {'repeated': True}
+  rows = Row, {'repeated': True}
+
+
+##### !!! Read Service !!! #####
+class InvalidQuery(proto.RequestError):
+
+  ''' raised when a query names an unknown aggregate or operator, or
+      a filter doesn't carry exactly the values its operator needs. '''
+
+
+@rpc.remote.service('read')
+class ReadService(Service):
+
+  ''' answers analytics queries '''
+
+  exceptions = rpc.Exceptions(dict(Service.exceptions.items(), invalid_query=InvalidQuery))
+
+  @rpc.remote.method(QueryRequest, QueryResponse)
+  def query(self, request):
+
+    ''' run a filter/group-by/aggregate query, vectorized over the
+        column arrays of every matching event batch. '''
+
+    for item in request.filters:
+      if item.operator != 'in' and len(item.values) != 1:
+        raise InvalidQuery('Filter on "%s" needs exactly one value, got %s.' % (item.column, len(item.values)))
+
+    filters = [(item.column, item.operator or '==', item.values if item.operator == 'in' else item.values[0])
+               for item in request.filters]
+    if request.start is not None: filters.append(('timestamp', '>=', request.start))
+    if request.end is not None: filters.append(('timestamp', '<', request.end))
+
+    try:
+      query = Query(filters, request.group_by, request.interval, request.aggregates or ('count',))
+      results = query.execute(scan(request.type, request.start, request.end))
+    except ValueError as exc:  # bad operators, aggregates or filter values
+      raise InvalidQuery(str(exc))
+
+    width = len(request.group_by)
+    offset = width + (1 if request.interval else 0)
+    return QueryResponse(columns=query.columns, rows=[Row(**{
+      'dimensions': [label or u'' for label in row[:width]],
+      'timestamp': row[width] if request.interval else None,
+      'aggregates': [value or 0.0 for value in row[offset:]],
+      'nulls': [i for i, value in enumerate(row[offset:]) if value is None]})
+      for row in results])
+
+
+__all__ = (
+  'export',
+  'InvalidQuery',
+  'ReadService',
+  'QueryRequest',
+  'QueryResponse'
+)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+'''
+
+  services: write
+  ~~~~~~~~~~~~~~~
+
+  :author: Sam Gammon <sam@momentum.io>
+  :author: Ian Weisberger <ian@momentum.io>
+  :author: David Rekow <david@momentum.io>
+  :copyright: (c) momentum labs, 2014
+  :license: The inspection, use, distribution, modification or implementation
+            of this source code is governed by a private license - all rights
+            are reserved by the Authors (collectively, "momentum labs") and held
+            under relevant California and US Federal Copyright laws. For full
+            details, see ``LICENSE.md`` at the root of this project. Continued
+            inspection of this source code demands agreement with the included
+            license and explicitly means acceptance to these terms.
+
+'''
+
+# canteen
+from canteen import rpc, model
+
+# finnalytics
+from ...base import Service
+from ...models import EventBatch
+from ...config import config
+from ...logic.query import Table
+from ...logic.ingest import Ingestor
+from ...logic.rollups import rollups
+from ...storage.wal import log
+from ...storage.segments import segments
+
+
+## Globals
+ingestor = Ingestor(log=log if log.enable else None, **config.config.get('ingest', {}))
+
+
+@ingestor.sink
+def persist(buf):
+
+  ''' default ingest sink: persist each sealed buffer as a single
+      columnar :py:class:`EventBatch` entity. '''
+
+  return EventBatch.from_buffer(buf).put()
+
+
+# keep minute/hour/day counters current as events are flushed
+if rollups.enable: ingestor.sink(rollups.record)
+
+
+def archive(type, before, store=segments):
+
+  ''' move persisted batches of ``type`` that ended before ``before``
+      out of the datastore and into one sealed, on-disk segment in
+      ``store``. the segment is synced before any batch is deleted, so
+      a crash midway can only leave events in both tiers, never in
+      neither. run by ``finna archive``. '''
+
+  query = EventBatch.query().filter(EventBatch.type == type).filter(EventBatch.end < before)
+  batches = filter(None, EventBatch.get_multi(query.fetch(keys_only=True)))  # entities live on their own shards
+  if not batches: return None
+
+  segment = store.seal(type, Table.concat([Table.from_columns(*batch.columns()) for batch in batches]))
+  EventBatch.delete_multi([batch.key for batch in batches])
+  return segment
+
+
+##### !!! Messages !!! #####
+class Dimension(model.Model):
+
+  ''' one dimension column, aligned with its batch's timestamps '''
+
+  name = basestring, {'required': True}
+  values = basestring, {'repeated': True}
+
+
+class Events(model.Model):
+
+  ''' a columnar run of events of a single type '''
+
+  type = basestring, {'required': True}
+  timestamps = float, {'repeated': True}
+  values = float, {'repeated': True}  # defaults to `1.0` per event if empty
+  dimensions = Dimension, {'repeated': True}
+
+
+class IngestRequest(model.Model):
+
+  ''' request to ingest one or more runs of events '''
+
+  batches = Events, {'repeated': True}
+
+
+class IngestResponse(model.Model):
+
+  ''' acknowledges how many events were accepted '''
+
+  accepted = int, {'default': 0}
+
+
+##### !!! Write Service !!! #####
+@rpc.remote.service('write')
+class WriteService(Service):
+
+  ''' accepts events for ingestion '''
+
+  @rpc.remote.method(IngestRequest, IngestResponse)
+  def ingest(self, request):
+
+    ''' buffer each run of events in ``request`` into array-backed
+        columns for its type. events are persisted in bulk once their
+        buffer crosses a size or age threshold, but are acknowledged
+        only once committed to the write-ahead log. '''
+
+    return IngestResponse(accepted=ingestor.write([
+      (batch.type, batch.timestamps, batch.values or None, dict((
+        (dimension.name, dimension.values) for dimension in batch.dimensions)))
+      for batch in request.batches]))
+
+
+__all__ = (
+  'archive',
+  'WriteService',
+  'IngestRequest',
+  'IngestResponse'
+)
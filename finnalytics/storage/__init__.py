@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+'''
+
+  storage
+  ~~~~~~~
+
+  :author: Sam Gammon <sam@momentum.io>
+  :author: Ian Weisberger <ian@momentum.io>
+  :author: David Rekow <david@momentum.io>
+  :copyright: (c) momentum labs, 2014
+  :license: The inspection, use, distribution, modification or implementation
+            of this source code is governed by a private license - all rights
+            are reserved by the Authors (collectively, "momentum labs") and held
+            under relevant California and US Federal Copyright laws. For full
+            details, see ``LICENSE.md`` at the root of this project. Continued
+            inspection of this source code demands agreement with the included
+            license and explicitly means acceptance to these terms.
+
+'''
+
+
+# finnalytics
+from .. import lazy
+
+
+__all__ = (
+  'pool',
+  'segments',
+  'wal'
+)
+
+
+# submodules are imported on first access
+lazy(__name__)
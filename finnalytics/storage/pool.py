@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+
+'''
+
+  storage: pool
+  ~~~~~~~~~~~~~
+
+  :author: Sam Gammon <sam@momentum.io>
+  :author: Ian Weisberger <ian@momentum.io>
+  :author: David Rekow <david@momentum.io>
+  :copyright: (c) momentum labs, 2014
+  :license: The inspection, use, distribution, modification or implementation
+            of this source code is governed by a private license - all rights
+            are reserved by the Authors (collectively, "momentum labs") and held
+            under relevant California and US Federal Copyright laws. For full
+            details, see ``LICENSE.md`` at the root of this project. Continued
+            inspection of this source code demands agreement with the included
+            license and explicitly means acceptance to these terms.
+
+'''
+
+# stdlib
+import bisect
+import struct
+import hashlib
+import threading
+import collections
+
+# redis
+import redis
+
+# finnalytics
+from ..config import config
+
+
+## Globals
+_POINT = struct.Struct('>Q')
+
+
+##### !!! Consistent Hashing !!! #####
+def hashtag(key):
+
+  ''' resolve the part of ``key`` that decides which server owns it.
+      as in Redis Cluster, if ``key`` contains a non-empty ``{tag}``,
+      only the tag is hashed, so keys sharing a tag stay together. '''
+
+  start = key.find('{')
+  if start != -1:
+    end = key.find('}', start + 1)
+    if end > start + 1: return key[start + 1:end]
+  return key
+
+
+class Ring(object):
+
+  ''' consistent-hash ring of servers. each server is placed at
+      ``replicas * weight`` pseudo-random points, and a key belongs to
+      the first server point at or after the key's own hash, so adding
+      a server only moves the keys that land on its new points. '''
+
+  def __init__(self, weights, replicas=160):
+
+    ''' initialize a ring from a mapping of server name to weight '''
+
+    self.weights, self.replicas = dict(weights), replicas
+
+    points = sorted((self.hash('%s#%d' % (node, replica)), node)
+                    for node, weight in self.weights.iteritems()
+                    for replica in xrange(int(replicas * weight)))
+    self.points, self.nodes = [point for point, _ in points], [node for _, node in points]
+
+  @staticmethod
+  def hash(key):
+
+    ''' hash ``key`` to a 64-bit position on the ring '''
+
+    return _POINT.unpack_from(hashlib.md5(key).digest())[0]
+
+  def node(self, key):
+
+    ''' resolve the server that owns ``key`` '''
+
+    if not self.nodes: raise KeyError('No servers on the hash ring.')
+    return self.nodes[bisect.bisect_left(self.points, self.hash(hashtag(key))) % len(self.nodes)]
+
+  def add(self, node, weight=1):
+
+    ''' build a new ring with ``node`` added (rings are immutable, so
+        swapping one in is atomic for concurrent readers) '''
+
+    return type(self)(dict(self.weights, **{node: weight}), self.replicas)
+
+
+##### !!! Connection Pools !!! #####
+class Pools(object):
+
+  ''' holds one bounded, reusable connection pool per configured
+      Redis server. pools are created lazily, on first use, and are
+      shared by everything in the process that talks to Redis. keys
+      routed through :py:meth:`execute` and :py:meth:`server_for` are
+      sharded across every server by consistent hashing, and must be
+      declared with :py:meth:`own` - as rollups, sessions and model
+      entities (see :py:class:`finnalytics.base.BaseModel`) are. model
+      indexes, ID counters and queries stay on the default server. '''
+
+  def __init__(self, servers, pool=None, replicas=160):
+
+    ''' initialize from the ``servers`` block of the ``RedisAdapter``
+        config, default ``pool`` bounds (``max_connections`` and
+        ``timeout``) that each server may override, and the number of
+        ring ``replicas`` per unit of server ``weight``. '''
+
+    servers = dict(servers)
+    self.default = servers.pop('default', None) or sorted(servers)[0]
+    self.servers, self.bounds = servers, dict(pool or {})
+    self.pools, self.lock, self.owned = {}, threading.Lock(), {}
+    self.ring = Ring(dict((name, settings.get('weight', 1)) for name, settings in servers.iteritems()), replicas)
+
+  @classmethod
+  def from_config(cls, config):
+
+    ''' build pools from the app's ``RedisAdapter`` config '''
+
+    adapter = config.config.get('RedisAdapter', {})
+    return cls(adapter.get('servers', {}), adapter.get('pool'), adapter.get('replicas', 160))
+
+  def pool(self, name=None):
+
+    ''' retrieve (or create) the connection pool for server ``name``,
+        defaulting to the configured ``default`` server. '''
+
+    name = name or self.default
+    pool = self.pools.get(name)
+    if pool is None:
+      with self.lock:
+        pool = self.pools.get(name)
+        if pool is None:
+          settings = dict(self.servers[name])
+          settings.pop('weight', None)
+          bounds = dict(self.bounds, **settings.pop('pool', {}))
+          pool = self.pools[name] = redis.BlockingConnectionPool(
+            max_connections=bounds.get('max_connections', 32),
+            timeout=bounds.get('timeout', 5),
+            **settings)
+    return pool
+
+  def client(self, name=None):
+
+    ''' build a client for server ``name`` backed by its pool '''
+
+    return redis.StrictRedis(connection_pool=self.pool(name))
+
+  def pipeline(self, name=None, transaction=False):
+
+    ''' open a pipeline to server ``name``. commands queued on it are
+        sent in a single round trip when it is executed. '''
+
+    return self.client(name).pipeline(transaction=transaction)
+
+  def own(self, pattern, route=None):
+
+    ''' declare that keys matching the glob ``pattern`` are sharded on
+        the ring, so :py:meth:`rebalance` moves them. keys matching no
+        declared pattern (like model indexes) are never moved.
+
+        :param route: if given, maps each matching key to the key it is
+          routed by (i.e. a ``{hashtag}``), or to ``None`` if it isn't
+          sharded after all. defaults to routing by the key itself. '''
+
+    self.owned[pattern] = route
+    return pattern
+
+  def server_for(self, key):
+
+    ''' resolve the server that owns ``key`` (see :py:func:`hashtag`) '''
+
+    return self.ring.node(key)
+
+  def partition(self, keys):
+
+    ''' group ``keys`` by owning server, preserving each key's
+        position in ``keys`` so results can be stitched back in order.
+        returns a mapping of ``server => [(position, key), ...]``. '''
+
+    groups = collections.defaultdict(list)
+    for position, key in enumerate(keys):
+      groups[self.server_for(key)].append((position, key))
+    return groups
+
+  def execute(self, keys, command):
+
+    ''' run ``command(pipeline, position, key)`` for each of ``keys``,
+        using one pipeline (and so one round trip) per owning server.
+        returns each result in the same order as ``keys`` - or a list
+        of results, where ``command`` queued more than one. '''
+
+    results = [None] * len(keys)
+    for server, group in self.partition(keys).iteritems():
+      pipe, spans = self.pipeline(server), []
+      for position, key in group:
+        queued = len(pipe)
+        command(pipe, position, key)
+        spans.append((position, queued, len(pipe)))
+
+      replies = pipe.execute()
+      for position, start, end in spans:
+        results[position] = replies[start] if end - start == 1 else replies[start:end]
+    return results
+
+  def rebalance(self, name, settings, weight=None, batch=1000):
+
+    ''' add server ``name`` (with connection ``settings``) to the ring
+        while serving traffic, moving over the keys it now owns:
+
+        1. every sharded key (see :py:meth:`own`) the new server will
+           own is copied to it (``DUMP`` and ``RESTORE``, keeping TTLs)
+           while the old owners keep serving reads and writes.
+        2. the new ring is swapped in, so subsequent commands route to
+           the new server.
+        3. the moved keys are deleted from their old owners.
+
+        writes that land on a moving key between its copy and the swap
+        are lost, so pause writers (i.e. flush and hold the ingestor)
+        for the duration if that matters. other processes pick up the
+        new server from config on their next deploy. returns the number
+        of keys moved. '''
+
+    ring = self.ring.add(name, weight or settings.get('weight', 1))
+    with self.lock:
+      self.servers[name] = dict(settings)
+
+    moved = {}
+    for server in self.ring.weights:
+      source, keys = self.client(server), set()
+      for pattern, route in self.owned.items():
+        for key in source.scan_iter(match=pattern, count=batch):
+          shard = route(key) if route else key
+          if shard is not None and ring.node(shard) == name: keys.add(key)
+      keys = sorted(keys)
+
+      for offset in xrange(0, len(keys), batch):
+        chunk, pipe = keys[offset:offset + batch], source.pipeline(transaction=False)
+        for key in chunk:
+          pipe.pttl(key)
+          pipe.dump(key)
+        replies = pipe.execute()
+
+        target = self.pipeline(name)
+        for key, ttl, payload in zip(chunk, replies[::2], replies[1::2]):
+          if payload is not None: target.restore(key, max(ttl, 0), payload, replace=True)
+        target.execute()
+      moved[server] = keys
+
+    self.ring = ring
+    for server, keys in moved.iteritems():
+      for offset in xrange(0, len(keys), batch):
+        self.client(server).delete(*keys[offset:offset + batch])
+    return sum(map(len, moved.itervalues()))
+
+  def disconnect(self):
+
+    ''' drop every pooled connection, i.e. after forking '''
+
+    with self.lock:
+      for pool in self.pools.itervalues():
+        pool.disconnect()
+      self.pools.clear()
+
+
+## Globals
+pools = Pools.from_config(config)
+
+
+__all__ = (
+  'hashtag',
+  'Ring',
+  'Pools',
+  'pools'
+)
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+
+'''
+
+  storage: segments
+  ~~~~~~~~~~~~~~~~~
+
+  :author: Sam Gammon <sam@momentum.io>
+  :author: Ian Weisberger <ian@momentum.io>
+  :author: David Rekow <david@momentum.io>
+  :copyright: (c) momentum labs, 2014
+  :license: The inspection, use, distribution, modification or implementation
+            of this source code is governed by a private license - all rights
+            are reserved by the Authors (collectively, "momentum labs") and held
+            under relevant California and US Federal Copyright laws. For full
+            details, see ``LICENSE.md`` at the root of this project. Continued
+            inspection of this source code demands agreement with the included
+            license and explicitly means acceptance to these terms.
+
+'''
+
+# stdlib
+import os
+import json
+import mmap
+import uuid
+import struct
+import threading
+
+# numpy
+import numpy
+
+# finnalytics
+from ..config import config
+from ..logic.query import Table
+
+
+## Globals
+_MAGIC = 'FNSG'
+_VERSION = 1
+_ALIGN = 8
+_HEADER = struct.Struct('<4sH2x')  # magic, version, padding
+_TRAILER = struct.Struct('<Q4s')  # footer length, magic
+_METRIC = numpy.dtype('<f8')
+_CODE = numpy.dtype('<u4')
+_RESERVED = ('timestamp', 'value')  # built-in column names, which dimensions can't shadow
+
+
+##### !!! Segments !!! #####
+class Segment(object):
+
+  ''' an immutable, memory-mapped file of events of one type for a
+      sealed time range. columns are fixed-width little-endian arrays,
+      each aligned to 8 bytes, followed by a JSON footer indexing them:
+
+        [header][timestamp f8 * n][value f8 * n][codes u4 * n]...[footer][trailer]
+
+      reading a column maps straight onto the page cache - no parsing,
+      no copies, and no memory held beyond what the OS chooses to keep. '''
+
+  __slots__ = ('path', 'index', 'buffer')
+
+  def __init__(self, path):
+
+    ''' open and map the segment at ``path`` '''
+
+    with open(path, 'rb') as handle:
+      self.buffer = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, version = _HEADER.unpack_from(self.buffer, 0)
+    length, trailer = _TRAILER.unpack_from(self.buffer, len(self.buffer) - _TRAILER.size)
+    if magic != _MAGIC or trailer != _MAGIC or version != _VERSION:
+      raise ValueError('File "%s" is not a valid event segment.' % path)
+
+    footer = len(self.buffer) - _TRAILER.size - length
+    self.path, self.index = path, json.loads(self.buffer[footer:footer + length])
+
+  type = property(lambda self: self.index['type'])
+  start = property(lambda self: self.index['start'])
+  end = property(lambda self: self.index['end'])
+
+  def __len__(self):
+
+    ''' number of events in this segment '''
+
+    return self.index['count']
+
+  def column(self, name):
+
+    ''' view column ``name`` as a zero-copy array over the mapping '''
+
+    spec = self.index['columns'][name]
+    return numpy.frombuffer(self.buffer, numpy.dtype(spec['dtype']), self.index['count'], spec['offset'])
+
+  def table(self):
+
+    ''' view this segment as a :py:class:`finnalytics.logic.query.Table`
+        whose columns all point into the mapping. '''
+
+    return Table(dict(((name, self.column(name)) for name in ('timestamp', 'value'))), dict((
+      (name, (spec['symbols'], self.column(name)))
+      for name, spec in self.index['columns'].iteritems() if 'symbols' in spec)))
+
+  @classmethod
+  def write(cls, path, type, table):
+
+    ''' write ``table`` (a :py:class:`finnalytics.logic.query.Table`)
+        as a segment at ``path``, sorted by timestamp. the file is
+        written beside ``path``, synced and atomically renamed into
+        place, so readers never see a partial segment. '''
+
+    reserved = sorted(set(table.dimensions) & set(_RESERVED))
+    if reserved: raise ValueError('Dimensions named %s collide with built-in columns.' % ', '.join(reserved))
+
+    order = numpy.argsort(table.metrics['timestamp'], kind='mergesort')
+    columns = [('timestamp', table.metrics['timestamp'][order].astype(_METRIC), None),
+               ('value', table.metrics['value'][order].astype(_METRIC), None)] + [
+               (name, codes[order].astype(_CODE), symbols)
+               for name, (symbols, codes) in sorted(table.dimensions.iteritems())]
+
+    index, offset = {
+      'type': type,
+      'count': len(table),
+      'start': float(table.metrics['timestamp'].min()) if len(table) else None,
+      'end': float(table.metrics['timestamp'].max()) if len(table) else None,
+      'columns': {}}, _HEADER.size
+
+    pending = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+    with open(pending, 'wb') as handle:
+      handle.write(_HEADER.pack(_MAGIC, _VERSION))
+      for name, data, symbols in columns:
+        padding = -offset % _ALIGN
+        handle.write('\x00' * padding)
+        offset += padding
+
+        index['columns'][name] = dict({'dtype': data.dtype.str, 'offset': offset},
+                                      **({'symbols': list(symbols)} if symbols is not None else {}))
+        handle.write(data.tostring())
+        offset += data.nbytes
+
+      footer = json.dumps(index, separators=(',', ':'))
+      handle.write(footer)
+      handle.write(_TRAILER.pack(len(footer), _MAGIC))
+      handle.flush()
+      os.fsync(handle.fileno())
+
+    os.rename(pending, path)
+    return cls(path)
+
+
+##### !!! Segment Store !!! #####
+class SegmentStore(object):
+
+  ''' file-backed cold tier for historical events, laid out as
+      ``<root>/<type>/<start>-<end>-<id>.seg``. time ranges are encoded
+      in file names, so pruning never opens a file, and opened segments
+      are cached so their mappings are shared by every reader. '''
+
+  def __init__(self, root):
+
+    ''' initialize a segment store rooted at ``root`` '''
+
+    self.root, self.open, self.lock = root, {}, threading.Lock()
+
+  def path(self, type):
+
+    ''' directory holding segments for ``type`` '''
+
+    return os.path.join(self.root, type.replace(os.sep, '_'))
+
+  def seal(self, type, table):
+
+    ''' write ``table`` as a new, immutable segment for ``type``.
+        timestamps must not be negative, since the time range is
+        encoded into the file name with ``-`` separators. '''
+
+    if not len(table): return None
+    timestamps = table.metrics['timestamp']
+    if timestamps.min() < 0: raise ValueError('Segments cannot hold negative timestamps.')
+
+    directory = self.path(type)
+    if not os.path.isdir(directory): os.makedirs(directory)
+
+    segment = Segment.write(os.path.join(directory, '%d-%d-%s.seg' % (
+      int(timestamps.min()), int(timestamps.max()) + 1, uuid.uuid4().hex)), type, table)
+
+    with self.lock:
+      self.open[segment.path] = segment
+    return segment
+
+  def segments(self, type, start=None, end=None):
+
+    ''' list (and open) the segments for ``type`` that overlap
+        ``[start, end)``. '''
+
+    directory, found = self.path(type), []
+    if not os.path.isdir(directory): return found
+
+    for filename in sorted(os.listdir(directory)):
+      if not filename.endswith('.seg'): continue
+      low, high, _ = filename[:-4].split('-', 2)
+      if (end is not None and int(low) >= end) or (start is not None and int(high) <= start): continue
+
+      path = os.path.join(directory, filename)
+      segment = self.open.get(path)
+      if segment is None:
+        with self.lock:
+          segment = self.open.get(path) or self.open.setdefault(path, Segment(path))
+      found.append(segment)
+    return found
+
+  def tables(self, type, start=None, end=None):
+
+    ''' zero-copy tables for every segment overlapping ``[start, end)`` '''
+
+    return [segment.table() for segment in self.segments(type, start, end)]
+
+
+## Globals
+segments = SegmentStore(config.app['paths']['segments'])
+
+
+__all__ = (
+  'Segment',
+  'SegmentStore',
+  'segments'
+)
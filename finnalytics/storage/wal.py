@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+
+'''
+
+  storage: write-ahead log
+  ~~~~~~~~~~~~~~~~~~~~~~~~
+
+  :author: Sam Gammon <sam@momentum.io>
+  :author: Ian Weisberger <ian@momentum.io>
+  :author: David Rekow <david@momentum.io>
+  :copyright: (c) momentum labs, 2014
+  :license: The inspection, use, distribution, modification or implementation
+            of this source code is governed by a private license - all rights
+            are reserved by the Authors (collectively, "momentum labs") and held
+            under relevant California and US Federal Copyright laws. For full
+            details, see ``LICENSE.md`` at the root of this project. Continued
+            inspection of this source code demands agreement with the included
+            license and explicitly means acceptance to these terms.
+
+'''
+
+# stdlib
+import os
+import json
+import time
+import uuid
+import zlib
+import errno
+import fcntl
+import shutil
+import struct
+import threading
+
+# canteen util
+from canteen.util import debug
+
+# finnalytics
+from ..config import config
+
+
+## Globals
+_RECORD = struct.Struct('<IIQ')  # crc32 (of the payload), payload length, sequence
+_LOCK = 'lock'  # held (flock'ed) by the process writing a log, for as long as it lives
+_CHECKPOINT = 'checkpoint'  # first sequence not yet flushed to the datastore
+_sync = getattr(os, 'fdatasync', os.fsync)
+logging = debug.Logger(name='wal')
+
+
+def _sync_directory(path):
+
+  ''' sync the directory at ``path``, so that files created in (or
+      renamed into) it survive a crash '''
+
+  handle = os.open(path, os.O_RDONLY)
+  try:
+    os.fsync(handle)
+  finally:
+    os.close(handle)
+
+
+##### !!! Commit Batch !!! #####
+class Batch(object):
+
+  ''' records waiting to be committed together '''
+
+  __slots__ = ('records', 'first', 'led', 'done', 'error')
+
+  def __init__(self):
+
+    ''' initialize an empty, open batch '''
+
+    self.records, self.first, self.led, self.done, self.error = [], None, False, threading.Event(), None
+
+
+##### !!! Write-Ahead Log !!! #####
+class WriteAheadLog(object):
+
+  ''' local, append-only log of accepted events, so that events still
+      buffered in memory survive a crash. each process writes its own
+      log, in a directory under ``root`` it holds an exclusive lock on:
+
+        <root>/<pid>-<id>/<first sequence>.log  (records: [crc32][length][sequence][json])
+
+      appends are group-committed: the first writer to reach an open
+      batch leads it, waits ``window`` seconds (and for any commit in
+      progress) while others join, then writes the whole batch with a
+      single ``fdatasync`` - one sync per batch, not per event. every
+      writer returns once its batch is durable.
+
+      once buffered events reach the datastore, :py:meth:`checkpoint`
+      records the first sequence still needed and drops files wholly
+      before it. logs whose process has died are replayed (from their
+      checkpoint) by :py:meth:`recover`. replay is at-least-once: a
+      crash between a flush and its checkpoint replays that flush. '''
+
+  def __init__(self, root, window=0.001, segment_size=32 << 20, enable=True):
+
+    ''' initialize a (not yet opened) write-ahead log.
+
+        :param root: directory holding every process's log.
+        :param window: seconds a commit waits for more records.
+        :param segment_size: bytes written to a log file before
+          starting the next one.
+        :param enable: if falsy, the ingest path doesn't log. '''
+
+    self.root, self.window, self.segment_size, self.enable = root, window, segment_size, enable
+    self.lock, self.io = threading.Lock(), threading.Lock()
+    self.pid, self.path, self.handle, self.owner, self.size = None, None, None, None, 0
+    self.sequence, self.batch = 0, Batch()
+
+  @classmethod
+  def from_config(cls, config):
+
+    ''' build a write-ahead log from the app's ``wal`` config '''
+
+    return cls(config.app['paths']['wal'], **config.config.get('wal', {}))
+
+  @property
+  def opened(self):
+
+    ''' whether this log is open in the current process (a forked
+        child writes a log of its own) '''
+
+    return self.pid == os.getpid()
+
+  def open(self):
+
+    ''' create and lock this process's log directory '''
+
+    with self.io:
+      if self.opened: return self.path
+      for inherited in (self.owner, self.handle):  # from before a fork - the parent keeps its lock
+        if inherited is not None: inherited.close()
+
+      # lock the directory before it appears under its real name, so recovery never claims it
+      name = '%s-%s' % (os.getpid(), uuid.uuid4().hex[:8])
+      path, pending = os.path.join(self.root, name), os.path.join(self.root, '.' + name)
+      os.makedirs(pending)
+      owner = open(os.path.join(pending, _LOCK), 'w')
+      fcntl.flock(owner, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      os.rename(pending, path)
+      _sync_directory(self.root)
+
+      with self.lock:
+        self.path, self.owner, self.handle, self.size = path, owner, None, 0
+        self.sequence, self.batch, self.pid = 0, Batch(), os.getpid()
+      return path
+
+  def append(self, record):
+
+    ''' log ``record`` (anything JSON-serializable), returning its
+        sequence once it has been committed to disk '''
+
+    if not self.opened: self.open()
+    payload = json.dumps(record, separators=(',', ':'))
+
+    with self.lock:
+      self.sequence += 1
+      sequence, batch = self.sequence, self.batch
+      batch.records.append(_RECORD.pack(zlib.crc32(payload) & 0xffffffff, len(payload), sequence) + payload)
+      if batch.first is None: batch.first = sequence
+      lead, batch.led = not batch.led, True
+
+    if lead:
+      if self.window: time.sleep(self.window)  # let other writers join the batch
+      with self.io:
+        with self.lock:
+          if self.batch is batch: self.batch = Batch()  # close the batch - later writers start the next
+        try:
+          self.write(batch)
+        except Exception as exc:
+          batch.error = exc
+          raise
+        finally:
+          batch.done.set()
+    else:
+      batch.done.wait()
+      if batch.error is not None: raise IOError('Failed to commit to the write-ahead log: %s' % batch.error)
+    return sequence
+
+  def write(self, batch):
+
+    ''' write and sync ``batch`` (``io`` must be held), starting a new
+        log file if the current one is full. if the write or sync fails,
+        the file is cut back to its last committed record and closed, so
+        the next batch starts a new file rather than following torn bytes. '''
+
+    if self.handle is None or self.size >= self.segment_size:
+      if self.handle is not None: self.handle.close()
+      self.handle, self.size = open(os.path.join(self.path, '%020d.log' % batch.first), 'ab', 0), 0
+      _sync_directory(self.path)
+
+    data = ''.join(batch.records)
+    try:
+      self.handle.write(data)
+      _sync(self.handle.fileno())
+    except Exception:
+      self.abandon()
+      raise
+    self.size += len(data)
+
+  def abandon(self):
+
+    ''' truncate the current log file to its last committed record and
+        close it (``io`` must be held). failures are only logged: a torn
+        tail left behind is skipped by :py:meth:`read`. '''
+
+    handle, size, self.handle, self.size = self.handle, self.size, None, 0
+    try:
+      os.ftruncate(handle.fileno(), size)
+      _sync(handle.fileno())
+    except (IOError, OSError) as exc:
+      logging.error('Failed to truncate "%s" to %s bytes: %s' % (handle.name, size, exc))
+    finally:
+      try:
+        handle.close()
+      except (IOError, OSError):
+        pass
+
+  def checkpoint(self, sequence):
+
+    ''' record that every record before ``sequence`` has reached the
+        datastore, and drop log files holding nothing newer '''
+
+    if not self.opened: return
+    with self.io:
+      target = os.path.join(self.path, _CHECKPOINT)
+      with open(target + '.tmp', 'w') as handle:
+        handle.write(str(sequence))
+        handle.flush()
+        os.fsync(handle.fileno())
+      os.rename(target + '.tmp', target)
+
+      files = self.files(self.path)
+      for (first, path), (following, _) in zip(files, files[1:]):
+        if following <= sequence and path != getattr(self.handle, 'name', None): os.remove(path)
+
+  @staticmethod
+  def files(path):
+
+    ''' ``(first sequence, path)`` of each log file under ``path`` '''
+
+    return sorted((int(name[:-4]), os.path.join(path, name)) for name in os.listdir(path) if name.endswith('.log'))
+
+  @classmethod
+  def read(cls, path):
+
+    ''' generate ``(sequence, record)`` for each record in the log at
+        ``path`` from its checkpoint on. a torn write ends its file: at
+        the tail of the newest file that's a crash mid-commit, anywhere
+        else it's logged as corruption and reading goes on to the next. '''
+
+    start = 0
+    if os.path.exists(os.path.join(path, _CHECKPOINT)):
+      with open(os.path.join(path, _CHECKPOINT)) as handle:
+        start = int(handle.read().strip() or 0)
+
+    files = cls.files(path)
+    for index, (first, filename) in enumerate(files):
+      with open(filename, 'rb') as handle:
+        data = handle.read()
+
+      offset = 0
+      while offset + _RECORD.size <= len(data):
+        checksum, length, sequence = _RECORD.unpack_from(data, offset)
+        payload = data[offset + _RECORD.size:offset + _RECORD.size + length]
+        if len(payload) != length or zlib.crc32(payload) & 0xffffffff != checksum: break
+        offset += _RECORD.size + length
+        if sequence >= start: yield sequence, json.loads(payload)
+
+      if offset != len(data):
+        (logging.warning if index == len(files) - 1 else logging.error)(
+          'Discarding %s bytes of torn writes in "%s".' % (len(data) - offset, filename))
+
+  def recover(self, replay):
+
+    ''' replay every log left by a process that has exited, calling
+        ``replay`` with each of its records in order (then dropping
+        it). logs of live processes are locked, and skipped. '''
+
+    if not os.path.isdir(self.root): return 0
+
+    recovered = 0
+    for name in sorted(os.listdir(self.root)):
+      path = os.path.join(self.root, name)
+      if name.startswith('.') or path == self.path or not os.path.isdir(path): continue
+
+      try:
+        owner = open(os.path.join(path, _LOCK), 'a')
+      except IOError:
+        continue  # being created, or already recovered
+
+      try:
+        try:
+          fcntl.flock(owner, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as exc:
+          if exc.errno in (errno.EAGAIN, errno.EACCES): continue  # its process is alive
+          raise
+
+        records = [record for _, record in self.read(path)]
+        if records:
+          logging.info('Replaying %s records from write-ahead log "%s".' % (len(records), name))
+          try:
+            replay(records)
+          except Exception:
+            logging.exception('Failed to replay write-ahead log "%s" - keeping it for the next recovery.' % name)
+            continue
+        shutil.rmtree(path)
+        recovered += len(records)
+      finally:
+        owner.close()
+    return recovered
+
+
+## Globals
+log = WriteAheadLog.from_config(config)
+
+
+__all__ = (
+  'Batch',
+  'WriteAheadLog',
+  'log'
+)
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+'''
+
+  finnalytics: templates
+  ~~~~~~~~~~~~~~~~~~~~~~
+
+  :author: Sam Gammon <sam@momentum.io>
+  :author: Ian Weisberger <ian@momentum.io>
+  :author: David Rekow <david@momentum.io>
+  :copyright: (c) momentum labs, 2014
+  :license: The inspection, use, distribution, modification or implementation
+            of this source code is governed by a private license - all rights
+            are reserved by the Authors (collectively, "momentum labs") and held
+            under relevant California and US Federal Copyright laws. For full
+            details, see ``LICENSE.md`` at the root of this project. Continued
+            inspection of this source code demands agreement with the included
+            license and explicitly means acceptance to these terms.
+
+'''
+
+# stdlib
+import os
+import sys
+import imp
+import types
+import marshal
+import threading
+
+
+## Globals
+BUNDLE = 'templates.bundle'  # filename of the bundle inside a compiled package
+_MAGIC = imp.get_magic()  # marshalled code is only valid for this interpreter
+
+
+##### !!! Compiled Templates !!! #####
+class CompiledTemplate(types.ModuleType):
+
+  ''' stand-in for a compiled template module, backed by a code
+      object from a template bundle. canteen's ``ModuleLoader`` only
+      touches ``run`` and ``name``, so the code object is executed the
+      first time ``run`` is called, rather than at import time. '''
+
+  def __init__(self, name, template, code):
+
+    ''' initialize this template module with its dotted module
+        ``name``, source ``template`` name and bundled ``code``. '''
+
+    super(CompiledTemplate, self).__init__(name)
+    self.name, self.__code, self.__lock = template, code, threading.Lock()
+
+  def run(self, environment):
+
+    ''' execute the template's code (once), then hand off to the
+        ``run`` it defines, which shadows this one from then on. '''
+
+    with self.__lock:
+      if self.__code is not None:
+        exec self.__code in self.__dict__
+        self.__code = None
+    return self.__dict__['run'](environment)
+
+
+##### !!! Bundles !!! #####
+def dump(templates, target):
+
+  ''' write a bundle of ``templates`` (a dict of dotted module path
+      to ``(template name, code object)``) to the file ``target``. '''
+
+  with open(target + '.tmp', 'wb') as handle:
+    handle.write(_MAGIC)
+    marshal.dump(templates, handle)
+  os.rename(target + '.tmp', target)
+
+
+def load(target):
+
+  ''' read a bundle file written by :py:func:`dump` in a single read,
+      returning its dict of templates. raises ``ImportError`` if it was
+      marshalled by a different interpreter. '''
+
+  with open(target, 'rb') as handle:
+    data = handle.read()
+
+  if data[:len(_MAGIC)] != _MAGIC:
+    raise ImportError('Template bundle "%s" was built by a different Python version.' % target)
+  return marshal.loads(data[len(_MAGIC):])
+
+
+def install(package, target=None):
+
+  ''' install every template in a bundle under ``package`` (the name
+      of an imported compiled template package), creating a stand-in
+      module per template and per subdirectory so that subsequent
+      template imports are satisfied from ``sys.modules`` without
+      touching the filesystem. returns the number of templates. '''
+
+  root = sys.modules[package]
+  templates = load(target or os.path.join(os.path.dirname(root.__file__), BUNDLE))
+
+  for path, (template, code) in templates.iteritems():
+    parent = root
+    for segment in path.split('.')[:-1]:
+      name = '.'.join((parent.__name__, segment))
+      child = sys.modules.get(name)
+      if child is None:
+        child = sys.modules[name] = types.ModuleType(name)
+        child.__path__, child.__package__ = [], name
+      setattr(parent, segment, child)
+      parent = child
+
+    name = '.'.join((parent.__name__, path.rsplit('.', 1)[-1]))
+    module = sys.modules[name] = CompiledTemplate(name, template, code)
+    setattr(parent, path.rsplit('.', 1)[-1], module)
+
+  return len(templates)
+
+
+__all__ = (
+  'BUNDLE',
+  'CompiledTemplate',
+  'dump',
+  'load',
+  'install'
+)
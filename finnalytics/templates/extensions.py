@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+'''
+
+  templates: extensions
+  ~~~~~~~~~~~~~~~~~~~~~
+
+  :author: Sam Gammon <sam@momentum.io>
+  :author: Ian Weisberger <ian@momentum.io>
+  :author: David Rekow <david@momentum.io>
+  :copyright: (c) momentum labs, 2014
+  :license: The inspection, use, distribution, modification or implementation
+            of this source code is governed by a private license - all rights
+            are reserved by the Authors (collectively, "momentum labs") and held
+            under relevant California and US Federal Copyright laws. For full
+            details, see ``LICENSE.md`` at the root of this project. Continued
+            inspection of this source code demands agreement with the included
+            license and explicitly means acceptance to these terms.
+
+'''
+
+# jinja2
+from jinja2 import nodes
+from jinja2.ext import Extension
+
+# finnalytics
+from ..logic.cache import renders
+
+
+## Globals
+FLUSH = u'<!--flush-->'  # marker emitted at each flush point while streaming
+
+
+##### !!! Fragment Cache !!! #####
+class FragmentCache(Extension):
+
+  ''' caches a rendered fragment of a template in the render cache:
+
+        {% cache "js", user.id, ttl=300, tags=["services"] %}
+          ...
+        {% endcache %}
+
+      the first argument names the fragment, any further positional
+      arguments are the (JSON-serializable) values its output varies by, and
+      ``ttl``/``tags`` are passed along to the cache. wrap the body of
+      a ``{% block %}`` to cache just that block. '''
+
+  tags = set(['cache'])
+
+  def parse(self, parser):
+
+    ''' parse a ``cache`` tag and its body into a call block '''
+
+    lineno = next(parser.stream).lineno
+    args, kwargs = [parser.parse_expression()], []
+
+    while parser.stream.skip_if('comma'):
+      if parser.stream.current.type == 'name' and parser.stream.look().type == 'assign':
+        name = next(parser.stream).value
+        parser.stream.skip()
+        kwargs.append(nodes.Keyword(name, parser.parse_expression()))
+      else:
+        args.append(parser.parse_expression())
+
+    body = parser.parse_statements(['name:endcache'], drop_needle=True)
+    return nodes.CallBlock(self.call_method('_render', [nodes.List(args)], kwargs), [], [], body).set_lineno(lineno)
+
+  def _render(self, args, caller, ttl=None, tags=()):
+
+    ''' serve a fragment from the render cache, rendering (and
+        caching) it on a miss '''
+
+    key = renders.key('fragment:%s' % args[0], args[1:])
+    content = renders.get(key)
+    if content is None:
+      content = renders.set(key, caller(), ttl=ttl, tags=tags)
+    return content
+
+
+##### !!! Flush Points !!! #####
+class FlushPoints(Extension):
+
+  ''' marks a point at which a streamed render should hand everything
+      rendered so far to the server:
+
+        </head>
+        {% flush %}
+
+      outside of a streamed render (see :py:func:`flushed`), the tag
+      renders nothing. '''
+
+  tags = set(['flush'])
+
+  def parse(self, parser):
+
+    ''' parse a ``flush`` tag into a conditional marker '''
+
+    lineno = next(parser.stream).lineno
+    return nodes.Output([nodes.CondExpr(
+      nodes.Name('streaming', 'load'), nodes.MarkSafe(nodes.Const(FLUSH)), nodes.Const(u''))]).set_lineno(lineno)
+
+
+def flushed(events, threshold=0):
+
+  ''' regroup the events of a template's ``generate()`` iterator into
+      chunks that end at flush points, dropping the markers. a flush
+      point is skipped if fewer than ``threshold`` characters have been
+      rendered since the last chunk went out. '''
+
+  pending, size = [], 0
+  for event in events:
+    parts = event.split(FLUSH) if FLUSH in event else (event,)
+    for part in parts[:-1]:
+      pending.append(part)
+      size += len(part)
+      if size >= threshold:
+        yield u''.join(pending)
+        pending, size = [], 0
+    pending.append(parts[-1])
+    size += len(parts[-1])
+  if pending: yield u''.join(pending)
+
+
+__all__ = (
+  'FLUSH',
+  'FragmentCache',
+  'FlushPoints',
+  'flushed'
+)
@@ -22,8 +22,12 @@
 
 if __debug__:
 
+  # stdlib
+  import unittest
+
   # canteen testing
   from canteen import test
+  from canteen.model.adapter import RedisAdapter
 
 
   class SampleTest(test.AppTest):
@@ -35,3 +39,38 @@ if __debug__:
       ''' asserts itself '''
 
       assert self, "give me agency and respect"
+
+
+  class RedisTest(test.FrameworkTest):
+
+    ''' base for tests against Redis, via ``fakeredis``: ``RedisAdapter``
+        and every server in :py:data:`finnalytics.storage.pool.pools`
+        are backed by in-process fakes, with the adapter's own fake as
+        the default server. '''
+
+    def setUp(self):
+
+      ''' point the adapter and pools at ``fakeredis``, if it's installed '''
+
+      try:
+        import fakeredis
+      except ImportError:
+        raise unittest.SkipTest('fakeredis unavailable')
+
+      from finnalytics.storage.pool import pools
+
+      RedisAdapter.__testing__ = True
+      self.pools, self.servers = pools, {pools.default: RedisAdapter.channel('__meta__')}
+      self.servers[pools.default].flushall()
+      self.saved = pools.ring, dict(pools.servers), dict(pools.owned)
+
+      pools.client = lambda name=None: self.servers.setdefault(
+        name or pools.default, fakeredis.FakeStrictRedis(singleton=False))
+
+    def tearDown(self):
+
+      ''' restore real connections, and the ring '''
+
+      RedisAdapter.__testing__ = False
+      del self.pools.client
+      self.pools.ring, self.pools.servers, self.pools.owned = self.saved
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+
+'''
+
+  benchmarks
+  ~~~~~~~~~~
+
+  :author: Sam Gammon <sam@momentum.io>
+  :author: Ian Weisberger <ian@momentum.io>
+  :author: David Rekow <david@momentum.io>
+  :copyright: (c) momentum labs, 2014
+  :license: The inspection, use, distribution, modification or implementation
+            of this source code is governed by a private license - all rights
+            are reserved by the Authors (collectively, "momentum labs") and held
+            under relevant California and US Federal Copyright laws. For full
+            details, see ``LICENSE.md`` at the root of this project. Continued
+            inspection of this source code demands agreement with the included
+            license and explicitly means acceptance to these terms.
+
+'''
+
+
+if __debug__:
+
+  # stdlib
+  import os
+  import json
+  import time
+  import shutil
+  import warnings
+  import tempfile
+
+  # canteen testing
+  from canteen import test
+  from canteen import rpc
+
+  # finnalytics testing
+  from finnalytics_tests import RedisTest
+
+  # werkzeug
+  from werkzeug import test as wsgi
+  from werkzeug import wrappers
+
+  # finnalytics
+  from finnalytics import base
+  from finnalytics.config import config
+  from finnalytics.logic import ingest
+  from finnalytics.logic import sessions
+  from finnalytics.storage import wal
+  from finnalytics.storage import segments
+
+
+  ## Globals
+  _BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench.json')
+  _RESULTS = os.environ.get('FINNA_BENCH_RESULTS', os.path.join(tempfile.gettempdir(), 'finna-bench.json'))
+  _THRESHOLD = float(os.environ.get('FINNA_BENCH_THRESHOLD', 1.5))  # allowed slowdown vs. baseline
+  _RECORD = bool(os.environ.get('FINNA_BENCH_RECORD'))  # overwrite the baseline with this run
+
+
+  class BenchModel(base.BaseModel):
+
+    ''' model benchmarked against the in-memory adapter '''
+
+    __adapter__ = 'InMemoryAdapter'
+
+    name = basestring
+    value = int
+
+
+  class RedisBenchModel(base.BaseModel):
+
+    ''' model benchmarked against Redis '''
+
+    __adapter__ = 'RedisAdapter'
+
+    name = basestring
+    value = int
+
+
+  class BenchService(base.Service):
+
+    ''' service benchmarked for RPC dispatch '''
+
+    @rpc.remote.method(rpc.Echo)
+    def echo(self, request):
+
+      ''' echo ``request`` back '''
+
+      return rpc.Echo(message=request.message)
+
+
+  def measure(target, repeat=5, budget=0.05):
+
+    ''' time ``target`` (a callable taking no arguments), returning the
+        best seconds-per-call over ``repeat`` runs, each of enough calls
+        to take at least ``budget`` seconds. '''
+
+    def run(number):
+      start = time.time()
+      for _ in xrange(number): target()
+      return time.time() - start
+
+    number = 1
+    while run(number) < budget: number *= 2
+    return min(run(number) for _ in xrange(repeat)) / number
+
+
+  class BenchmarkTest(test.AppTest):
+
+    ''' benchmarks hot paths, failing any that regress more than
+        ``FINNA_BENCH_THRESHOLD`` times past the baseline committed in
+        ``bench.json``. results are written to ``FINNA_BENCH_RESULTS``,
+        and are merged into the baseline only if ``FINNA_BENCH_RECORD``
+        is set. the app's on-disk state (WAL, segments) goes to a
+        scratch directory. '''
+
+    results = {}
+
+    @classmethod
+    def setUpClass(cls):
+
+      ''' load the committed baseline (failing without one, unless
+          recording), and point the app's data at a scratch directory
+          (``FINNA_DATA`` covers the startup child) '''
+
+      super(BenchmarkTest, cls).setUpClass()
+      cls.results, cls.baseline = {}, {}
+      if os.path.exists(_BASELINE):
+        with open(_BASELINE) as handle: cls.baseline = json.load(handle)
+      elif not _RECORD:
+        raise AssertionError('No benchmark baseline at %s - record one with FINNA_BENCH_RECORD=1.' % _BASELINE)
+
+      cls.data, paths = tempfile.mkdtemp(), config.app['paths']
+      cls.saved = (os.environ.get('FINNA_DATA'), paths['wal'], paths['segments'], wal.log.root, segments.segments.root)
+      os.environ['FINNA_DATA'] = cls.data
+      paths['wal'] = wal.log.root = os.path.join(cls.data, 'wal')
+      paths['segments'] = segments.segments.root = os.path.join(cls.data, 'segments')
+
+    @classmethod
+    def tearDownClass(cls):
+
+      ''' write out this run's results (and baseline, if recording) '''
+
+      super(BenchmarkTest, cls).tearDownClass()
+
+      variable, paths = cls.saved[0], config.app['paths']
+      if variable is None: os.environ.pop('FINNA_DATA', None)
+      else: os.environ['FINNA_DATA'] = variable
+      paths['wal'], paths['segments'], wal.log.root, segments.segments.root = cls.saved[1:]
+      shutil.rmtree(cls.data, ignore_errors=True)
+
+      if not cls.results: return
+
+      if os.path.dirname(_RESULTS) and not os.path.isdir(os.path.dirname(_RESULTS)):
+        os.makedirs(os.path.dirname(_RESULTS))
+
+      for target, results in [(_RESULTS, cls.results)] + ([(_BASELINE, dict(cls.baseline, **cls.results))]
+                                                         if _RECORD else []):
+        with open(target, 'w') as handle:
+          json.dump(results, handle, indent=2, sort_keys=True)
+
+    def bench(self, name, target, **kwargs):
+
+      ''' measure ``target`` as ``name`` and check it against the baseline '''
+
+      seconds = self.results[name] = measure(target, **kwargs)
+      limit = self.baseline.get(name)
+      if limit is None and not _RECORD:
+        warnings.warn('"%s" has no baseline in %s, so it can\'t regress - record one with FINNA_BENCH_RECORD=1.' % (
+          name, _BASELINE))
+      assert limit is None or seconds <= limit * _THRESHOLD, (
+        '"%s" regressed: %.2fus per call, baseline is %.2fus.' % (name, seconds * 1e6, limit * 1e6))
+      return seconds
+
+    def redis(self):
+
+      ''' back Redis with ``fakeredis`` for this test, as
+          :py:class:`finnalytics_tests.RedisTest` does (skipping if
+          it isn't installed) '''
+
+      harness = RedisTest('setUp')
+      harness.setUp()
+      self.addCleanup(harness.tearDown)
+
+    def test_factory(self):
+
+      ''' model construction with ``BaseModel.factory`` '''
+
+      self.bench('model.factory', lambda: BenchModel.factory(None, id='bench', name=u'bench', value=1))
+
+    def test_put_inmemory(self):
+
+      ''' single and bulk writes against ``InMemoryAdapter`` '''
+
+      entity = BenchModel.factory(None, id='bench', name=u'bench', value=1)
+      self.bench('model.put.inmemory', entity.put)
+      self.bench('model.put_multi.inmemory', BenchModel.bulk(range(100), name=[u'bench'] * 100, value=range(100)).put)
+
+    def test_put_redis(self):
+
+      ''' single and (pipelined) bulk writes against Redis '''
+
+      self.redis()
+      entity = RedisBenchModel.factory(None, id='bench', name=u'bench', value=1)
+      self.bench('model.put.redis', entity.put)
+      self.bench('model.put_multi.redis', RedisBenchModel.bulk(range(100), name=[u'bench'] * 100, value=range(100)).put)
+
+    def test_render(self):
+
+      ''' full dispatch and render of ``home.haml`` '''
+
+      from finnalytics.dispatch import application
+      client = wsgi.Client(application, wrappers.BaseResponse)
+      assert client.get('/').status_code == 200
+      self.bench('template.home', lambda: client.get('/').data)
+
+    def test_rpc(self):
+
+      ''' RPC dispatch through an instrumented ``Service`` method '''
+
+      service, request = BenchService(), rpc.Echo(message='bench')
+      assert service.echo(request).message == 'bench'
+      self.bench('rpc.dispatch', lambda: service.echo(request))
+
+    def test_session(self):
+
+      ''' binary session cookie decode, with and without the cache '''
+
+      cookie, cache = sessions.BinaryCookie({'uuid': 'deadbeef' * 8, 'n': 1}, 'secret').serialize(), (
+        sessions.BinaryCookie.verified.entries)
+
+      def decode():
+        cache.clear()
+        return sessions.BinaryCookie.unserialize(cookie, 'secret')
+
+      self.bench('session.decode', decode)
+      self.bench('session.decode.cached', lambda: sessions.BinaryCookie.unserialize(cookie, 'secret'))
+
+    def test_startup(self):
+
+      ''' cold import and spawn stay within ``dev.startup.budget`` '''
+
+      from scripts import startup
+      from finnalytics.config import config
+
+      budget, result = config.app['dev']['startup']['budget'], startup.measure()
+      self.results['startup'] = result['total']
+      assert result['total'] <= budget, 'Startup took %.0fms, over the %.0fms budget.' % (
+        result['total'] * 1000, budget * 1000)
+
+    def test_ingest(self):
+
+      ''' batch ingestion of 1,000 events with two dimensions '''
+
+      ingestor, timestamps = ingest.Ingestor(flush_size=1 << 30, flush_interval=0), [float(i) for i in xrange(1000)]
+      dimensions = {'page': ['/a', '/b'] * 500, 'ref': ['x'] * 1000}
+
+      def batch():
+        ingestor.ingest('bench', timestamps, None, dimensions)
+        ingestor.buffers.clear()
+
+      self.bench('ingest.batch', batch)
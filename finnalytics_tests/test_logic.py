@@ -0,0 +1,480 @@
+# -*- coding: utf-8 -*-
+
+'''
+
+  logic tests
+  ~~~~~~~~~~~
+
+  :author: Sam Gammon <sam@momentum.io>
+  :author: Ian Weisberger <ian@momentum.io>
+  :author: David Rekow <david@momentum.io>
+  :copyright: (c) momentum labs, 2014
+  :license: The inspection, use, distribution, modification or implementation
+            of this source code is governed by a private license - all rights
+            are reserved by the Authors (collectively, "momentum labs") and held
+            under relevant California and US Federal Copyright laws. For full
+            details, see ``LICENSE.md`` at the root of this project. Continued
+            inspection of this source code demands agreement with the included
+            license and explicitly means acceptance to these terms.
+
+'''
+
+
+if __debug__:
+
+  # canteen testing
+  from canteen import test
+
+  # stdlib
+  import os
+  import json
+  import shutil
+  import tempfile
+
+  # finnalytics testing
+  from finnalytics_tests import RedisTest
+
+  # finnalytics
+  from finnalytics.logic import cache
+  from finnalytics.logic import assets
+  from finnalytics.logic import query
+  from finnalytics.logic import ingest
+  from finnalytics.logic import metrics
+  from finnalytics.logic import rollups
+  from finnalytics.logic import profiler
+  from finnalytics.logic import sessions
+  from finnalytics.logic import sketches
+  from finnalytics.storage import pool
+
+
+  class AssetManifestTest(test.FrameworkTest):
+
+    ''' tests resolution of fingerprinted asset names '''
+
+    def test_resolve(self):
+
+      ''' listed assets resolve to their fingerprinted names, others to themselves '''
+
+      root = tempfile.mkdtemp()
+      try:
+        manifest = assets.AssetManifest(root)
+        assert manifest.resolve('script', 'app.js') == 'app.js'
+
+        with open(os.path.join(root, assets.MANIFEST), 'w') as handle:
+          json.dump({'assets': {'js/app.js': {'path': assets.fingerprinted('js/app.js', 'abc123')}}}, handle)
+        manifest.load()
+
+        url = manifest.helper('script', lambda *fragments: '/'.join(('assets/script',) + fragments))
+        assert url('app.js?v=1') == 'assets/script/app.abc123.js?v=1'
+        assert url('other.js') == 'assets/script/other.js' and url('pkg', 'app') == 'assets/script/pkg/app'
+      finally:
+        shutil.rmtree(root)
+
+
+  class AssetServerTest(test.FrameworkTest):
+
+    ''' tests the in-process static asset server '''
+
+    def test_serve(self):
+
+      ''' precompressed variants are negotiated and current copies revalidate '''
+
+      root = tempfile.mkdtemp()
+      try:
+        os.mkdir(os.path.join(root, 'js'))
+        for name, content in (('app.js', 'var a;'), ('app.js.gz', 'gz')):
+          with open(os.path.join(root, 'js', name), 'wb') as handle: handle.write(content)
+
+        server = assets.AssetServer(assets.AssetManifest(root))
+        app = server.wrap(lambda environ, start_response: start_response('404 Not Found', []) or [])
+
+        def get(path, **headers):
+          response, environ = {}, dict(('HTTP_' + key.upper(), value) for key, value in headers.iteritems())
+          environ.update({'PATH_INFO': path, 'REQUEST_METHOD': 'GET'})
+          body = ''.join(app(environ, lambda status, headers: response.update(headers, status=status)))
+          return response, body
+
+        plain, body = get('/assets/script/app.js')
+        assert plain['status'] == '200 OK' and body == 'var a;' and 'Content-Encoding' not in plain
+        packed, body = get('/assets/script/app.js', accept_encoding='deflate, gzip')
+        assert body == 'gz' and packed['Content-Encoding'] == 'gzip' and packed['ETag'] != plain['ETag']
+
+        assert get('/assets/script/app.js', if_none_match=plain['ETag'])[0]['status'] == '304 Not Modified'
+        assert get('/assets/script/../../secret')[0]['status'] == '404 Not Found'
+      finally:
+        shutil.rmtree(root)
+
+
+  class RenderCacheTest(test.FrameworkTest):
+
+    ''' tests the rendered page/fragment cache '''
+
+    def test_eviction(self):
+
+      ''' least-recently-used entries are evicted to fit the byte budget '''
+
+      renders = cache.RenderCache(budget=10)
+      renders.set('a', u'12345')
+      renders.set('b', (u'123', u'45'))
+      assert renders.get('a') == u'12345'
+
+      renders.set('c', u'zz')
+      assert renders.get('b') is None and renders.size == 7
+      assert renders.set('d', u'x' * 11) and renders.get('d') is None
+
+    def test_invalidate(self):
+
+      ''' tagged entries are dropped together '''
+
+      renders = cache.RenderCache()
+      renders.set('a', u'1', tags=('home',))
+      renders.set('b', u'2', tags=('home', 'services'))
+      renders.set('c', u'3')
+
+      assert renders.invalidate('home') == 2
+      assert renders.get('c') == u'3' and len(renders) == 1 and not renders.tags
+
+    def test_key(self):
+
+      ''' keys are stable across equal values, and refuse unstable ones '''
+
+      assert cache.RenderCache.key('page', [('user', {'b': 1, 'a': 2})]) == (
+        cache.RenderCache.key('page', [('user', {'a': 2, 'b': 1})]))
+      self.assertRaises(TypeError, cache.RenderCache.key, 'page', [('user', object())])
+
+
+  class IngestTest(test.FrameworkTest):
+
+    ''' tests columnar event buffering '''
+
+    def test_columns_align(self):
+
+      ''' dimension columns stay aligned with the timestamp column '''
+
+      buf = ingest.EventBuffer('pageview')
+      buf.extend([1.0, 2.0], None, {'page': ['/', '/about']})
+      buf.append(3.0, 2.0, {'referrer': 'google'})
+
+      assert len(buf) == 3
+      assert len(buf.columns['page'].codes) == len(buf.columns['referrer'].codes) == 3
+      assert list(buf.rows())[2] == (3.0, 2.0, {'referrer': 'google'})
+
+    def test_flush_on_size(self):
+
+      ''' buffers are handed to sinks once they cross `flush_size` '''
+
+      flushed = []
+      ingestor = ingest.Ingestor(flush_size=3, flush_interval=0, sinks=[flushed.append])
+      ingestor.ingest('pageview', [1.0, 2.0])
+      assert not flushed
+
+      ingestor.ingest('pageview', [3.0])
+      assert len(flushed) == 1 and len(flushed[0]) == 3
+      assert 'pageview' not in ingestor.buffers
+
+
+  class RollupTest(test.FrameworkTest):
+
+    ''' tests time-bucketed rollup aggregation '''
+
+    def test_aggregate(self):
+
+      ''' events fold into per-period totals and dimension combinations '''
+
+      buf = ingest.EventBuffer('pageview')
+      buf.extend([0.0, 30.0, 90.0], [1.0, 1.0, 2.0], {'page': ['/', '/a', '/'], 'referrer': ['g', None, 'g']})
+      totals = rollups.Rollups(None).aggregate(buf)
+
+      assert totals['rollup:pageview:day:0'][''] == 4.0
+      assert totals['rollup:pageview:day:0']['page=%2F|referrer=g'] == 3.0
+      assert totals['rollup:pageview:minute:60'][''] == 2.0
+      assert totals['rollup:pageview:hour:0']['referrer=g'] == 3.0  # rows missing a dimension are skipped
+
+
+  class MetricsTest(test.FrameworkTest):
+
+    ''' tests RPC method metrics '''
+
+    def test_histogram(self):
+
+      ''' percentiles stay within the histogram's precision '''
+
+      histogram = metrics.Histogram()
+      for value in xrange(1, 100001): histogram.record(value)
+
+      for q in (50, 99, 99.9):
+        assert abs(histogram.percentile(q) - q * 1000) <= q * 1000 / 32.0, (q, histogram.percentile(q))
+      assert histogram.max == 100000 and histogram.percentile(100) == 100000
+
+    def test_shards(self):
+
+      ''' shards merge into a single summary '''
+
+      method = metrics.MethodMetrics('test.method')
+      shard = method.shard()
+      assert method.shard() is shard
+
+      shard.calls, shard.errors = 2, {'unauthorized': 1}
+      shard.latency.record(1500)
+      snapshot = method.snapshot()
+      assert snapshot['calls'] == 2 and snapshot['errors'] == {'unauthorized': 1}
+      assert snapshot['latency']['max'] == 1.5
+
+    def test_internal(self):
+
+      ''' internal endpoints want the token, even from localhost '''
+
+      from finnalytics import pages
+
+      request = lambda addr, token=None: type('Request', (object,), {
+        'remote_addr': addr, 'headers': {'X-Finna-Metrics': token} if token else {}})()
+
+      registry = metrics.metrics
+      saved = registry.token, registry.trust_local
+      try:
+        registry.token, registry.trust_local = 'secret', False
+        assert not pages.internal(request('127.0.0.1'))
+        assert not pages.internal(request('10.0.0.1', 'wrong'))
+        assert pages.internal(request('10.0.0.1', 'secret'))
+        assert pages.internal(request('10.0.0.1', u'secret'))
+
+        registry.token, registry.trust_local = None, True
+        assert pages.internal(request('127.0.0.1'))
+        assert not pages.internal(request('10.0.0.1', 'secret'))
+      finally:
+        registry.token, registry.trust_local = saved
+
+
+  class ProfilerTest(test.FrameworkTest):
+
+    ''' tests the sampling profiler middleware '''
+
+    def test_sample(self):
+
+      ''' flagged requests are sampled and counted by route '''
+
+      prof = profiler.Profiler(enable=True, rate=0, token='secret')
+      prof.label = lambda environ: environ['PATH_INFO']
+      prof.start = lambda: None
+
+      def app(environ, start_response):
+        prof.sample()
+        return ['ok']
+
+      wrapped = prof.wrap(app)
+      for flag in (None, 'wrong', 'secret'):
+        environ = {'PATH_INFO': '/'} if flag is None else {'PATH_INFO': '/', 'HTTP_X_FINNA_PROFILE': flag}
+        assert list(wrapped(environ, None)) == ['ok']
+
+      assert prof.stacks.keys() == ['/'] and sum(prof.stacks['/'].values()) == 1
+      assert ':app;' in prof.stacks['/'].keys()[0] and not prof.active
+      assert profiler.Profiler().wrap(app) is app
+
+
+  class SessionTest(test.FrameworkTest):
+
+    ''' tests binary session cookies '''
+
+    def test_codec(self):
+
+      ''' session values survive the binary codec '''
+
+      value = {'uuid': 'deadbeef' * 8, 'n': [0, -7, 2 ** 40, 1.5, u'\u2603', 'abc', None, True]}
+      assert sessions.loads(sessions.dumps(value)) == value
+      assert len(sessions.dumps({'uuid': 'deadbeef' * 8})) < 64
+
+    def test_verify(self):
+
+      ''' tampered cookies are rejected, verified ones are cached '''
+
+      cookie = sessions.BinaryCookie({'uuid': 'abc'}, 'secret').serialize()
+      assert dict(sessions.BinaryCookie.unserialize(cookie, 'secret')) == {'uuid': 'abc'}
+      assert sessions.BinaryCookie.verified.get((cookie, 'secret')) == {'uuid': 'abc'}
+
+      assert not sessions.BinaryCookie.unserialize(cookie, 'other')
+      assert not sessions.BinaryCookie.unserialize(cookie[:-2] + 'AA', 'secret')
+
+    def test_legacy(self):
+
+      ''' ``json`` cookies still load in binary mode, which isn't the default '''
+
+      legacy = sessions.Cookies.get_mode('json')({'uuid': 'abc'}, 'secret').serialize()
+      assert dict(sessions.BinaryCookie.unserialize(legacy, 'secret')) == {'uuid': 'abc'}
+      assert not sessions.BinaryCookie.unserialize(legacy, 'other')
+      assert sessions.Cookies.get_mode('unknown') is sessions.Cookies.get_mode('json')
+
+
+  class RedisSessionTest(RedisTest):
+
+    ''' tests server-side sessions, against (fake) Redis '''
+
+    def setUp(self):
+
+      ''' build an engine, and stub requests and responses '''
+
+      super(RedisSessionTest, self).setUp()
+      self.engine = sessions.RedisSessions('redis', {'redis': {'prefix': 'session', 'key': 'sid'}}, None)
+      self.cookies = {}
+
+    def request(self, sid=None):
+
+      ''' stub a request carrying session cookie ``sid`` '''
+
+      return type('Request', (object,), {
+        'host': 'localhost:8080', 'cookies': {'sid': sid} if sid else {},
+        'set_session': lambda request, session, engine: session})()
+
+    def commit(self, session, sid=None):
+
+      ''' commit ``session``, returning the cookie set for it (if any) '''
+
+      response = type('Response', (object,), {'set_cookie': lambda response, name, value, **kwargs: (
+        self.cookies.__setitem__(name, value))})()
+      self.cookies.clear()
+      self.engine.commit(self.request(sid), response, session)
+      return self.cookies.get('sid')
+
+    def stored(self):
+
+      ''' every key stored on any server '''
+
+      return dict((name, server.keys('*')) for name, server in self.servers.items() if server.keys('*'))
+
+    def test_lazy(self):
+
+      ''' untouched sessions never reach Redis, and aren't established '''
+
+      fetched = []
+      self.engine.fetch = lambda id: fetched.append(id)
+
+      session = self.engine.load(self.request('unknown'), None)
+      assert not session.loaded and self.commit(session, 'unknown') is None
+      assert fetched == [] and self.stored() == {}
+
+      session = self.engine.load(self.request(), None)
+      assert self.commit(session) is None and self.stored() == {}
+
+    def test_dirty(self):
+
+      ''' sessions are written back only when their data changed '''
+
+      session = self.engine.load(self.request(), None)
+      session.set('uuid', 'abc')
+      sid = self.commit(session)
+      assert sid and self.engine.fetch(sid)
+
+      key = self.engine.key(sid)
+      server = self.servers[self.pools.server_for(key)]
+      server.set(key, sessions.dumps({'uuid': 'stale'}))
+
+      session = self.engine.load(self.request(sid), None)
+      assert session.data == {'uuid': 'stale'} and not session.dirty
+      assert self.commit(session, sid) is None and sessions.loads(server.get(key)) == {'uuid': 'stale'}
+
+      session.set('uuid', 'def')
+      assert session.dirty and self.commit(session, sid) is None
+      assert sessions.loads(server.get(key)) == {'uuid': 'def'}
+
+      session.reset()
+      self.commit(session, sid)
+      assert not server.exists(key)
+
+    def test_sharding(self):
+
+      ''' session bodies are stored by, and read back from, the server owning their key '''
+
+      self.pools.ring = pool.Ring({self.pools.default: 1, 'other': 1})
+      ids = []
+      for n in xrange(20):
+        session = self.engine.load(self.request(), None)
+        session.set('n', n)
+        ids.append(self.commit(session))
+
+      for n, sid in enumerate(ids):
+        key, owner = self.engine.key(sid), self.pools.server_for(self.engine.key(sid))
+        assert [name for name, keys in self.stored().items() if key in keys] == [owner]
+        assert self.engine.load(self.request(sid), None).data == {'n': n}
+      assert set(self.stored()) == {self.pools.default, 'other'}
+
+
+  class SketchTest(test.FrameworkTest):
+
+    ''' tests probabilistic sketches '''
+
+    def test_hyperloglog(self):
+
+      ''' merged distinct counts survive a round trip through bytes '''
+
+      monday, tuesday = sketches.HyperLogLog(), sketches.HyperLogLog()
+      monday.update('visitor-%s' % i for i in xrange(10000))
+      tuesday.update('visitor-%s' % i for i in xrange(5000, 15000))
+
+      week = sketches.loads(sketches.merge([monday, tuesday]).dumps())
+      assert abs(week.cardinality() - 15000) < 15000 * 0.03
+
+    def test_count_min(self):
+
+      ''' frequency estimates never undercount '''
+
+      counts = sketches.CountMin(width=256, depth=4)
+      for i in xrange(2000):
+        counts.add('/page/%s' % (i % 50))
+      counts.add('/', 1000)
+
+      assert counts.estimate('/') >= 1000
+      assert sketches.loads(counts.dumps()).estimate('/') == counts.estimate('/')
+
+    def test_space_saving(self):
+
+      ''' heavy hitters are retained within a bounded summary '''
+
+      top = sketches.SpaceSaving(capacity=5)
+      for i in xrange(1000):
+        top.add('/' if i % 2 else '/page/%s' % i)
+
+      assert len(top.counts) == 5
+      assert top.top(1)[0][0] == u'/'
+      assert sketches.loads(top.dumps()).top(1) == top.top(1)
+
+
+  class QueryTest(test.FrameworkTest):
+
+    ''' tests vectorized query execution '''
+
+    def test_group_by(self):
+
+      ''' aggregates are computed per group across concatenated tables '''
+
+      first, second = ingest.EventBuffer('pageview'), ingest.EventBuffer('pageview')
+      first.extend([0.0, 10.0, 70.0], [1.0, 2.0, 3.0], {'page': ['/', '/a', '/']})
+      second.extend([100.0, 200.0], [4.0, 5.0], {'page': ['/a', '/a']})
+
+      table = query.Table.concat([query.Table.from_buffer(first), query.Table.from_buffer(second)])
+      results = query.Query(group_by=['page'], aggregates=['count', 'sum', 'min:value', 'max:timestamp']).execute(table)
+
+      assert results == [['/', 2, 4.0, 1.0, 70.0], ['/a', 3, 11.0, 2.0, 200.0]]
+
+    def test_filters(self):
+
+      ''' filters narrow rows before aggregation '''
+
+      buf = ingest.EventBuffer('pageview')
+      buf.extend([0.0, 60.0, 120.0], [1.0, 2.0, 3.0], {'page': ['/', '/a', '/a']})
+
+      table = query.Table.from_buffer(buf)
+      assert query.Query([('page', '==', '/a'), ('value', '>', 2)], aggregates=['count']).execute(table) == [[1]]
+      assert query.Query([('page', 'in', ['/missing'])], group_by=['page']).execute(table) == []
+
+    def test_empty(self):
+
+      ''' an empty table has a count and sum, but no average or extremes '''
+
+      assert query.Query(aggregates=['count', 'sum', 'avg', 'min', 'max']).execute(query.Table()) == [
+        [0, 0.0, None, None, None]]
+
+    def test_invalid(self):
+
+      ''' unknown aggregates and metric columns are rejected up front '''
+
+      for spec in ('median', 'sum:bogus', 'max:page'):
+        self.assertRaises(ValueError, query.Query, aggregates=[spec])
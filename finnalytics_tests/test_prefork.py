@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+'''
+
+  prefork tests
+  ~~~~~~~~~~~~~
+
+  :author: Sam Gammon <sam@momentum.io>
+  :author: Ian Weisberger <ian@momentum.io>
+  :author: David Rekow <david@momentum.io>
+  :copyright: (c) momentum labs, 2014
+  :license: The inspection, use, distribution, modification or implementation
+            of this source code is governed by a private license - all rights
+            are reserved by the Authors (collectively, "momentum labs") and held
+            under relevant California and US Federal Copyright laws. For full
+            details, see ``LICENSE.md`` at the root of this project. Continued
+            inspection of this source code demands agreement with the included
+            license and explicitly means acceptance to these terms.
+
+'''
+
+
+if __debug__:
+
+  # stdlib
+  import os
+  import time
+  import errno
+
+  # canteen testing
+  from canteen import test
+
+  # finnalytics
+  from finnalytics import dispatch
+
+  # scripts
+  from scripts import prefork
+
+
+  class EngineTest(test.FrameworkTest):
+
+    ''' tests resolving gevent servers for each engine '''
+
+    def test_fallback(self):
+
+      ''' every engine resolves, even where ``gevent.wsgi`` is gone '''
+
+      from gevent import pywsgi
+
+      for engine in dispatch.ENGINES:
+        assert dispatch.server(engine) is pywsgi.WSGIServer, engine
+      self.assertRaises(KeyError, dispatch.server, 'unknown')
+
+
+  class ArbiterTest(test.FrameworkTest):
+
+    ''' tests the prefork master's bookkeeping, with exits stubbed in place of forked workers '''
+
+    def setUp(self):
+
+      ''' stub ``os.waitpid`` in the prefork module '''
+
+      self.exits, self.os = [], prefork.os
+      prefork.os = type('os', (object,), {'waitpid': staticmethod(self.waitpid), 'WNOHANG': os.WNOHANG})
+
+    def tearDown(self):
+
+      ''' restore ``os`` '''
+
+      prefork.os = self.os
+
+    def waitpid(self, pid, options):
+
+      ''' report the next stubbed ``(pid, status)`` exit, then ``ECHILD`` '''
+
+      if not self.exits: raise OSError(errno.ECHILD, 'No child processes')
+      return self.exits.pop(0)
+
+    def test_backoff(self):
+
+      ''' workers failing as they start back off respawning, exponentially, up to 30s '''
+
+      arbiter, now, spawned = prefork.Arbiter(workers=2), time.time(), []
+      arbiter.spawn = lambda: (spawned.append(True), arbiter.workers.__setitem__(len(spawned) + 100, time.time()))
+      arbiter.workers = {1: now, 2: now, 3: now - 60}
+
+      self.exits = [(1, 256)]
+      arbiter.reap()
+      assert arbiter.failures == 1 and 1 not in arbiter.workers
+      assert now + 1 < arbiter.backoff <= time.time() + 2
+
+      arbiter.maintain()
+      assert spawned == []  # still backing off
+
+      self.exits = [(2, 256), (0, 0)]
+      arbiter.reap()
+      assert arbiter.failures == 2 and arbiter.backoff > now + 3
+
+      arbiter.failures = 10
+      arbiter.workers[4] = time.time()
+      self.exits = [(4, 256)]
+      arbiter.reap()
+      assert time.time() + 29 < arbiter.backoff <= time.time() + 30
+
+      self.exits = [(3, 256), (99, 256)]  # long-lived, then unknown (retired by a reload)
+      arbiter.reap()
+      assert arbiter.failures == 0 and arbiter.workers == {}
+
+      arbiter.backoff = 0
+      arbiter.maintain()
+      assert len(spawned) == 2 and len(arbiter.workers) == 2
+
+    def test_stopping(self):
+
+      ''' exits while stopping don't count as failures '''
+
+      arbiter = prefork.Arbiter()
+      arbiter.workers, arbiter.stopping = {1: time.time()}, True
+      self.exits = [(1, 256)]
+      arbiter.reap()
+      assert arbiter.failures == 0 and arbiter.workers == {}
+
+
+  class WorkerTest(test.FrameworkTest):
+
+    ''' tests worker retirement, against a stub server '''
+
+    def worker(self, **options):
+
+      ''' build a worker around a stub app and server '''
+
+      worker, self.stopped = prefork.Worker(lambda environ, start_response: ['ok'], None, **options), []
+      worker.server = type('Server', (object,), {'stop': lambda server, timeout=None: self.stopped.append(timeout)})()
+      return worker
+
+    def test_max_requests(self):
+
+      ''' workers retire once they've served ``max_requests`` '''
+
+      import gevent
+
+      worker = self.worker(max_requests=2, grace=5)
+      assert worker.dispatch({}, None) == ['ok'] and not worker.retiring
+      assert worker.dispatch({}, None) == ['ok'] and worker.retiring and worker.served == 2
+
+      gevent.sleep(0)
+      assert self.stopped == [5]
+
+      worker.dispatch({}, None)
+      gevent.sleep(0)
+      assert self.stopped == [5]  # only stopped once
+
+    def test_max_memory(self):
+
+      ''' workers retire once resident memory passes ``max_memory`` '''
+
+      import gevent
+
+      worker, rss = self.worker(max_memory=64 << 20, check=0), prefork.rss
+      try:
+        prefork.rss = lambda: 128 << 20
+        worker.watch()
+      finally:
+        prefork.rss = rss
+
+      gevent.sleep(0)
+      assert worker.retiring and self.stopped == [30]
@@ -0,0 +1,472 @@
+# -*- coding: utf-8 -*-
+
+'''
+
+  storage tests
+  ~~~~~~~~~~~~~
+
+  :author: Sam Gammon <sam@momentum.io>
+  :author: Ian Weisberger <ian@momentum.io>
+  :author: David Rekow <david@momentum.io>
+  :copyright: (c) momentum labs, 2014
+  :license: The inspection, use, distribution, modification or implementation
+            of this source code is governed by a private license - all rights
+            are reserved by the Authors (collectively, "momentum labs") and held
+            under relevant California and US Federal Copyright laws. For full
+            details, see ``LICENSE.md`` at the root of this project. Continued
+            inspection of this source code demands agreement with the included
+            license and explicitly means acceptance to these terms.
+
+'''
+
+
+if __debug__:
+
+  # stdlib
+  import os
+  import csv
+  import json
+  import errno
+  import pickle
+  import shutil
+  import tempfile
+  import cStringIO
+
+  # numpy
+  import numpy
+
+  # canteen testing
+  from canteen import test
+  from canteen import model
+
+  # finnalytics testing
+  from finnalytics_tests import RedisTest
+
+  # finnalytics
+  from finnalytics import base
+  from finnalytics import models
+  from finnalytics.services import read
+  from finnalytics.services import write
+  from finnalytics.logic import ingest
+  from finnalytics.logic import query
+  from finnalytics.storage import pool
+  from finnalytics.storage import segments
+  from finnalytics.storage import wal
+
+
+  class RingTest(test.FrameworkTest):
+
+    ''' tests consistent-hash sharding '''
+
+    def test_hashtag(self):
+
+      ''' keys sharing a ``{tag}`` are owned by the same server '''
+
+      ring = pool.Ring({'a': 1, 'b': 1, 'c': 1})
+      assert ring.node('{group}one') == ring.node('{group}two') == ring.node('group')
+      assert pool.hashtag('{}key') == '{}key'
+
+    def test_add(self):
+
+      ''' adding a server only moves keys onto that server '''
+
+      keys = ['key:%s' % i for i in xrange(5000)]
+      before = pool.Ring({'a': 1, 'b': 1, 'c': 1})
+      after = before.add('d')
+
+      moved = [key for key in keys if before.node(key) != after.node(key)]
+      assert set(after.node(key) for key in moved) == set(['d'])
+      assert 0.15 < len(moved) / float(len(keys)) < 0.35
+
+
+  class BulkModel(base.BaseModel):
+
+    ''' model bulk-written to (fake) Redis '''
+
+    __adapter__ = 'RedisAdapter'
+
+    name = basestring
+    value = int
+
+
+  class BulkTest(RedisTest):
+
+    ''' tests pipelined bulk operations against ``RedisAdapter`` '''
+
+    def test_put_get_multi(self):
+
+      ''' entities saved with ``put`` are read by ``get_multi`` '''
+
+      keys = [BulkModel(key=model.Key(BulkModel, 'one'), name=u'one', value=1).put(),
+              BulkModel(name=u'two', value=2).put()]
+      one, two, missing = BulkModel.get_multi(keys + [model.Key(BulkModel, 'missing')])
+      assert (one.name, one.value, two.name, two.value, missing) == (u'one', 1, u'two', 2, None)
+
+    def test_put_multi_get(self):
+
+      ''' entities saved with ``put_multi`` are read by ``get``, and take
+          IDs from the adapter's own counter '''
+
+      first = BulkModel(name=u'first', value=0).put()
+      keys = BulkModel.put_multi([BulkModel(name=u'bulk', value=i) for i in xrange(3)])
+      after = BulkModel(name=u'after', value=4).put()
+
+      assert [key.id for key in keys] == [first.id + 1, first.id + 2, first.id + 3]
+      assert after.id == first.id + 4
+      assert [BulkModel.get(key).value for key in keys] == [0, 1, 2]
+
+    def test_delete_multi(self):
+
+      ''' ``delete_multi`` removes entities saved with ``put`` '''
+
+      key = BulkModel(name=u'gone', value=1).put()
+      assert BulkModel.delete_multi([key, model.Key(BulkModel, 'missing')]) == [True, False]
+      assert BulkModel.get(key) is None
+
+
+  class ShardTest(RedisTest):
+
+    ''' tests sharding models and keys across (fake) Redis servers '''
+
+    class Dumping(object):
+
+      ''' mixin for ``fakeredis``, which lacks ``DUMP`` and ``RESTORE`` '''
+
+      def dump(self, name):
+        return pickle.dumps(self._db[name]) if name in self._db else None
+
+      def restore(self, name, ttl, value, replace=False):
+        self._db[name] = pickle.loads(value)
+        return True
+
+    def server(self, singleton=False):
+
+      ''' build a fake server that can ``DUMP`` and ``RESTORE`` '''
+
+      import fakeredis
+      return type('DumpingRedis', (self.Dumping, fakeredis.FakeStrictRedis), {})(singleton=singleton)
+
+    def test_routing(self):
+
+      ''' entities are stored by the server owning their root, and read back from it '''
+
+      self.pools.ring = pool.Ring({self.pools.default: 1, 'other': 1})
+      roots = [model.Key(BulkModel, 'root-%s' % i) for i in xrange(20)]
+      entities = [BulkModel(key=key, name=u'root', value=1) for key in roots] + [
+        BulkModel(key=model.Key(BulkModel, 'child', parent=key), name=u'child', value=2) for key in roots]
+      keys = BulkModel.put_multi(entities)
+
+      for key in keys:
+        owner = self.pools.ring.node('{%s}' % key.ancestry.next().urlsafe())
+        assert self.servers[owner].get(key.urlsafe()) is not None
+        assert self.servers[({self.pools.default, 'other'} - {owner}).pop()].get(key.urlsafe()) is None
+      assert set(self.pools.ring.node(BulkModel._shard(key)) for key in keys) == {self.pools.default, 'other'}
+
+      assert [entity.name for entity in BulkModel.get_multi(keys)] == [u'root'] * 20 + [u'child'] * 20
+      assert BulkModel.get(keys[-1]).value == 2 and BulkModel.get(name='root-0').value == 1
+      assert BulkModel.get(keys[-1]).delete() and BulkModel.get(keys[-1]) is None
+
+    def test_rebalance(self):
+
+      ''' rebalancing onto a new server moves the owned keys it now owns, and nothing else '''
+
+      source = self.servers[self.pools.default] = self.server(singleton=True)  # shared with the adapter
+      target = self.servers['other'] = self.server()
+      self.pools.own('owned:*')
+
+      names = ['%s' % i for i in xrange(200)]
+      for name in names:
+        source.set('owned:' + name, name)
+        source.set('loose:' + name, name)
+      keys = BulkModel.put_multi([BulkModel(name=u'bulk', value=i) for i in xrange(50)])
+
+      moved = self.pools.rebalance('other', {})
+      ring = self.pools.ring
+      owned = [name for name in names if ring.node('owned:' + name) == 'other']
+      entities = [key for key in keys if ring.node(BulkModel._shard(key)) == 'other']
+
+      assert owned and entities and moved == len(owned) + len(entities)
+      for name in names:
+        assert (target if name in owned else source).get('owned:' + name) == name
+        assert source.get('loose:' + name) == name and target.get('loose:' + name) is None
+      assert all(target.get(key.urlsafe()) and source.get(key.urlsafe()) is None for key in entities)
+      assert [entity.value for entity in BulkModel.get_multi(keys)] == range(50)
+
+
+  class SegmentTest(test.FrameworkTest):
+
+    ''' tests memory-mapped event segments '''
+
+    def setUp(self):
+
+      ''' make a scratch segment store '''
+
+      self.root = tempfile.mkdtemp()
+      self.store = segments.SegmentStore(self.root)
+
+    def tearDown(self):
+
+      ''' clean up the scratch segment store '''
+
+      shutil.rmtree(self.root)
+
+    def test_round_trip(self):
+
+      ''' sealed segments read back sorted, as views over the mapping '''
+
+      buf = ingest.EventBuffer('pageview')
+      buf.extend([50.0, 10.0, 70.0], [1.0, 2.0, 3.0], {'page': ['/', '/a', None]})
+      self.store.seal('pageview', query.Table.from_buffer(buf))
+
+      table, = self.store.tables('pageview')
+      assert list(table.metrics['timestamp']) == [10.0, 50.0, 70.0]
+      assert table.metrics['timestamp'].base is not None  # a view, not a copy
+      assert query.Query(group_by=['page'], aggregates=['sum']).execute(table) == [
+        [None, 3.0], [u'/', 1.0], [u'/a', 2.0]]
+
+    def test_pruning(self):
+
+      ''' segments outside the requested range are never opened '''
+
+      buf = ingest.EventBuffer('pageview')
+      buf.extend([100.0, 200.0])
+      self.store.seal('pageview', query.Table.from_buffer(buf))
+
+      assert len(self.store.segments('pageview', 0, 100)) == 0
+      assert len(self.store.segments('pageview', 201, 300)) == 0
+      assert len(self.store.segments('pageview', 150, 160)) == 1
+
+    def test_rejects(self):
+
+      ''' negative timestamps and dimensions named for built-in columns are refused '''
+
+      early = query.Table({'timestamp': numpy.array([-100.0, 100.0]), 'value': numpy.ones(2)})
+      shadowing = query.Table({'timestamp': numpy.ones(1), 'value': numpy.ones(1)}, {
+        'value': ([None, u'/'], numpy.ones(1, numpy.uint32))})
+
+      self.assertRaises(ValueError, self.store.seal, 'pageview', early)
+      self.assertRaises(ValueError, self.store.seal, 'pageview', shadowing)
+      self.assertRaises(ValueError, ingest.EventBuffer('pageview').extend, [-100.0])
+      self.assertRaises(ValueError, ingest.EventBuffer('pageview').extend, [1.0], None, {'timestamp': ['/']})
+
+
+  class ArchiveTest(RedisTest):
+
+    ''' tests archiving persisted batches into segments '''
+
+    def setUp(self):
+
+      ''' back ``EventBatch`` with (fake) Redis and a scratch segment store '''
+
+      super(ArchiveTest, self).setUp()
+      self.root, self.original = tempfile.mkdtemp(), models.EventBatch.__adapter__
+      self.store, models.EventBatch.__adapter__ = segments.SegmentStore(self.root), BulkModel.__adapter__
+
+    def tearDown(self):
+
+      ''' restore ``EventBatch``'s adapter and clean up the segment store '''
+
+      models.EventBatch.__adapter__ = self.original
+      shutil.rmtree(self.root)
+      super(ArchiveTest, self).tearDown()
+
+    def test_archive(self):
+
+      ''' batches written by the persist sink move into one segment, once '''
+
+      for timestamps in ([10.0, 20.0], [30.0], [500.0]):
+        buf = ingest.EventBuffer('pageview')
+        buf.extend(timestamps, None, {'page': ['/'] * len(timestamps)})
+        write.persist(buf)
+
+      segment = write.archive('pageview', 100.0, store=self.store)
+      assert list(segment.table().metrics['timestamp']) == [10.0, 20.0, 30.0]
+      keys = models.EventBatch.query().filter(models.EventBatch.type == 'pageview').fetch(keys_only=True)
+      batches = filter(None, models.EventBatch.get_multi(keys))  # indexes outlive deletes
+      assert [batch.start for batch in batches] == [500.0]
+      assert write.archive('pageview', 100.0, store=self.store) is None
+
+
+  class ExportTest(RedisTest):
+
+    ''' tests streaming raw events out of segments and the ingest buffer '''
+
+    def setUp(self):
+
+      ''' seal one segment, persist one batch, and buffer more events in memory '''
+
+      super(ExportTest, self).setUp()
+      self.root, self.original = tempfile.mkdtemp(), (models.EventBatch.__adapter__, read.segments)
+      models.EventBatch.__adapter__, read.segments = BulkModel.__adapter__, segments.SegmentStore(self.root)
+
+      sealed = ingest.EventBuffer('export')
+      sealed.extend([10.0, 20.0], [1.0, 2.0], {'page': ['/a', '/b']})
+      read.segments.seal('export', query.Table.from_buffer(sealed))
+
+      persisted = ingest.EventBuffer('export')
+      persisted.extend([25.0], [4.0], {'page': ['/c']})
+      write.persist(persisted)
+
+      buffered = ingest.EventBuffer('export')
+      buffered.extend([30.0], [3.0], {'ref': [u'say "hi", \u2603']})
+      with write.ingestor.lock:
+        write.ingestor.buffers['export'] = buffered
+
+    def tearDown(self):
+
+      ''' drop the buffer, and restore the segment store and ``EventBatch``'s adapter '''
+
+      with write.ingestor.lock:
+        write.ingestor.buffers.pop('export', None)
+      models.EventBatch.__adapter__, read.segments = self.original
+      shutil.rmtree(self.root)
+      super(ExportTest, self).tearDown()
+
+    def test_rows(self):
+
+      ''' each table's rows come out in chunks, with its own dimensions '''
+
+      assert list(read.rows('export', chunk=1)) == [
+        (['page'], [(10.0, 1.0, '/a')]), (['page'], [(20.0, 2.0, '/b')]),
+        (['page'], [(25.0, 4.0, '/c')]), (['ref'], [(30.0, 3.0, u'say "hi", \u2603')])]
+      assert list(read.rows('export', 15.0, 30.0, names=['page', 'ref'])) == [
+        (['page', 'ref'], [(20.0, 2.0, '/b', None)]), (['page', 'ref'], [(25.0, 4.0, '/c', None)])]
+      assert [row for names, chunk in read.rows('export', 26.0, 27.0) for row in chunk] == []
+
+    def test_ndjson(self):
+
+      ''' NDJSON has one object per event, without missing dimensions '''
+
+      lines = ''.join(read.export('export', format='ndjson')).splitlines()
+      assert [json.loads(line) for line in lines] == [
+        {'timestamp': 10.0, 'value': 1.0, 'page': '/a'},
+        {'timestamp': 20.0, 'value': 2.0, 'page': '/b'},
+        {'timestamp': 25.0, 'value': 4.0, 'page': '/c'},
+        {'timestamp': 30.0, 'value': 3.0, 'ref': u'say "hi", \u2603'}]
+
+    def test_csv(self):
+
+      ''' CSV has one header for every dimension, and quotes values as needed '''
+
+      rows = list(csv.reader(cStringIO.StringIO(''.join(read.export('export', format='csv')))))
+      assert rows == [
+        ['timestamp', 'value', 'page', 'ref'],
+        ['10.0', '1.0', '/a', ''],
+        ['20.0', '2.0', '/b', ''],
+        ['25.0', '4.0', '/c', ''],
+        ['30.0', '3.0', '', u'say "hi", \u2603'.encode('utf-8')]]
+      assert '"say ""hi"", \xe2\x98\x83"' in ''.join(read.export('export', format='csv'))
+
+    def test_page(self):
+
+      ''' the export page wants the metrics token, and streams the chosen format '''
+
+      from finnalytics import pages
+      from finnalytics.logic import metrics
+
+      def get(format, token=None, **args):
+        responses = []
+        page = type('Page', (object,), {
+          'request': type('Request', (object,), {
+            'remote_addr': '127.0.0.1', 'args': args, 'headers': {'X-Finna-Metrics': token} if token else {}})(),
+          'http': type('HTTP', (object,), {
+            'new_response': staticmethod(lambda *body, **kwargs: responses.append((body, kwargs)))})()})()
+        pages.Export.GET.im_func(page, 'export', format)
+        return responses[0]
+
+      registry = metrics.metrics
+      saved = registry.token, registry.trust_local
+      try:
+        registry.token, registry.trust_local = 'secret', False
+        assert get('csv') == ((), {'status': '403 Forbidden'})
+        assert get('csv', 'wrong') == ((), {'status': '403 Forbidden'})
+        assert get('xml', 'secret') == ((), {'status': '404 Not Found'})
+        assert get('csv', 'secret', start='soon') == ((), {'status': '400 Bad Request'})
+
+        (body,), kwargs = get('ndjson', 'secret', start='15')
+        assert kwargs['content_type'] == 'application/x-ndjson' and kwargs['direct_passthrough']
+        assert [json.loads(line)['timestamp'] for line in ''.join(body).splitlines()] == [20.0, 25.0, 30.0]
+      finally:
+        registry.token, registry.trust_local = saved
+
+
+  class WriteAheadLogTest(test.FrameworkTest):
+
+    ''' tests the ingest write-ahead log '''
+
+    def setUp(self):
+
+      ''' make a scratch log directory '''
+
+      self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+
+      ''' clean up the scratch log directory '''
+
+      shutil.rmtree(self.root)
+
+    def test_recover(self):
+
+      ''' events buffered by a dead process are replayed, flushed ones are not '''
+
+      log = wal.WriteAheadLog(self.root, window=0)
+      ingestor = ingest.Ingestor(flush_size=2, flush_interval=0, log=log)
+      ingestor.write([('pageview', [1.0, 2.0], None, {})])  # flushed, and checkpointed
+      ingestor.write([('pageview', [3.0], None, {'page': ['/']})])
+      log.owner.close()  # as if its process had died
+
+      flushed = []
+      recovering = ingest.Ingestor(log=wal.WriteAheadLog(self.root), sinks=[flushed.append])
+      assert recovering.recover() == 1 and not os.path.exists(log.path)
+      assert [(list(buf.timestamps), buf.columns['page'].symbols) for buf in flushed] == [([3.0], [None, '/'])]
+
+    def test_torn(self):
+
+      ''' a failed write is cut back, and torn bytes only end their own file '''
+
+      class Torn(object):
+
+        ''' file that tears every write halfway through '''
+
+        def __init__(self, handle): self.handle, self.name = handle, handle.name
+        def fileno(self): return self.handle.fileno()
+        def close(self): self.handle.close()
+        def write(self, data):
+          self.handle.write(data[:len(data) // 2])
+          raise IOError(errno.ENOSPC, 'No space left on device')
+
+      log = wal.WriteAheadLog(self.root, window=0)
+      log.append({'n': 1})
+      log.handle = Torn(log.handle)
+      self.assertRaises(IOError, log.append, {'n': 2})
+      assert log.handle is None and log.size == 0
+      log.append({'n': 3})
+
+      first, second = [path for _, path in log.files(log.path)]
+      assert [record for _, record in log.read(log.path)] == [{'n': 1}, {'n': 3}]
+
+      # damage the older file: the newer one is still read
+      with open(first, 'ab') as handle: handle.write('torn')
+      assert [record for _, record in log.read(log.path)] == [{'n': 1}, {'n': 3}]
+
+    def test_failed_sink(self):
+
+      ''' a failing sink doesn't fail the write, and is retried on the next flush '''
+
+      flushed, broken = [], [True]
+
+      def sink(buf):
+        if broken[0]: raise IOError('datastore unavailable')
+        flushed.append(list(buf.timestamps))
+
+      log = wal.WriteAheadLog(self.root, window=0)
+      ingestor = ingest.Ingestor(flush_size=2, flush_interval=0, sinks=[sink], log=log)
+      assert ingestor.write([('pageview', [1.0, 2.0], None, {})]) == 2
+      assert not flushed and len(ingestor.failed) == len(ingestor.flushing) == 1
+      assert not os.path.exists(os.path.join(log.path, 'checkpoint'))  # pinned
+
+      broken[0] = False
+      assert ingestor.flush() == 2 and flushed == [[1.0, 2.0]]
+      assert not ingestor.failed and not ingestor.flushing
+      with open(os.path.join(log.path, 'checkpoint')) as handle: assert int(handle.read()) == 2
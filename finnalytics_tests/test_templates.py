@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+'''
+
+  template tests
+  ~~~~~~~~~~~~~~
+
+  :author: Sam Gammon <sam@momentum.io>
+  :author: Ian Weisberger <ian@momentum.io>
+  :author: David Rekow <david@momentum.io>
+  :copyright: (c) momentum labs, 2014
+  :license: The inspection, use, distribution, modification or implementation
+            of this source code is governed by a private license - all rights
+            are reserved by the Authors (collectively, "momentum labs") and held
+            under relevant California and US Federal Copyright laws. For full
+            details, see ``LICENSE.md`` at the root of this project. Continued
+            inspection of this source code demands agreement with the included
+            license and explicitly means acceptance to these terms.
+
+'''
+
+
+if __debug__:
+
+  # stdlib
+  import os
+  import sys
+  import types
+  import shutil
+  import tempfile
+
+  # jinja2
+  import jinja2
+
+  # canteen testing
+  from canteen import test
+
+  # finnalytics
+  from finnalytics import templates
+  from finnalytics.templates import extensions
+
+
+  class BundleTest(test.FrameworkTest):
+
+    ''' tests single-file compiled template bundles '''
+
+    def setUp(self):
+
+      ''' make a scratch package to install a bundle under '''
+
+      self.root = tempfile.mkdtemp()
+      self.package = sys.modules['_bundle_test'] = types.ModuleType('_bundle_test')
+      self.package.__file__ = os.path.join(self.root, '__init__.py')
+
+    def tearDown(self):
+
+      ''' clean up the scratch package and its templates '''
+
+      for name in [name for name in sys.modules if name.startswith('_bundle_test')]:
+        del sys.modules[name]
+      shutil.rmtree(self.root)
+
+    def test_install(self):
+
+      ''' bundled templates are importable and only executed on ``run`` '''
+
+      templates.dump({
+        'home': ('home.html', compile('ran = True\ndef run(environment): return environment', 'home', 'exec')),
+        'pages.about': ('pages/about.html', compile('def run(environment): return 1', 'about', 'exec'))
+      }, os.path.join(self.root, templates.BUNDLE))
+
+      assert templates.install('_bundle_test') == 2
+      home = getattr(__import__('_bundle_test', None, None, ['home']), 'home')
+      about = getattr(__import__('_bundle_test.pages', None, None, ['about']), 'about')
+
+      assert home.name == 'home.html' and not hasattr(home, 'ran')
+      assert home.run('env') == 'env' and home.ran
+      assert about.run(None) == 1
+
+
+  class FlushTest(test.FrameworkTest):
+
+    ''' tests flush points in streamed renders '''
+
+    @staticmethod
+    def template(source):
+
+      ''' compile ``source`` with the flush extension. canteen patches
+          jinja's code generator to wrap compiled templates in a
+          ``run(environment)`` function, so unwrap that if present. '''
+
+      environment = jinja2.Environment(autoescape=True, extensions=[extensions.FlushPoints])
+      namespace = {'environment': environment, '__file__': '<template>'}
+      exec environment.compile(source) in namespace
+
+      if 'run' in namespace:
+        namespace['root'], namespace['blocks'], namespace['debug_info'] = namespace['run'](environment)
+      return jinja2.Template._from_namespace(environment, namespace, environment.globals)
+
+    def test_flushed(self):
+
+      ''' streamed renders split at flush points, other renders ignore them '''
+
+      template = self.template(
+        u'<head></head>{% flush %}<body>{% for i in items %}{{ i }}{% flush %}{% endfor %}</body>')
+
+      assert template.render(items=[1, 2]) == u'<head></head><body>12</body>'
+      assert list(extensions.flushed(template.generate(items=[1, 2], streaming=True))) == [
+        u'<head></head>', u'<body>1', u'2', u'</body>']
+      assert list(extensions.flushed(template.generate(items=[1, 2], streaming=True), threshold=14)) == [
+        u'<head></head><body>1', u'2</body>']
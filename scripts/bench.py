@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+'''
+
+  load generator
+  ~~~~~~~~~~~~~~
+
+  :author: Sam Gammon <sam@momentum.io>
+  :author: Ian Weisberger <ian@momentum.io>
+  :author: David Rekow <david@momentum.io>
+  :copyright: (c) momentum labs, 2014
+  :license: The inspection, use, distribution, modification or implementation
+            of this source code is governed by a private license - all rights
+            are reserved by the Authors (collectively, "momentum labs") and held
+            under relevant California and US Federal Copyright laws. For full
+            details, see ``LICENSE.md`` at the root of this project. Continued
+            inspection of this source code demands agreement with the included
+            license and explicitly means acceptance to these terms.
+
+'''
+
+# stdlib
+import os
+import sys
+import json
+import time
+import errno
+import socket
+import signal
+import itertools
+
+# finnalytics
+from finnalytics.dispatch import server
+
+
+## Globals
+_RPC_PREFIX = '/_rpc/v1/'
+
+# default traffic: weighted page loads and RPC calls
+SCRIPT = (
+  {'path': '/', 'weight': 4},
+  {'rpc': 'write.ingest', 'weight': 4, 'request': {'batches': [{
+    'type': 'bench', 'timestamps': [1.0, 2.0, 3.0], 'dimensions': [{'name': 'page', 'values': ['/', '/a', '/']}]}]}},
+  {'rpc': 'read.query', 'weight': 2, 'request': {'type': 'bench', 'group_by': ['page'], 'aggregates': ['count']}}
+)
+
+
+def load_script(path=None):
+
+  ''' load a JSON list of calls to replay from ``path`` (or use the
+      default :py:data:`SCRIPT`), expanded by weight into a list of
+      ``(method, path, body, headers)`` requests. each call is either
+      ``{"path": ..., "method": ..., "body": ...}`` or ``{"rpc":
+      "<service>.<method>", "request": {...}}``, plus an optional
+      ``weight``. '''
+
+  calls = SCRIPT
+  if path:
+    with open(path) as handle: calls = json.load(handle)
+
+  requests = []
+  for call in calls:
+    if 'rpc' in call:
+      request = ('POST', _RPC_PREFIX + call['rpc'], json.dumps(call.get('request', {})),
+                 {'Content-Type': 'application/json'})
+    else:
+      body = call.get('body')
+      request = (call.get('method', 'POST' if body else 'GET').upper(), call['path'],
+                 body if body is None or isinstance(body, basestring) else json.dumps(body), call.get('headers', {}))
+    requests.extend([request] * int(call.get('weight', 1)))
+  return requests
+
+
+def serve(engine, port):
+
+  ''' serve ``finnalytics.dispatch.application`` on ``port`` with the
+      gevent server for ``engine``, forever. meant for a forked child. '''
+
+  import gevent
+  from gevent import monkey
+  gevent.reinit()
+  monkey.patch_all()
+
+  from finnalytics.config import config
+  config.config.setdefault('streaming', {})['enable'] = engine == 'stream'
+
+  from finnalytics import dispatch
+  application = dispatch.load()
+  listener = socket.socket()
+  listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+  listener.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+  listener.bind(('127.0.0.1', port))
+  listener.listen(1024)
+  cls = server(engine)
+  options = {'log': None} if cls.__module__ == 'gevent.pywsgi' else {}
+  cls(listener, application, **options).serve_forever()
+
+
+def wait(port, timeout=30.0):
+
+  ''' block until something accepts connections on ``port`` '''
+
+  deadline = time.time() + timeout
+  while True:
+    try:
+      socket.create_connection(('127.0.0.1', port), 1.0).close()
+      return True
+    except socket.error:
+      if time.time() >= deadline: return False
+      time.sleep(0.05)
+
+
+def drive(port, requests, concurrency=16, total=2000):
+
+  ''' replay ``total`` of ``requests`` (round-robin) against ``port``
+      from ``concurrency`` keep-alive clients, returning the elapsed
+      seconds, a latency histogram (in microseconds) and a map of
+      error kinds (HTTP statuses or exception names) to counts. '''
+
+  import gevent
+  import httplib
+  from gevent import monkey
+  monkey.patch_all()
+
+  from finnalytics.logic.metrics import Histogram
+
+  counter, latency, errors = itertools.count(), Histogram(), {}
+
+  def connect():
+
+    ''' open a client connection, without Nagle's delay '''
+
+    connection = httplib.HTTPConnection('127.0.0.1', port)
+    connection.connect()
+    connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return connection
+
+  def client():
+
+    ''' issue requests until ``total`` have been sent '''
+
+    connection = connect()
+    for index in counter:
+      if index >= total: break
+      method, path, body, headers = requests[index % len(requests)]
+
+      start = time.time()
+      try:
+        connection.request(method, path, body, headers)
+        response = connection.getresponse()
+        response.read()
+      except (httplib.HTTPException, socket.error) as exc:
+        errors[type(exc).__name__] = errors.get(type(exc).__name__, 0) + 1
+        connection.close()
+        connection = connect()
+        continue
+
+      latency.record((time.time() - start) * 1e6)
+      if response.status >= 400: errors[response.status] = errors.get(response.status, 0) + 1
+    connection.close()
+
+  start = time.time()
+  gevent.joinall([gevent.spawn(client) for _ in xrange(concurrency)])
+  return time.time() - start, latency, errors
+
+
+def run(engine, port=8089, script=None, concurrency=16, total=2000):
+
+  ''' fork a server for ``engine`` and drive it with ``script``,
+      returning a summary of throughput and latency (in ms) '''
+
+  requests = load_script(script)
+  server(engine)  # fail here, rather than in the child, if the engine is unavailable
+
+  child = os.fork()
+  if not child:
+    try:
+      serve(engine, port)
+    finally:
+      os._exit(1)
+
+  try:
+    if not wait(port): raise RuntimeError('Engine "%s" never started listening on port %s.' % (engine, port))
+    drive(port, requests[:1], 1, 1)  # warm up imports, templates and connections
+    seconds, latency, errors = drive(port, requests, concurrency, total)
+  finally:
+    os.kill(child, signal.SIGTERM)
+    try:
+      os.waitpid(child, 0)
+    except OSError as exc:
+      if exc.errno != errno.ECHILD: raise
+
+  return {
+    'engine': engine,
+    'requests': total,
+    'concurrency': concurrency,
+    'seconds': seconds,
+    'throughput': total / seconds,
+    'errors': errors,
+    'latency': latency.summary(scale=1000)}
+
+
+def report(results, out=sys.stdout):
+
+  ''' print a table of ``results`` (from :py:func:`run`) to ``out`` '''
+
+  out.write('%-8s %10s %9s %9s %9s %9s %8s\n' % ('engine', 'req/s', 'p50 ms', 'p99 ms', 'p999 ms', 'max ms', 'errors'))
+  for result in results:
+    latency = result['latency']
+    out.write('%-8s %10.1f %9.2f %9.2f %9.2f %9.2f %8d\n' % (
+      result['engine'], result['throughput'], latency['p50'], latency['p99'], latency['p999'], latency['max'],
+      sum(result['errors'].values())))
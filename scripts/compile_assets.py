@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+'''
+
+  asset compiler
+  ~~~~~~~~~~~~~~
+
+  :author: Sam Gammon <sam@momentum.io>
+  :author: Ian Weisberger <ian@momentum.io>
+  :author: David Rekow <david@momentum.io>
+  :copyright: (c) momentum labs, 2014
+  :license: The inspection, use, distribution, modification or implementation
+            of this source code is governed by a private license - all rights
+            are reserved by the Authors (collectively, "momentum labs") and held
+            under relevant California and US Federal Copyright laws. For full
+            details, see ``LICENSE.md`` at the root of this project. Continued
+            inspection of this source code demands agreement with the included
+            license and explicitly means acceptance to these terms.
+
+'''
+
+# stdlib
+import os
+import re
+import sys
+import gzip
+import json
+import hashlib
+import multiprocessing
+
+
+## Globals
+_extra_paths = [
+  'finnalytics/',
+  'finnalytics/lib',
+  'lib/canteen'
+]
+
+for path in filter(lambda x: x not in sys.path, _extra_paths):
+  sys.path.insert(0, path)
+
+_GZIP_LEVEL = 9  # compressed once at build time, so spend the CPU
+_DIGEST_LENGTH = 12  # hex characters of the sha1 kept in fingerprinted names
+_COMPRESSIBLE = frozenset(('.css', '.js', '.map', '.svg', '.html', '.json', '.txt', '.xml', '.ico', '.eot', '.ttf'))
+_SOURCES = frozenset(('coffee', 'less', 'sass', 'scss'))  # directories of uncompiled sources, never served
+_fingerprinted = re.compile(r'\.[0-9a-f]{%s}\.[^./]+$' % _DIGEST_LENGTH)
+
+
+def _digest(source):
+
+  ''' content hash of the file at ``source`` '''
+
+  digest = hashlib.sha1()
+  with open(source, 'rb') as handle:
+    for block in iter(lambda: handle.read(1 << 16), ''):
+      digest.update(block)
+  return digest.hexdigest()[:_DIGEST_LENGTH]
+
+
+def _write(target, data):
+
+  ''' atomically write ``data`` to ``target`` '''
+
+  with open(target + '.tmp', 'wb') as handle:
+    handle.write(data)
+  os.rename(target + '.tmp', target)
+
+
+def _compress(data, level=_GZIP_LEVEL):
+
+  ''' gzip ``data`` at ``level``, with a zeroed timestamp so that
+      rebuilding unchanged content yields identical bytes '''
+
+  from cStringIO import StringIO
+
+  buf = StringIO()
+  with gzip.GzipFile(filename='', mode='wb', fileobj=buf, compresslevel=level, mtime=0) as handle:
+    handle.write(data)
+  return buf.getvalue()
+
+
+def compile_asset(job):
+
+  ''' fingerprint and compress a single asset. writes a copy named
+      for its content hash, plus a ``.gz`` variant of both names where
+      compressing is worth it, and returns its manifest entry. '''
+
+  root, name, level = job
+  source = os.path.join(root, name)
+  digest = _digest(source)
+
+  from finnalytics.logic.assets import fingerprinted
+  hashed = fingerprinted(name, digest)
+
+  with open(source, 'rb') as handle:
+    data = handle.read()
+
+  if not os.path.exists(os.path.join(root, hashed)):
+    _write(os.path.join(root, hashed), data)
+
+  compressed = None
+  if os.path.splitext(name)[1].lower() in _COMPRESSIBLE:
+    packed = _compress(data, level)
+    if len(packed) < len(data):
+      compressed = len(packed)
+      for target in (source, os.path.join(root, hashed)):
+        _write(target + '.gz', packed)
+
+  for target in (source, os.path.join(root, hashed)):
+    if compressed is None and os.path.exists(target + '.gz'):
+      os.remove(target + '.gz')  # stale variant from an older version
+
+  return name, {'path': hashed, 'hash': digest, 'size': len(data), 'gzip': compressed}
+
+
+def collect(root, previous=()):
+
+  ''' list the (relative) paths of every servable asset under
+      ``root``, skipping build outputs and uncompiled sources '''
+
+  from finnalytics.logic.assets import MANIFEST
+
+  outputs = frozenset(entry['path'] for entry in previous)
+  for directory, directories, files in os.walk(root):
+    relative = os.path.relpath(directory, root)
+    directories[:] = [name for name in directories if not (relative == '.' and name in _SOURCES)]
+
+    for filename in files:
+      name = os.path.normpath(os.path.join(relative, filename))
+      if (filename.startswith('.') or filename.endswith(('.gz', '.tmp')) or name == MANIFEST or
+          name in outputs or _fingerprinted.search(filename)):
+        continue
+      yield name
+
+
+def build(root, jobs=None, level=_GZIP_LEVEL):
+
+  ''' fingerprint and pre-compress every asset under ``root`` in
+      parallel, prune outputs from previous builds whose source has
+      changed or gone, and write the manifest. '''
+
+  from finnalytics.logic.assets import MANIFEST
+
+  target = os.path.join(root, MANIFEST)
+  previous = {}
+  if os.path.exists(target):
+    with open(target) as handle:
+      previous = json.load(handle).get('assets', {})
+
+  work = [(root, name, level) for name in sorted(collect(root, previous.values()))]
+  pool = multiprocessing.Pool(jobs or None) if len(work) > 1 else None
+  try:
+    entries = dict(pool.map(compile_asset, work) if pool else map(compile_asset, work))
+  finally:
+    if pool: pool.close(); pool.join()
+
+  current = frozenset(entry['path'] for entry in entries.itervalues())
+  for name, entry in previous.iteritems():
+    if entry['path'] not in current:
+      for stale in (entry['path'], entry['path'] + '.gz') + (() if name in entries else (name + '.gz',)):
+        if os.path.exists(os.path.join(root, stale)): os.remove(os.path.join(root, stale))
+
+  _write(target, json.dumps({'assets': entries}, indent=2, sort_keys=True))
+  print 'Compiled %s assets (%s compressed).' % (len(entries), sum(1 for e in entries.itervalues() if e['gzip']))
+  return entries
+
+
+def run(jobs=None, level=_GZIP_LEVEL):
+
+  ''' build the app's asset tree '''
+
+  from finnalytics.config import config
+  return build(config.app.get('paths', {}).get('assets'), jobs=jobs, level=level)
+
+
+if __name__ == '__main__':
+  run()
+
+
+__all__ = (
+  'compile_asset',
+  'collect',
+  'build',
+  'run'
+)
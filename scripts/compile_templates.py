@@ -22,11 +22,14 @@
 # stdlib
 import os
 import sys
+import shutil
 import jinja2
+import hashlib
 import py_compile
+import multiprocessing
 
 # jinja2 imports
-from jinja2 import nodes
+from jinja2 import meta, nodes
 from jinja2.nodes import EvalContext
 from jinja2._compat import iteritems
 from jinja2.ext import with_, autoescape, do, loopcontrols
@@ -56,6 +59,8 @@ _extensions = [with_, autoescape, do, loopcontrols]
 try:
     import hamlish_jinja
 except ImportError:
+    pass
+else:
     _extensions.append(hamlish_jinja.HamlishExtension)
 
 
@@ -152,15 +157,7 @@ def compile_dir(env, src_path, dst_path, pattern=r'^.*\.(html|js|haml|svg|css|sa
             _import_paths.append(_make_module_path(compile_file(env, src_name, dst_name, encoding=encoding,
                 base_dir=base_dir, as_module=as_module), _root_path))
 
-            file_path, file_name = tuple(dst_name.rsplit('/', 1))
-            source_path = os.path.join(file_path, '.'.join((file_name.rsplit('.', 1)[0], 'py')))
-
-            if not __debug__:
-                precompiled_path = os.path.join(file_path, '.'.join((file_name.rsplit('.', 1)[0], 'pyc' if sys.flags.optimize else 'pyo')))
-                try:
-                    py_compile.compile(source_path, precompiled_path)
-                except Exception:
-                    print "Failed to precompile: '%s'... Skipping..." % source_path
+            _precompile(dst_name)
 
         elif path.isfile(src_name) and not re.match(pattern, filename):
             # it's not a template, move it inline
@@ -168,28 +165,97 @@ def compile_dir(env, src_path, dst_path, pattern=r'^.*\.(html|js|haml|svg|css|sa
                 with open(src_name, 'rb') as staticread:
                     staticwrite.write(staticread.read())
 
-    _seen_submodules = set()
     if as_module and path.isdir(dst_path) and fill_init:
         # Go back and fill in __init__.py with subimports and preloading code
-        init = path.join(dst_path, '__init__.py')
-        with open(init, 'w') as init:
-            map(lambda line: init.write(line + "\n"), (
-                '# -*- coding: utf-8 -*-',
-                '',
-                "'''",
-                '',
-                '   compiled templates: %s' % _make_module_path(dst_path, _root_path),
-                '',
-                "'''",
-                '',
-                '# subtemplates',
-                '\n'.join(map(_make_import_statement, _import_paths)),
-                ''
-            ))
+        _write_init(dst_path, _import_paths, _root_path)
 
     return _import_paths
 
 
+def _precompile(dst_name):
+
+    """
+        Precompiles the module generated for a template to bytecode, as a
+        `.pyo` when running optimized (`-O`) and a `.pyc` otherwise, to match
+        what the interpreter that imports it will look for.
+
+        `dst_name`: destination path the template was compiled to.
+
+    """
+
+    file_path, file_name = tuple(dst_name.rsplit('/', 1))
+    source_path = os.path.join(file_path, '.'.join((file_name.rsplit('.', 1)[0], 'py')))
+    precompiled_path = source_path + ('o' if sys.flags.optimize else 'c')
+
+    try:
+        py_compile.compile(source_path, precompiled_path, doraise=True)
+    except py_compile.PyCompileError:
+        print "Failed to precompile: '%s'... Skipping..." % source_path
+
+
+def _write_init(dst_path, import_paths, root_path, bundle=False):
+
+    """
+        Writes an __init__.py for a compiled template package, importing
+        each of its compiled submodules.
+
+        `dst_path`: path to the compiled package directory.
+        `import_paths`: dotted module paths to import.
+        `root_path`: root file path for generating import statements
+        `bundle`: if True, the package installs its templates from a
+            template bundle instead of importing each submodule.
+
+    """
+
+    with open(path.join(dst_path, '__init__.py'), 'w') as init:
+        map(lambda line: init.write(line + "\n"), (
+            '# -*- coding: utf-8 -*-',
+            '',
+            "'''",
+            '',
+            '   compiled templates: %s' % _make_module_path(dst_path, root_path),
+            '',
+            "'''",
+            '',
+        ) + ((
+            '# bundled templates',
+            'from finnalytics import templates; templates.install(__name__)',
+            ''
+        ) if bundle else (
+            '# subtemplates',
+            '\n'.join(map(_make_import_statement, import_paths)),
+            ''
+        )))
+
+
+def write_bundle(target, templates):
+
+    """
+        Marshals every compiled template module into a single bundle file,
+        which the compiled package loads with one read at import time.
+
+        `target`: path to the compiled package directory.
+        `templates`: build manifest entries, by relative source name.
+
+        Returns the path to the bundle.
+
+    """
+
+    from finnalytics.templates import BUNDLE, dump
+
+    bundled = {}
+    for name, entry in templates.iteritems():
+        if 'dependencies' not in entry:
+            continue  # not a template
+
+        with open(entry['output'], 'r') as handle:
+            code = compile(handle.read(), entry['output'], 'exec')
+        bundled[_make_module_path(entry['output'], target)] = (name, code)
+
+    dump(bundled, path.join(target, BUNDLE))
+    return path.join(target, BUNDLE)
+
+
 def _visit_template_shim(self, node, frame=None):
     assert frame is None, 'no root frame allowed'
     eval_ctx = EvalContext(self.environment, self.name)
@@ -316,27 +382,263 @@ def load_environment():
     return core.TemplateAPI().environment(base.Handler(), config)
 
 
-def run(module=None, sources=None, target=None):
+def prepare_environment():
 
     '''  '''
 
-    import os
-    if not module or not sources or not target:
-        root = os.path.dirname(os.path.abspath(os.path.realpath(__file__)))  ## scripts/
-        root = os.path.dirname(root)  ## /
-
-        module, sources, target = root+'/finnalytics/templates', root+'/finnalytics/templates/source', root+'/finnalytics/templates/compiled'
-
     env = load_environment()
     for name, _filter in (
         ('json', json.dumps),
         ):
         env.filters[name] = _filter
+    return env
+
+
+## Incremental + parallel compilation
+_MANIFEST = '.manifest.json'
+_TEMPLATE_PATTERN = r'^.*\.(html|js|haml|svg|css|sass|less|scss|coffee)$'
+_worker_env = None
+
+
+def _hash_file(src_path):
+
+    """
+        Hashes the contents of a source file.
+
+    """
+
+    with open(src_path, 'rb') as handle:
+        return hashlib.sha1(handle.read()).hexdigest()
+
+
+def _compiler_fingerprint():
+
+    """
+        Fingerprints the compiler itself (this script, plus the Jinja2
+        version), so that changes to codegen invalidate every template.
+
+    """
+
+    source = path.abspath(__file__).replace('.pyc', '.py')
+    return hashlib.sha1(':'.join((jinja2.__version__, _hash_file(source)))).hexdigest()
+
+
+def scan_sources(sources, pattern=_TEMPLATE_PATTERN):
+
+    """
+        Lists every file under a source directory.
+
+        `sources`: path to the source directory.
+        `pattern`: a regular expression to match template file names.
+
+        Returns a dict of `relative name => (absolute path, is_template)`.
+
+    """
+
+    found = {}
+    for directory, _, filenames in os.walk(sources):
+        for filename in filenames:
+            src_name = path.join(directory, filename)
+            found[path.relpath(src_name, sources).replace(os.sep, '/')] = (src_name, bool(re.match(pattern, filename)))
+    return found
+
+
+def _destination(target, name, is_template):
+
+    """
+        Resolves the compiled output path for a relative source name,
+        replacing dashes the same way `compile_dir` does.
+
+    """
+
+    dst_name = path.join(target, *[part.replace('-', '_') for part in name.split('/')])
+    return (path.splitext(dst_name)[0] + '.py') if is_template else dst_name
+
+
+def _init_worker():
+
+    """
+        Builds a Jinja2 environment once per worker process.
+
+    """
+
+    global _worker_env
+    _worker_env = prepare_environment()
+
+
+def _compile_job(job):
+
+    """
+        Compiles a single template in a worker process.
+
+        `job`: tuple of `(name, src_path, dst_path, base_dir)`.
+
+        Returns `(name, dst_path or None, dependencies)`, where dependencies
+        are the names of templates this one extends, includes or imports.
+
+    """
+
+    name, src_path, dst_path, base_dir = job
+
+    try:
+        with open(src_path, 'r') as src_file:
+            source = src_file.read().decode('utf-8')
+        dependencies = sorted(filter(None, meta.find_referenced_templates(_worker_env.parse(source, name, src_path))))
+    except jinja2.TemplateSyntaxError:
+        dependencies = []
+
+    result = compile_file(_worker_env, src_path, dst_path, base_dir=base_dir, as_module=True)
+    if result == src_path:
+        return name, None, dependencies
+
+    _precompile(result)
+    return name, result, dependencies
+
+
+def plan(sources, target, manifest):
+
+    """
+        Works out which sources need recompiling against a previous build
+        manifest: anything new, changed or missing its output, plus every
+        template that (transitively) extends, includes or imports one of those.
+
+        Returns `(stale, hashes)`, where `stale` is a set of relative names.
+
+    """
+
+    found, previous = scan_sources(sources), manifest.get('templates', {})
+    hashes = dict((name, _hash_file(src_name)) for name, (src_name, _) in found.iteritems())
+
+    stale = set(name for name, (src_name, is_template) in found.iteritems() if (
+        name not in previous or
+        previous[name]['hash'] != hashes[name] or
+        not path.exists(_destination(target, name, is_template))))
+
+    # map each template to the templates that depend on it (by bare or relative name)
+    dependents = {}
+    for name, entry in previous.iteritems():
+        for dependency in entry.get('dependencies', ()):
+            dependents.setdefault(dependency, set()).add(name)
+
+    frontier = list(stale)
+    while frontier:
+        name = frontier.pop()
+        for dependent in dependents.get(name, set()) | dependents.get(name.rsplit('/', 1)[-1], set()):
+            if dependent in found and dependent not in stale:
+                stale.add(dependent)
+                frontier.append(dependent)
+
+    return stale, hashes
+
+
+def build(module, sources, target, root, incremental=True, jobs=None, bundle=False):
+
+    """
+        Compiles a tree of templates, optionally only those affected by
+        changes since the last build, fanning compilation out across a
+        process pool.
+
+        `module`: the base path to be removed from compiled template names.
+        `sources`: path to the source directory.
+        `target`: path to the compiled package directory.
+        `root`: root file path for generating import statements.
+        `incremental`: if True, consult the build manifest and skip
+            templates whose sources (and dependencies) are unchanged.
+        `jobs`: number of worker processes (defaults to every core).
+        `bundle`: if True, also write a single-file template bundle and
+            have the root package load templates from it.
+
+    """
+
+    manifest_path = path.join(target, _MANIFEST)
+    manifest = {}
+    if incremental and path.exists(manifest_path):
+        with open(manifest_path, 'r') as handle:
+            manifest = json.load(handle)
+    if manifest.get('compiler') != _compiler_fingerprint():
+        manifest = {}  # the compiler changed, so every template is stale
+
+    found = scan_sources(sources)
+    stale, hashes = plan(sources, target, manifest)
+    templates = dict(manifest.get('templates', {}))
+
+    # drop outputs for sources that have since been removed
+    for name in set(templates) - set(found):
+        output = templates.pop(name).get('output')
+        for leftover in filter(path.exists, (output, output and output + 'c', output and output + 'o')):
+            os.remove(leftover)
+
+    jobs_list = []
+    for name in sorted(stale):
+        src_name, is_template = found[name]
+        dst_name = _destination(target, name, is_template)
+        if not path.isdir(path.dirname(dst_name)):
+            os.makedirs(path.dirname(dst_name))
+
+        if not is_template:
+            # it's not a template, move it inline
+            shutil.copyfile(src_name, dst_name)
+            templates[name] = {'hash': hashes[name], 'output': dst_name}
+        else:
+            jobs_list.append((name, src_name, dst_name, module))
+
+    print 'Compiling %s of %s templates...' % (len(jobs_list), len([n for n in found if found[n][1]]))
+
+    if jobs_list:
+        pool = multiprocessing.Pool(processes=jobs or multiprocessing.cpu_count(), initializer=_init_worker)
+        try:
+            for name, output, dependencies in pool.imap_unordered(_compile_job, jobs_list):
+                print 'Compiled %s...' % name
+                if output:
+                    templates[name] = {'hash': hashes[name], 'output': output, 'dependencies': dependencies}
+                else:
+                    templates.pop(name, None)  # failed: force a retry next build
+        finally:
+            pool.close()
+            pool.join()
+
+    # regenerate package inits, which are cheap, from every compiled module -
+    # like `compile_dir`, each package imports everything beneath it
+    packages = {}
+    for name, (src_name, is_template) in found.iteritems():
+        if is_template and name in templates:
+            dst_name = _destination(target, name, is_template)
+            directory = path.dirname(dst_name)
+            while len(directory) >= len(target):
+                packages.setdefault(directory, []).append(_make_module_path(dst_name, root))
+                directory = path.dirname(directory)
+
+    for directory, modules in packages.iteritems():
+        _write_init(directory, sorted(modules), root, bundle=bundle and directory == target)
+
+    from finnalytics.templates import BUNDLE
+    if bundle:
+        print 'Wrote template bundle %s...' % write_bundle(target, templates)
+    elif path.exists(path.join(target, BUNDLE)):
+        os.remove(path.join(target, BUNDLE))  # left over from a bundled build
+
+    with open(manifest_path, 'w') as handle:
+        json.dump({'compiler': _compiler_fingerprint(), 'templates': templates}, handle, indent=2, sort_keys=True)
+
+    return sorted(templates[name]['output'] for name in templates if 'dependencies' in templates[name])
+
+
+def run(module=None, sources=None, target=None, incremental=False, jobs=None, bundle=False):
+
+    '''  '''
+
+    import os
+    root = os.path.dirname(os.path.abspath(os.path.realpath(__file__)))  ## scripts/
+    root = os.path.dirname(root)  ## /
+
+    if not module or not sources or not target:
+        module, sources, target = (
+            root+'/finnalytics/templates', root+'/finnalytics/templates/source', root+'/finnalytics/templates/compiled')
 
     print "=== Compiling canteen templates. ==="
 
-    for _mod in compile_dir(env, sources, target, base_dir=module, as_module=True, _root_path=root):
-        print 'Generated module %s...' % _mod
+    for _mod in build(module, sources, target, root, incremental=incremental, jobs=jobs, bundle=bundle):
+        print 'Generated module %s...' % _make_module_path(_mod, root)
 
     return 0
 
@@ -25,7 +25,7 @@ __author__ = "momentum labs, ltd"
 
 
 # stdlib
-import os, sys
+import os, sys, json
 
 project_root = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
 sys.path.insert(0, project_root)
@@ -75,6 +75,12 @@ class Finnalytics(cli.Tool):
     arguments = (
       ('--ip', '-i', {'type': str, 'help': 'address to bind to'}),
       ('--port', '-p', {'type': int, 'help': 'port to bind to'}),
+      ('--workers', '-w', {'type': int, 'help': 'fork this many gevent workers from a preloaded master'}),
+      ('--engine', '-e', {'choices': ('pywsgi', 'wsgi', 'stream'),
+                          'help': 'gevent engine for workers (defaults to `gevent.engine`)'}),
+      ('--reuseport', {'action': 'store_true', 'help': 'give each worker its own SO_REUSEPORT socket'}),
+      ('--max-requests', {'type': int, 'help': 'recycle workers after this many requests'}),
+      ('--max-memory', {'type': int, 'help': 'recycle workers past this much resident memory, in MB'})
     )
 
     def execute(arguments):
@@ -92,6 +98,19 @@ class Finnalytics(cli.Tool):
       import finnalytics, canteen
       from finnalytics.config import config
 
+      if arguments.workers:
+        from scripts import prefork
+
+        return prefork.Arbiter.from_config(config, **{
+          'interface': arguments.ip or '127.0.0.1',
+          'port': arguments.port or 8080,
+          'workers': arguments.workers,
+          'engine': arguments.engine,
+          'reuseport': arguments.reuseport or None,
+          'max_requests': arguments.max_requests,
+          'max_memory': arguments.max_memory and arguments.max_memory << 20
+        }).run()
+
       canteen.run(finnalytics, **{
         'port': arguments.port or 8080,
         'interface': arguments.ip or '127.0.0.1',
@@ -104,13 +123,16 @@ class Finnalytics(cli.Tool):
     ''' Builds local sources. '''
 
     arguments = (
-      ('--gzip', {'action': 'store_true', 'help': 'pre-gzip assets'}),
+      ('--gzip', {'action': 'store_true', 'help': 'fingerprint and pre-gzip assets, and write the asset manifest'}),
       ('--sass', {'action': 'store_true', 'help': 'collect/compile SASS'}),
       ('--scss', {'action': 'store_true', 'help': 'collect/compile SCSS'}),
       ('--less', {'action': 'store_true', 'help': 'collect/compile LESS'}),
       ('--coffee', {'action': 'store_true', 'help': 'collect/compile CoffeeScript'}),
       ('--closure', {'action': 'store_true', 'help': 'preprocess JS with closure compiler'}),
-      ('--templates', {'action': 'store_true', 'help': 'compile and optimize jinja2 templates'})
+      ('--templates', {'action': 'store_true', 'help': 'compile and optimize jinja2 templates'}),
+      ('--incremental', {'action': 'store_true', 'help': 'only recompile changed templates (and their dependents)'}),
+      ('--jobs', '-j', {'type': int, 'help': 'number of parallel build processes (defaults to all cores)'}),
+      ('--bundle', {'action': 'store_true', 'help': 'also pack compiled templates into a single-file bundle'})
     )
 
     def execute(arguments):
@@ -126,24 +148,40 @@ class Finnalytics(cli.Tool):
           passed to :py:meth:`sys.exit` and converted into Unix-style
           return codes. '''
 
+      if arguments.gzip:
+
+        logging.info('Fingerprinting and compressing app assets...')
+
+        from scripts import compile_assets
+
+        try:
+          compile_assets.run(jobs=arguments.jobs)
+        except:
+          logging.error('An exception was encountered while compiling assets.')
+          raise
+        else:
+          logging.info('Assets compiled successfully.')
+
       if arguments.templates:
 
         logging.info('Compiling app templates...')
 
         from scripts import compile_templates
 
-        # delete existing templates first, if any
-        logging.info('Cleaning existing template path...')
-        module_root = os.path.join(project_root, "finnalytics", "templates")
+        # delete existing templates first, if any (unless we're building incrementally)
+        if not arguments.incremental:
+          logging.info('Cleaning existing template path...')
+          module_root = os.path.join(project_root, "finnalytics", "templates")
 
-        clean_command = "rm -fr %s" % os.path.join(module_root, "compiled", "*")
-        if config.get('debug', False):
-          logging.debug('Executing command: "%s".' % clean_command)
-        os.system(clean_command)
+          clean_command = "rm -fr %s" % os.path.join(module_root, "compiled", "*")
+          if config.get('debug', False):
+            logging.debug('Executing command: "%s".' % clean_command)
+          os.system(clean_command)
 
         # run the template compiler
         try:
-          result = compile_templates.run()
+          result = compile_templates.run(
+            incremental=arguments.incremental, jobs=arguments.jobs, bundle=arguments.bundle)
         except:
           logging.error('An exception was encountered while compiling templates.')
           raise
@@ -151,6 +189,133 @@ class Finnalytics(cli.Tool):
           logging.info('Templates compiled successfully.')
 
 
+  class Archive(cli.Tool):
+
+    ''' Moves old event batches into on-disk segments. '''
+
+    arguments = (
+      ('type', {'nargs': '+', 'help': 'event type(s) to archive'}),
+      ('--age', '-a', {'type': float, 'help': ('archive batches whose last event is older than this,'
+                                                ' in seconds (defaults to `archive.age`)')})
+    )
+
+    def execute(arguments):
+
+      ''' Execute the ``finna archive`` tool, given a set of arguments
+          packaged as a :py:class:`argparse.Namespace`.
+
+          :param arguments: Product of the ``parser.parse_args()``
+          call, dispatched by ``apptools`` or manually.
+
+          :returns: Python value ``True`` or ``False`` depending on
+          the result of the call. ``Falsy`` return values will be
+          passed to :py:meth:`sys.exit` and converted into Unix-style
+          return codes. '''
+
+      import time
+      from finnalytics.config import config
+      from finnalytics.services import write
+
+      before = time.time() - (arguments.age or config.config.get('archive', {}).get('age', 7 * 86400))
+      for type in arguments.type:
+        segment = write.archive(type, before)
+        if segment is None:
+          logging.info('No batches of "%s" to archive.' % type)
+        else:
+          logging.info('Archived %s events of "%s" into "%s".' % (len(segment), type, segment.path))
+      return True
+
+
+  class Bench(cli.Tool):
+
+    ''' Load-tests the app under each gevent engine. '''
+
+    arguments = (
+      ('--engine', '-e', {'action': 'append', 'choices': ('pywsgi', 'wsgi', 'stream'),
+                          'help': 'engine to test (repeatable, defaults to all)'}),
+      ('--concurrency', '-c', {'type': int, 'help': 'concurrent keep-alive clients (defaults to 16)'}),
+      ('--requests', '-n', {'type': int, 'help': 'requests per engine (defaults to 2000)'}),
+      ('--script', '-s', {'type': str, 'help': 'JSON file of routes/RPC calls to replay'}),
+      ('--port', '-p', {'type': int, 'help': 'port to serve on while testing (defaults to 8089)'}),
+      ('--output', '-o', {'type': str, 'help': 'also write results as JSON to this path'})
+    )
+
+    def execute(arguments):
+
+      ''' Execute the ``finna bench`` tool, given a set of arguments
+          packaged as a :py:class:`argparse.Namespace`.
+
+          :param arguments: Product of the ``parser.parse_args()``
+          call, dispatched by ``apptools`` or manually.
+
+          :returns: Python value ``True`` or ``False`` depending on
+          the result of the call. ``Falsy`` return values will be
+          passed to :py:meth:`sys.exit` and converted into Unix-style
+          return codes. '''
+
+      from scripts import bench
+
+      results = []
+      for engine in arguments.engine or ('pywsgi', 'wsgi', 'stream'):
+        logging.info('Benchmarking engine "%s"...' % engine)
+        try:
+          results.append(bench.run(engine, **{
+            'port': arguments.port or 8089,
+            'script': arguments.script,
+            'concurrency': arguments.concurrency or 16,
+            'total': arguments.requests or 2000
+          }))
+        except ImportError as exc:
+          logging.warning('Skipping engine "%s": %s' % (engine, exc))
+
+      bench.report(results)
+      if arguments.output:
+        with open(arguments.output, 'w') as handle:
+          json.dump(results, handle, indent=2, sort_keys=True)
+      return bool(results)
+
+
+  class Startup(cli.Tool):
+
+    ''' Profiles cold-start time, per imported module. '''
+
+    arguments = (
+      ('--budget', '-b', {'type': float, 'help': ('fail if startup takes longer, in seconds'
+                                                   ' (defaults to `dev.startup.budget`)')}),
+      ('--top', '-t', {'type': int, 'help': 'number of slowest modules to list (defaults to 20)'}),
+      ('--output', '-o', {'type': str, 'help': 'also write the profile as JSON to this path'})
+    )
+
+    def execute(arguments):
+
+      ''' Execute the ``finna startup`` tool, given a set of arguments
+          packaged as a :py:class:`argparse.Namespace`.
+
+          :param arguments: Product of the ``parser.parse_args()``
+          call, dispatched by ``apptools`` or manually.
+
+          :returns: Python value ``True`` or ``False`` depending on
+          the result of the call. ``Falsy`` return values will be
+          passed to :py:meth:`sys.exit` and converted into Unix-style
+          return codes. '''
+
+      from scripts import startup
+      from finnalytics.config import config
+
+      budget = arguments.budget or config.app.get('dev', {}).get('startup', {}).get('budget')
+      result = startup.measure()
+      startup.report(result, top=arguments.top or 20, budget=budget)
+
+      if arguments.output:
+        with open(arguments.output, 'w') as handle:
+          json.dump(result, handle, indent=2, sort_keys=True)
+
+      if budget is not None and result['total'] > budget:
+        logging.error('Startup took %.0fms, over the %.0fms budget.' % (result['total'] * 1000, budget * 1000))
+        return False
+      return True
+
+
   class Deploy(cli.Tool):
 
     ''' Deploys code to prod/staging. '''
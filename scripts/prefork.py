@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+
+'''
+
+  prefork server
+  ~~~~~~~~~~~~~~
+
+  :author: Sam Gammon <sam@momentum.io>
+  :author: Ian Weisberger <ian@momentum.io>
+  :author: David Rekow <david@momentum.io>
+  :copyright: (c) momentum labs, 2014
+  :license: The inspection, use, distribution, modification or implementation
+            of this source code is governed by a private license - all rights
+            are reserved by the Authors (collectively, "momentum labs") and held
+            under relevant California and US Federal Copyright laws. For full
+            details, see ``LICENSE.md`` at the root of this project. Continued
+            inspection of this source code demands agreement with the included
+            license and explicitly means acceptance to these terms.
+
+'''
+
+# stdlib
+import os
+import sys
+import time
+import errno
+import random
+import signal
+import socket
+import resource
+
+# canteen util
+from canteen.util import debug
+
+# finnalytics
+from finnalytics.dispatch import server
+
+
+## Globals
+_LISTENER = 'FINNA_LISTENER_FD'  # inherited listening socket, across a reload
+_SIGNALS = (signal.SIGTERM, signal.SIGINT, signal.SIGQUIT, signal.SIGHUP)
+logging = debug.Logger(name='prefork')
+
+
+def listen(interface, port, backlog=1024, reuseport=False):
+
+  ''' open a listening socket on ``interface`` and ``port`` '''
+
+  sock = socket.socket(socket.AF_INET6 if ':' in interface else socket.AF_INET, socket.SOCK_STREAM)
+  sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+  if reuseport: sock.setsockopt(socket.SOL_SOCKET, getattr(socket, 'SO_REUSEPORT', 15), 1)
+  sock.bind((interface, port))
+  sock.listen(backlog)
+  return sock
+
+
+def rss():
+
+  ''' resident memory of this process, in bytes '''
+
+  try:
+    with open('/proc/self/statm') as handle:
+      return int(handle.read().split()[1]) * resource.getpagesize()
+  except (IOError, IndexError, ValueError):
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # no /proc: settle for the peak
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+##### !!! Worker !!! #####
+class Worker(object):
+
+  ''' a forked worker process, serving the app on the shared listener
+      with a gevent server until it is told to stop, has served
+      ``max_requests`` or has outgrown ``max_memory``. a retiring
+      worker stops accepting at once and exits once its in-flight
+      requests finish (or ``grace`` seconds pass), and the master
+      forks a replacement. '''
+
+  def __init__(self, app, listener, engine='wsgi', max_requests=None, max_memory=None, check=5, grace=30):
+
+    ''' initialize a worker (in the forked child) '''
+
+    self.app, self.listener, self.engine = app, listener, engine
+    self.max_requests, self.max_memory, self.check, self.grace = max_requests, max_memory, check, grace
+    self.served, self.server, self.retiring = 0, None, False
+
+  def run(self):
+
+    ''' serve until retired '''
+
+    import gevent
+    from gevent import pool
+
+    handler = getattr(gevent, 'signal_handler', None) or gevent.signal
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+      handler(signum, self.retire, 'signal %s' % signum)
+    signal.signal(signal.SIGQUIT, lambda *args: os._exit(0))
+
+    cls = server(self.engine)
+    options = {'log': None} if cls.__module__ == 'gevent.pywsgi' and not __debug__ else {}
+    options['spawn'] = pool.Pool()  # tracks in-flight requests, so that stopping waits for them
+    self.server = cls(self.listener, self.dispatch, **options)
+    if self.max_memory: gevent.spawn(self.watch)
+    self.server.serve_forever()
+
+  def dispatch(self, environ, start_response):
+
+    ''' dispatch a request to the app, counting it '''
+
+    self.served += 1
+    if self.max_requests and self.served >= self.max_requests: self.retire('served %s requests' % self.served)
+    return self.app(environ, start_response)
+
+  def watch(self):
+
+    ''' retire once resident memory passes ``max_memory`` '''
+
+    import gevent
+
+    while not self.retiring:
+      gevent.sleep(self.check)
+      if rss() > self.max_memory: self.retire('resident memory at %sMB' % (rss() >> 20))
+
+  def retire(self, reason):
+
+    ''' stop accepting and exit once in-flight requests finish '''
+
+    import gevent
+
+    if self.retiring: return
+    self.retiring = True
+    logging.info('Worker %s retiring (%s).' % (os.getpid(), reason))
+    gevent.spawn(self.server.stop, timeout=self.grace)
+
+
+##### !!! Arbiter !!! #####
+class Arbiter(object):
+
+  ''' prefork master: loads the app once, so forked workers share
+      its memory copy-on-write, then keeps ``workers`` of them running,
+      replacing any that exit. workers share the master's listening
+      socket, or each bind their own with ``SO_REUSEPORT``.
+
+      signals: ``TERM``/``INT`` stop gracefully, ``QUIT`` stops at
+      once, and ``HUP`` reloads: workers drain while the master
+      re-executes itself (keeping its socket, so no connection is
+      refused) to load fresh code and fork new ones. '''
+
+  def __init__(self, interface='127.0.0.1', port=8080, workers=2, engine='wsgi', reuseport=False,
+               max_requests=None, jitter=0.1, max_memory=None, check=5, grace=30):
+
+    ''' initialize a prefork master (see the ``gevent.workers`` config) '''
+
+    self.interface, self.port, self.count, self.engine, self.reuseport = interface, port, workers, engine, reuseport
+    self.max_requests, self.jitter, self.max_memory, self.check, self.grace = (
+      max_requests, jitter, max_memory, check, grace)
+    self.app, self.listener, self.workers, self.signals = None, None, {}, []
+    self.stopping, self.deadline, self.backoff, self.failures = False, None, 0, 0
+
+  @classmethod
+  def from_config(cls, config, **overrides):
+
+    ''' build a prefork master from the app's ``gevent`` config,
+        with ``overrides`` (skipping any that are ``None``) '''
+
+    settings = config.config.get('gevent', {})
+    options = dict(settings.get('workers', {}), engine=settings.get('engine', 'wsgi'))
+    options.update((key, value) for key, value in overrides.iteritems() if value is not None)
+    return cls(**options)
+
+  def load(self):
+
+    ''' patch for gevent and load the app, before forking '''
+
+    from gevent import monkey
+    monkey.patch_all()
+
+    from finnalytics.config import config
+    config.config.setdefault('streaming', {})['enable'] = self.engine == 'stream'
+
+    from finnalytics import dispatch
+    self.app = dispatch.load()
+
+  def bind(self):
+
+    ''' open (or, after a reload, inherit) the listening socket '''
+
+    inherited = os.environ.pop(_LISTENER, None)
+    if inherited:
+      self.listener = socket.fromfd(int(inherited), socket.AF_INET6 if ':' in self.interface else socket.AF_INET,
+                                    socket.SOCK_STREAM)
+      os.close(int(inherited))
+    elif not self.reuseport:
+      self.listener = listen(self.interface, self.port)
+
+  def run(self):
+
+    ''' serve until stopped '''
+
+    started = time.time()
+    self.load()
+    self.bind()
+
+    for signum in _SIGNALS:
+      signal.signal(signum, lambda signum, frame: self.signals.append(signum))
+
+    logging.info('Loaded app in %.0fms; forking %s "%s" workers on %s:%s.' % (
+      (time.time() - started) * 1000, self.count, self.engine, self.interface, self.port))
+
+    while True:
+      self.reap()
+      while self.signals: self.handle(self.signals.pop(0))
+
+      if self.stopping:
+        if not self.workers: break
+        if time.time() >= self.deadline: self.kill(signal.SIGKILL)
+      else:
+        self.maintain()
+      time.sleep(0.25)
+
+    logging.info('Stopped.')
+    return True
+
+  def handle(self, signum):
+
+    ''' act on a signal received by the master '''
+
+    if signum == signal.SIGHUP: return self.reload()
+    if signum == signal.SIGQUIT:
+      self.kill(signal.SIGQUIT)
+      os._exit(0)
+
+    if not self.stopping:
+      logging.info('Stopping gracefully...')
+      self.stopping, self.deadline = True, time.time() + self.grace
+      self.kill(signal.SIGTERM)
+
+  def reload(self):
+
+    ''' retire the current workers and re-execute the master, handing
+        it the listening socket '''
+
+    logging.info('Reloading...')
+    self.kill(signal.SIGTERM)
+    if self.listener is not None: os.environ[_LISTENER] = str(self.listener.fileno())
+    os.execv(sys.executable, [sys.executable] + (['-O'] if sys.flags.optimize else []) + sys.argv)
+
+  def maintain(self):
+
+    ''' fork workers until there are ``workers`` of them '''
+
+    if time.time() < self.backoff: return
+    while len(self.workers) < self.count:
+      self.spawn()
+
+  def spawn(self):
+
+    ''' fork a worker '''
+
+    limit = self.max_requests and self.max_requests + random.randint(0, int(self.max_requests * (self.jitter or 0)))
+
+    pid = os.fork()
+    if pid:
+      self.workers[pid] = time.time()
+      return pid
+
+    status = 0
+    try:
+      for signum in _SIGNALS: signal.signal(signum, signal.SIG_DFL)
+      listener = listen(self.interface, self.port, reuseport=True) if self.listener is None else self.listener
+      Worker(self.app, listener, self.engine, limit, self.max_memory, self.check, self.grace).run()
+    except Exception:
+      logging.exception('Worker %s crashed.' % os.getpid())
+      status = 1
+    finally:
+      os._exit(status)
+
+  def reap(self):
+
+    ''' collect exited workers, backing off from respawning ones that
+        keep failing as soon as they start '''
+
+    while True:
+      try:
+        pid, status = os.waitpid(-1, os.WNOHANG)
+      except OSError as exc:
+        if exc.errno == errno.ECHILD: return
+        raise
+      if not pid: return
+
+      started = self.workers.pop(pid, None)
+      if started is None or self.stopping: continue  # a worker retired by a reload, or stopping anyway
+
+      if status and time.time() - started < 1.0:
+        self.failures += 1
+        self.backoff = time.time() + min(2 ** self.failures, 30)
+        logging.warning('Worker %s failed on startup; retrying in %ss.' % (pid, min(2 ** self.failures, 30)))
+      else:
+        self.failures = 0
+
+  def kill(self, signum):
+
+    ''' send ``signum`` to every worker '''
+
+    for pid in self.workers.keys():
+      try:
+        os.kill(pid, signum)
+      except OSError as exc:
+        if exc.errno != errno.ESRCH: raise
+
+
+__all__ = (
+  'listen',
+  'rss',
+  'Worker',
+  'Arbiter'
+)
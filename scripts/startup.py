@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+'''
+
+  startup profiler
+  ~~~~~~~~~~~~~~~~
+
+  :author: Sam Gammon <sam@momentum.io>
+  :author: Ian Weisberger <ian@momentum.io>
+  :author: David Rekow <david@momentum.io>
+  :copyright: (c) momentum labs, 2014
+  :license: The inspection, use, distribution, modification or implementation
+            of this source code is governed by a private license - all rights
+            are reserved by the Authors (collectively, "momentum labs") and held
+            under relevant California and US Federal Copyright laws. For full
+            details, see ``LICENSE.md`` at the root of this project. Continued
+            inspection of this source code demands agreement with the included
+            license and explicitly means acceptance to these terms.
+
+'''
+
+# stdlib
+import os
+import sys
+import json
+import time
+import subprocess
+import __builtin__
+
+
+## Globals
+_root = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+_extra_paths = [
+  _root,
+  os.path.join(_root, 'lib'),
+  os.path.join(_root, 'lib/canteen'),
+  os.path.join(_root, 'finnalytics/lib')
+]
+
+
+##### !!! Import Timer !!! #####
+class ImportTimer(object):
+
+  ''' times the first import of every module while active, by
+      wrapping ``__import__``. each module is charged its own
+      (``self``) time, excluding the modules it imports in turn, and
+      its ``cumulative`` time, including them. '''
+
+  def __init__(self):
+
+    ''' initialize an (inactive) import timer '''
+
+    self.modules, self.stack, self.known, self.original = {}, [], set(sys.modules), None
+
+  def __enter__(self):
+
+    ''' start timing imports '''
+
+    self.original, __builtin__.__import__ = __builtin__.__import__, self
+    return self
+
+  def __exit__(self, *exc_info):
+
+    ''' stop timing imports '''
+
+    __builtin__.__import__ = self.original
+
+  def __call__(self, name, globals=None, locals=None, fromlist=None, level=-1):
+
+    ''' import ``name``, charging any modules it loads for the time '''
+
+    # modules are in ``sys.modules`` before their body runs, so claim them for the enclosing import first
+    if self.stack and len(sys.modules) != len(self.known): self.stack[-1][1].update(self.claim())
+
+    start = time.time()
+    self.stack.append([0.0, set()])
+    try:
+      return self.original(name, globals, locals, fromlist, level)
+    finally:
+      elapsed, (children, owned) = time.time() - start, self.stack.pop()
+      if self.stack: self.stack[-1][0] += elapsed
+
+      owned = [module for module in owned | self.claim() if sys.modules.get(module) is not None]
+      if owned:
+        # a dotted import loads its parent packages in the same call - charge the leaf
+        self.modules[max(owned, key=len)] = {'cumulative': elapsed, 'self': elapsed - children}
+
+  def claim(self):
+
+    ''' names of modules loaded since the last call '''
+
+    added = set(sys.modules) - self.known if len(sys.modules) != len(self.known) else set()
+    self.known |= added
+    return added
+
+  def slowest(self, count=None, key='self'):
+
+    ''' modules sorted by descending ``key`` time '''
+
+    return sorted(self.modules.iteritems(), key=lambda item: -item[1][key])[:count]
+
+
+def profile():
+
+  ''' time ``import finnalytics`` and spawning the app, per module.
+      meant to run in a fresh interpreter (see :py:func:`measure`). '''
+
+  with ImportTimer() as timer:
+    start = time.time()
+    import finnalytics
+    imported = time.time()
+    finnalytics.dispatch.create()
+    spawned = time.time()
+
+  return {
+    'import': imported - start,
+    'spawn': spawned - imported,
+    'total': spawned - start,
+    'modules': dict(timer.modules)}
+
+
+def measure():
+
+  ''' profile startup in a fresh interpreter, so nothing is already
+      imported. ``process`` is wall time including interpreter boot. '''
+
+  start = time.time()
+  command = [sys.executable] + (['-O'] if sys.flags.optimize else []) + [
+    os.path.join(_root, 'scripts', 'startup.py')]
+  output = subprocess.check_output(command, cwd=_root)
+  result = json.loads(output.strip().splitlines()[-1])
+  result['process'] = time.time() - start
+  return result
+
+
+def report(result, top=20, budget=None, out=sys.stdout):
+
+  ''' print ``result`` (from :py:func:`measure`) to ``out``, with the
+      ``top`` slowest modules by self time '''
+
+  out.write('%-56s %10s %10s\n' % ('module', 'self ms', 'cumul. ms'))
+  for module, timing in sorted(result['modules'].iteritems(), key=lambda item: -item[1]['self'])[:top]:
+    out.write('%-56s %10.1f %10.1f\n' % (module, timing['self'] * 1000, timing['cumulative'] * 1000))
+
+  out.write('\n')
+  for phase in ('import', 'spawn', 'total', 'process'):
+    if phase in result: out.write('%-56s %10.1f\n' % (phase, result[phase] * 1000))
+  if budget is not None:
+    out.write('%-56s %10.1f (%s)\n' % ('budget', budget * 1000, 'ok' if result['total'] <= budget else 'EXCEEDED'))
+
+
+if __name__ == '__main__':
+  for path in filter(lambda x: x not in sys.path, _extra_paths):
+    sys.path.insert(0, path)
+
+  # only the last line is the result (spawning may log)
+  sys.stdout.write('\n' + json.dumps(profile()) + '\n')
+
+
+__all__ = (
+  'ImportTimer',
+  'profile',
+  'measure',
+  'report'
+)
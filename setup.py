@@ -35,7 +35,10 @@ tools.setup(name="finnalytics",
               "finnalytics.services",
               "finnalytics.services.read",
               "finnalytics.services.write",
-              "finnalytics.services.security"
+              "finnalytics.services.security",
+              "finnalytics.storage",
+              "finnalytics.templates",
+              "finnalytics.templates.compiled"
             ] + [
               "finnalytics_tests"
             ] if __debug__ else [],
@@ -45,5 +48,5 @@ tools.setup(name="finnalytics",
             dependency_links=(
               "git+git://github.com/sgammon/canteen.git#egg=canteen-0.2-alpha",
             ),
-            tests_require=("nose",)
+            tests_require=("nose", "fakeredis<1.0")
 )